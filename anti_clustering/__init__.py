@@ -18,4 +18,8 @@ from anti_clustering.naive_random_heuristic import NaiveRandomHeuristicAntiClust
 from anti_clustering.exact_cluster_editing import ExactClusterEditingAntiClustering
 from anti_clustering.exchange_heuristic import ExchangeHeuristicAntiClustering
 from anti_clustering.tabu_search_heuristic import TabuSearchHeuristicAntiClustering
+from anti_clustering.parallel_tempering_heuristic import ParallelTemperingHeuristicAntiClustering
+from anti_clustering.online_anti_clustering import OnlineAntiClustering
+from anti_clustering.divide_and_conquer import DivideAndConquerAntiClustering
 from anti_clustering._base import AntiClustering
+from anti_clustering.callbacks import Callback, IterationInfo, MetricsCollector
@@ -13,21 +13,54 @@
 # limitations under the License.
 """Generic anti-clustering interface."""
 
-from typing import List, Optional
+import contextlib
+import time
+from typing import Dict, Iterator, List, Optional, Union
 from abc import ABC, abstractmethod
+import numpy as np
 import numpy.typing as npt
 import pandas as pd
-import scipy.spatial
-from scipy.spatial.distance import squareform, pdist
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import squareform
 from sklearn.preprocessing import MinMaxScaler
-from anti_clustering._union_find import UnionFind
+from anti_clustering.callbacks import Callback, PrintCallback
+from anti_clustering._distance import (
+    build_distance_matrix,
+    build_neighbour_graph,
+    check_distance_matrix,
+    get_block_size,
+    stack_codes,
+)
+from anti_clustering._parallel import effective_n_jobs
 
 
 class AntiClustering(ABC):
     """Generic anti-clustering interface."""
 
-    def __init__(self, verbose=False):
+    def __init__(
+        self,
+        verbose=False,
+        n_jobs: int = 1,
+        dtype: npt.DTypeLike = np.float64,
+        distance_block_size: Optional[int] = None,
+        callbacks: Optional[List[Callback]] = None,
+    ):
+        # pylint: disable = R0913
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError(f"dtype must be a floating point type, got {dtype}.")
+
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+        self.distance_block_size = distance_block_size
+        self.callbacks = callbacks
+
+    def __getstate__(self) -> dict:
+        # Callbacks are only called in the main process, so they are left out when sending algorithms to workers.
+        state = self.__dict__.copy()
+        state["callbacks"] = None
+        return state
 
     def run(
         self,
@@ -36,7 +69,12 @@ class AntiClustering(ABC):
         categorical_columns: Optional[List[str]],
         num_groups: int,
         destination_column: str,
+        metric: str = "euclidean",
+        weights: Optional[Dict[str, float]] = None,
+        num_neighbours: Optional[int] = None,
+        stratify_columns: Optional[List[str]] = None,
     ) -> pd.DataFrame:
+        # pylint: disable = R0913
         """
         Run anti clustering algorithm on dataset.
         :param df: The dataset to run anti-clustering on.
@@ -44,37 +82,180 @@ class AntiClustering(ABC):
         :param categorical_columns: Columns in dataset to use for anti-clustering containing strings or dates.
         :param num_groups: Number of anti-clusters to generate.
         :param destination_column: The column to write results to.
+        :param metric: The distance between elements, "euclidean", "cosine" or "gower". See compute_distance_matrix.
+        :param weights: Optional weight of each column. Columns not included have weight 1.
+        :param num_neighbours: If given, distances are approximated by a sparse matrix of this many nearest neighbours
+        of each row, see compute_distance_matrix.
+        :param stratify_columns: Optional columns whose combinations of values are spread evenly over the anti-clusters,
+        see run_with_distance_matrix.
+        :return: The original dataframe with a destination_column added.
+        """
+        distance_matrix = self.compute_distance_matrix(
+            df=df,
+            numerical_columns=numerical_columns,
+            categorical_columns=categorical_columns,
+            metric=metric,
+            weights=weights,
+            num_neighbours=num_neighbours,
+        )
+
+        return self.run_with_distance_matrix(
+            df=df,
+            distance_matrix=distance_matrix,
+            num_groups=num_groups,
+            destination_column=destination_column,
+            stratify_columns=stratify_columns,
+        )
+
+    def run_with_distance_matrix(
+        self,
+        df: pd.DataFrame,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        destination_column: str,
+        stratify_columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        # pylint: disable = R0913
+        """
+        Run anti clustering algorithm on dataset with a precomputed distance matrix, e.g. from compute_distance_matrix.
+        This allows computing distances once for several algorithms or numbers of anti-clusters, or using any other
+        distance.
+
+        With stratify_columns, each combination of values of these columns is a stratum, and the number of elements of
+        each stratum in any two anti-clusters differs by at most one. This is a hard constraint, only supported by the
+        swap-based heuristics: initial solutions deal each stratum evenly over the anti-clusters, and elements only
+        swap anti-clusters within their stratum.
+        :param df: The dataset to run anti-clustering on.
+        :param distance_matrix: Distances between rows of df. Either a symmetric square matrix with a zero diagonal, a
+        condensed matrix as returned by scipy.spatial.distance.pdist, or a sparse matrix from compute_distance_matrix
+        with num_neighbours. The matrix is not modified.
+        :param num_groups: Number of anti-clusters to generate.
+        :param destination_column: The column to write results to.
+        :param stratify_columns: Optional columns in dataset to stratify anti-clusters by.
         :return: The original dataframe with a destination_column added.
         """
+        if scipy.sparse.issparse(distance_matrix):
+            # Copied, as sorting indices would otherwise modify the matrix of the caller.
+            distance_matrix = scipy.sparse.csr_matrix(distance_matrix, dtype=self.dtype, copy=True)
+            distance_matrix.sort_indices()
+        else:
+            distance_matrix = np.asarray(distance_matrix)
+            if distance_matrix.ndim == 1:
+                distance_matrix = squareform(distance_matrix, checks=False)
+            distance_matrix = distance_matrix.astype(self.dtype, copy=False)
+        check_distance_matrix(distance_matrix=distance_matrix, num_elements=len(df))
+
+        with self._phase("solve"):
+            cluster_assignment = self._solve(
+                distance_matrix=distance_matrix, num_groups=num_groups, strata=self._get_strata(df, stratify_columns)
+            )
+
+        with self._phase("post_process"):
+            return self._post_process(
+                df=df, destination_column=destination_column, cluster_assignment=cluster_assignment
+            )
+
+    def compute_distance_matrix(
+        self,
+        df: pd.DataFrame,
+        numerical_columns: Optional[List[str]],
+        categorical_columns: Optional[List[str]],
+        metric: str = "euclidean",
+        weights: Optional[Dict[str, float]] = None,
+        num_neighbours: Optional[int] = None,
+    ) -> Union[npt.NDArray[float], scipy.sparse.csr_matrix]:
+        # pylint: disable = R0913
+        """
+        Compute the distance matrix used by run. Numerical columns are scaled to [0, 1] first. The distance is:
+        * "euclidean": The Euclidean distance between numerical columns plus the Hamming distance between categorical
+          columns.
+        * "cosine": The cosine distance between numerical columns plus the Hamming distance between categorical columns.
+        * "gower": The Gower distance, i.e. the mean over all columns of the absolute difference between numerical
+          columns and the mismatch between categorical columns.
+        Weights multiply the squared differences of the Euclidean and cosine distances and the terms of the Gower
+        distance. The Hamming distance is the weighted fraction of mismatching categorical columns.
+
+        For large datasets, where a dense matrix does not fit in memory, distances can be approximated from the
+        num_neighbours nearest neighbours of each row. The sparse matrix stores the distance between neighbours minus
+        the largest such distance, and treats all other pairs as being that far apart. This keeps near neighbours in
+        different anti-clusters, using O(N * num_neighbours) memory. Only the swap-based heuristics support sparse
+        matrices.
+        :param df: The dataset.
+        :param numerical_columns: Columns in dataset containing numbers.
+        :param categorical_columns: Columns in dataset containing strings or dates.
+        :param metric: The distance, "euclidean", "cosine" or "gower".
+        :param weights: Optional weight of each column. Columns not included have weight 1.
+        :param num_neighbours: If given, the number of nearest neighbours of each row in a sparse approximation.
+        :return: The distance matrix, with the dtype of the algorithm. A sparse CSR matrix if num_neighbours is given.
+        """
         numerical_columns = [] if numerical_columns is None else numerical_columns
         categorical_columns = [] if categorical_columns is None else categorical_columns
 
-        prepared_df = self._prepare_data(
-            df=df, numerical_columns=numerical_columns, categorical_columns=categorical_columns
-        )
+        with self._phase("prepare_data"):
+            prepared_df = self._prepare_data(
+                df=df, numerical_columns=numerical_columns, categorical_columns=categorical_columns
+            )
 
-        distance_matrix = self._get_distance_matrix(
-            df=prepared_df, numerical_columns=numerical_columns, categorical_columns=categorical_columns
-        )
+        with self._phase("distance_matrix"):
+            return self._get_distance_matrix(
+                df=prepared_df,
+                numerical_columns=numerical_columns,
+                categorical_columns=categorical_columns,
+                metric=metric,
+                weights=weights,
+                num_neighbours=num_neighbours,
+            )
 
-        cluster_assignment = self._solve(distance_matrix=distance_matrix, num_groups=num_groups)
+    def _get_callbacks(self) -> List[Callback]:
+        """
+        Get the callbacks to report progress to, including printing in verbose mode.
+        :return: The callbacks. Empty if progress is not reported.
+        """
+        callbacks = [] if self.callbacks is None else list(self.callbacks)
+        if self.verbose:
+            callbacks.append(PrintCallback())
+        return callbacks
 
-        return self._post_process(
-            df=df,
-            numerical_columns=numerical_columns,
-            categorical_columns=categorical_columns,
-            destination_column=destination_column,
-            cluster_assignment_matrix=cluster_assignment,
-        )
+    @contextlib.contextmanager
+    def _phase(self, phase: str) -> Iterator[None]:
+        """
+        Context manager timing a phase and reporting it to callbacks.
+        :param phase: Name of the phase.
+        :return:
+        """
+        callbacks = self._get_callbacks()
+        start = time.perf_counter()
+        yield
+        if len(callbacks) > 0:
+            seconds = time.perf_counter() - start
+            for callback in callbacks:
+                callback.on_phase_end(phase, seconds)
 
     @abstractmethod
-    def _solve(self, distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[bool]:
+    def _solve(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, strata: Optional[npt.NDArray[int]] = None
+    ) -> npt.NDArray:
         """
         Abstract solve signature. To be implemented in subclasses.
         :param distance_matrix: The distance matrix of elements.
         :param num_groups: Number of anti-clusters to generate.
-        :return:
+        :param strata: Optional stratum of each element, numbered from 0. Each stratum must be spread evenly over the
+        anti-clusters. Subclasses not supporting strata raise a ValueError.
+        :return: Either a vector with the anti-cluster label of each element, or a matrix containing for each pair of
+        elements if they belong to the same anti-cluster.
+        """
+
+    @staticmethod
+    def _get_strata(df: pd.DataFrame, stratify_columns: Optional[List[str]]) -> Optional[npt.NDArray[int]]:
+        """
+        Number the combinations of values of the columns to stratify by.
+        :param df: The input dataframe.
+        :param stratify_columns: Columns in dataset to stratify by, or None.
+        :return: The stratum of each element, or None without columns to stratify by.
         """
+        if stratify_columns is None or len(stratify_columns) == 0:
+            return None
+        return df.groupby(stratify_columns, sort=False, dropna=False).ngroup().to_numpy(dtype=np.intp)
 
     def _prepare_data(
         self, df: pd.DataFrame, numerical_columns: List[str], categorical_columns: List[str]
@@ -97,63 +278,92 @@ class AntiClustering(ABC):
 
         return df
 
-    def _post_process(
-        self,
-        df: pd.DataFrame,
-        numerical_columns: List[str],
-        categorical_columns: List[str],
-        destination_column: str,
-        cluster_assignment_matrix: npt.NDArray[bool],
-    ) -> pd.DataFrame:
-        # pylint: disable = R0913
+    def _post_process(self, df: pd.DataFrame, destination_column: str, cluster_assignment: npt.NDArray) -> pd.DataFrame:
         """
         Postprocess results and prepare for returning to caller.
         :param df: The input dataframe.
-        :param numerical_columns: Columns in dataset to use for anti-clustering containing numbers.
-        :param categorical_columns: Columns in dataset to use for anti-clustering containing strings or dates.
         :param destination_column: The column to write results to.
-        :param cluster_assignment_matrix: A matrix containing for each pair of elements if they belong to the same
-        anti-cluster.
+        :param cluster_assignment: Either a vector with the anti-cluster label of each element, or a matrix containing
+        for each pair of elements if they belong to the same anti-cluster. Only the upper triangle of the matrix is used.
         :return: The inputted dataframe with the new destination column.
         """
-        components = UnionFind(len(df))
-
-        for j in range(len(df)):
-            for i in range(0, j):
-                if cluster_assignment_matrix[i][j] == 1:
-                    components.union(i, j)
-
-        df = df.assign(**{destination_column: [components.find(i) for i in range(len(df))]})
+        if cluster_assignment.ndim == 2:
+            adjacency = scipy.sparse.csr_matrix(np.triu(np.asarray(cluster_assignment == 1, dtype=bool), k=1))
+            _, labels = connected_components(adjacency, directed=False)
+        else:
+            labels = cluster_assignment
 
         # Normalize cluster labels. The algorithm assignment of cluster labels may be non-deterministic.
-        # Ensure that all labels are enumerated starting from 0 without gaps.
-        cluster_labels = df.sort_values(by=[*numerical_columns, *categorical_columns])[destination_column].unique()
-        mapping = {k: i for i, k in enumerate(cluster_labels)}
-        df = df.replace({destination_column: mapping})
+        # Ensure that all labels are enumerated starting from 0 without gaps, in order of first occurrence.
+        _, first_occurrence, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        rank = np.empty(len(first_occurrence), dtype=np.intp)
+        rank[np.argsort(first_occurrence)] = np.arange(len(first_occurrence))
 
-        return df
+        return df.assign(**{destination_column: rank[inverse]})
 
     def _get_distance_matrix(
-        self, df: pd.DataFrame, numerical_columns: List[str], categorical_columns: List[str]
-    ) -> npt.NDArray[float]:
+        self,
+        df: pd.DataFrame,
+        numerical_columns: List[str],
+        categorical_columns: List[str],
+        metric: str = "euclidean",
+        weights: Optional[Dict[str, float]] = None,
+        num_neighbours: Optional[int] = None,
+    ) -> Union[npt.NDArray[float], scipy.sparse.csr_matrix]:
+        # pylint: disable = R0913
         """
         Calculate distance matrix between each pair of elements. Numeric columns default to Euclidean distance and
-        categorical columns default to Hamming distance.
+        categorical columns default to Hamming distance. The matrix is stored with the dtype of the algorithm, and is
+        computed in blocks of distance_block_size rows, in parallel if n_jobs allows it.
         :param df: The input dataframe.
         :param numerical_columns: Columns in dataset to use for anti-clustering containing numbers.
         :param categorical_columns: Columns in dataset to use for anti-clustering containing strings or dates.
+        :param metric: The distance, "euclidean", "cosine" or "gower".
+        :param weights: Optional weight of each column. Columns not included have weight 1.
+        :param num_neighbours: If given, the number of nearest neighbours of each element in a sparse approximation.
         :return: The distance matrix.
         """
+        weights = {} if weights is None else weights
+        unknown_columns = set(weights) - set(numerical_columns) - set(categorical_columns)
+        if len(unknown_columns) > 0:
+            raise ValueError(f"Weights given for columns not used for anti-clustering: {sorted(unknown_columns)}.")
+
+        numerical_data, numerical_weights = None, None
+        if len(numerical_columns) > 0:
+            numerical_data = df[numerical_columns].to_numpy(dtype=np.float64)
+            numerical_weights = np.array([weights.get(column, 1.0) for column in numerical_columns])
 
-        categorical_distance = 0
+        categorical_data, categorical_weights = None, None
         if len(categorical_columns) > 0:
-            categorical_distance = squareform(
-                pdist(df[categorical_columns].apply(lambda x: pd.factorize(x)[0]), metric="hamming")
-            )
+            categorical_data = stack_codes([pd.factorize(df[column])[0] for column in categorical_columns])
+            if any(column in weights for column in categorical_columns):
+                categorical_weights = np.array([weights.get(column, 1.0) for column in categorical_columns])
 
-        numeric_distance = 0
-        if len(numerical_columns) > 0:
-            numerical_data = df[numerical_columns].to_numpy()
-            numeric_distance = scipy.spatial.distance_matrix(numerical_data, numerical_data)
+        n_jobs = effective_n_jobs(self.n_jobs)
+        block_size = get_block_size(num_elements=len(df), n_jobs=n_jobs, block_size=self.distance_block_size)
 
-        return numeric_distance + categorical_distance
+        if num_neighbours is not None:
+            return build_neighbour_graph(
+                numerical_data=numerical_data,
+                categorical_data=categorical_data,
+                num_elements=len(df),
+                num_neighbours=num_neighbours,
+                dtype=self.dtype,
+                block_size=block_size,
+                n_jobs=n_jobs,
+                metric=metric,
+                numerical_weights=numerical_weights,
+                categorical_weights=categorical_weights,
+            )
+
+        return build_distance_matrix(
+            numerical_data=numerical_data,
+            categorical_data=categorical_data,
+            num_elements=len(df),
+            dtype=self.dtype,
+            block_size=block_size,
+            n_jobs=n_jobs,
+            metric=metric,
+            numerical_weights=numerical_weights,
+            categorical_weights=categorical_weights,
+        )
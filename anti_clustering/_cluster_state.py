@@ -0,0 +1,344 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compact anti-cluster assignment used by the swap-based heuristics.
+"""
+
+from typing import List, Optional, Tuple, Union
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse
+
+
+class ClusterState:
+    """
+    An anti-cluster assignment stored as a label vector together with a group membership index.
+    Elements are kept ordered by group in a single array, such that each group occupies a contiguous slice. This allows
+    swapping two elements and drawing a random element outside a group in constant time.
+
+    If a distance matrix is given, the state also maintains the summed distance from each element to each anti-cluster
+    and the objective value. This allows evaluating a swap in constant time, evaluating all swaps of an element in
+    linear time and completing a swap in linear time.
+
+    Elements may be divided into strata, such as the categories of a column. Only elements in the same stratum can then
+    swap anti-clusters, which keeps the number of elements of each stratum in each anti-cluster fixed. Elements are
+    ordered by stratum first, so each stratum and each anti-cluster within it occupy contiguous slices.
+
+    The distance matrix may also be a sparse CSR matrix with sorted indices, in which case missing entries are zero.
+    Completing a swap then takes time linear in the number of entries in the rows of the swapped elements, and
+    evaluating a swap takes logarithmic time.
+    """
+
+    # Number of rows of a dense distance matrix summed at a time when initializing.
+    _BLOCK_SIZE = 256
+
+    __slots__ = (
+        "labels",
+        "num_groups",
+        "strata",
+        "num_strata",
+        "objective",
+        "_members",
+        "_position",
+        "_offsets",
+        "_distance_matrix",
+        "_distance_to_group",
+    )
+
+    def __init__(
+        self,
+        labels: npt.NDArray[int],
+        num_groups: int,
+        distance_matrix: Optional[Union[npt.NDArray[float], scipy.sparse.csr_matrix]] = None,
+        strata: Optional[npt.NDArray[int]] = None,
+    ):
+        """
+        Initialize state from labels.
+        :param labels: The anti-cluster label of each element. Labels must be in the interval [0, num_groups).
+        :param num_groups: Number of anti-clusters.
+        :param distance_matrix: Optional distance matrix of elements. Required for evaluating swaps.
+        :param strata: Optional stratum of each element, in the interval [0, number of strata). Elements only swap
+        anti-clusters with elements in the same stratum. Defaults to a single stratum.
+        """
+        self.labels = np.array(labels, dtype=np.intp)
+        self.num_groups = num_groups
+        self.strata = np.zeros(len(self.labels), dtype=np.intp) if strata is None else np.asarray(strata, dtype=np.intp)
+        self.num_strata = int(self.strata.max(initial=0)) + 1
+        # Elements ordered by stratum and anti-cluster, and the position of each element in that ordering.
+        self._members = np.lexsort((self.labels, self.strata))
+        self._position = np.empty_like(self._members)
+        self._position[self._members] = np.arange(len(self.labels))
+        # Group g of stratum s occupies [_offsets[c], _offsets[c + 1]) of _members, with c = s * num_groups + g.
+        self._offsets = np.zeros(self.num_strata * num_groups + 1, dtype=np.intp)
+        np.cumsum(
+            np.bincount(self.strata * num_groups + self.labels, minlength=self.num_strata * num_groups),
+            out=self._offsets[1:],
+        )
+
+        self._distance_matrix = distance_matrix
+        self._distance_to_group = None
+        self.objective = None
+        if distance_matrix is not None:
+            # Stored group-major, i.e. _distance_to_group[g, i] is the summed distance from element i to all elements
+            # in anti-cluster g. This makes the updates following a swap contiguous in memory. Sums are always
+            # accumulated in double precision, also when the distance matrix is stored in reduced precision.
+            if scipy.sparse.issparse(distance_matrix):
+                one_hot = scipy.sparse.csr_matrix(
+                    (np.ones(len(self.labels)), (self.labels, np.arange(len(self.labels)))),
+                    shape=(num_groups, len(self.labels)),
+                )
+                self._distance_to_group = (one_hot @ distance_matrix.astype(np.float64)).toarray()
+            else:
+                # Computed as D @ Y for one-hot encoded labels Y, in blocks of rows of the symmetric distance matrix
+                # converted to double precision in a small scratch buffer.
+                num_elements = len(self.labels)
+                one_hot = np.zeros((num_elements, num_groups))
+                one_hot[np.arange(num_elements), self.labels] = 1.0
+                self._distance_to_group = np.empty((num_groups, num_elements), dtype=np.float64)
+                scratch = np.empty((max(1, min(self._BLOCK_SIZE, num_elements)), num_elements))
+                for start in range(0, num_elements, len(scratch)):
+                    block = scratch[: min(len(scratch), num_elements - start)]
+                    block[...] = distance_matrix[start : start + len(block)]
+                    self._distance_to_group[:, start : start + len(block)] = (block @ one_hot).T
+            self.objective = float(self._distance_to_group[self.labels, np.arange(len(self.labels))].sum())
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getstate__(self) -> dict:
+        # The distance matrix is left out when pickling, as it is usually shared between processes already.
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "_distance_matrix"}
+
+    def __setstate__(self, state: dict) -> None:
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._distance_matrix = None
+
+    def attach(self, distance_matrix: Union[npt.NDArray[float], scipy.sparse.csr_matrix]) -> None:
+        """
+        Attach the distance matrix the state was initialized with, e.g. after unpickling.
+        :param distance_matrix: The distance matrix.
+        :return:
+        """
+        self._distance_matrix = distance_matrix
+
+    def to_arrays(self) -> List[npt.NDArray]:
+        """
+        Get the arrays of a state with a distance matrix, from which from_arrays rebuilds it, e.g. in shared memory.
+        :return: The labels, strata, ordering of elements, position of each element, offsets of the anti-clusters in
+        the ordering and summed distances from each element to each anti-cluster.
+        """
+        return [self.labels, self.strata, self._members, self._position, self._offsets, self._distance_to_group]
+
+    @classmethod
+    def from_arrays(
+        cls,
+        arrays: List[npt.NDArray],
+        objective: float,
+        distance_matrix: Union[npt.NDArray[float], scipy.sparse.csr_matrix],
+    ) -> "ClusterState":
+        # pylint: disable = W0212
+        """
+        Rebuild a state from the arrays returned by to_arrays, without copying them. Swaps modify the arrays in place.
+        :param arrays: The arrays of the state.
+        :param objective: The objective value of the state.
+        :param distance_matrix: The distance matrix the state was initialized with.
+        :return: The state.
+        """
+        state = cls.__new__(cls)
+        state.labels, state.strata, state._members, state._position, state._offsets, state._distance_to_group = arrays
+        state.num_groups = len(state._distance_to_group)
+        state.num_strata = (len(state._offsets) - 1) // state.num_groups
+        state.objective = objective
+        state._distance_matrix = distance_matrix
+        return state
+
+    def copy(self) -> "ClusterState":
+        # pylint: disable = W0212
+        """
+        Copy the state.
+        :return: An independent copy of the state.
+        """
+        state = ClusterState.__new__(ClusterState)
+        state.labels = self.labels.copy()
+        state.num_groups = self.num_groups
+        # Strata never change, so they are shared.
+        state.strata = self.strata
+        state.num_strata = self.num_strata
+        state._members = self._members.copy()
+        state._position = self._position.copy()
+        state._offsets = self._offsets.copy()
+        state._distance_matrix = self._distance_matrix
+        state._distance_to_group = None if self._distance_to_group is None else self._distance_to_group.copy()
+        state.objective = self.objective
+        return state
+
+    def members(self, group: int) -> npt.NDArray[int]:
+        """
+        Get the elements of an anti-cluster.
+        :param group: The anti-cluster.
+        :return: The elements in the anti-cluster, read-only. A view of the state with a single stratum, which changes
+        with swaps, and a copy with several strata, which does not.
+        """
+        if self.num_strata > 1:
+            cells = range(group, len(self._offsets) - 1, self.num_groups)
+            members = np.concatenate([self._members[self._offsets[cell] : self._offsets[cell + 1]] for cell in cells])
+        else:
+            members = self._members[self._offsets[group] : self._offsets[group + 1]]
+        members.flags.writeable = False
+        return members
+
+    def group_size(self, group: int) -> int:
+        """
+        Get the number of elements in an anti-cluster.
+        :param group: The anti-cluster.
+        :return: The size of the anti-cluster.
+        """
+        return int(np.diff(self._offsets)[group :: self.num_groups].sum())
+
+    def exchanges(self, i: int) -> npt.NDArray[int]:
+        """
+        Get the elements that element i can swap anti-clusters with, i.e. all elements in the same stratum in other
+        anti-clusters.
+        :param i: Element index.
+        :return: Possible exchanges.
+        """
+        stratum_start, cell_start, cell_end, stratum_end = self._slices(i)
+        return np.concatenate((self._members[stratum_start:cell_start], self._members[cell_end:stratum_end]))
+
+    def num_exchanges(self, i: int) -> int:
+        """
+        Get the number of elements that element i can swap anti-clusters with.
+        :param i: Element index.
+        :return: Number of possible exchanges.
+        """
+        stratum_start, cell_start, cell_end, stratum_end = self._slices(i)
+        return int(stratum_end - stratum_start - (cell_end - cell_start))
+
+    def exchange(self, i: int, k: int) -> int:
+        """
+        Get the k'th possible exchange of element i in constant time. Equivalent to self.exchanges(i)[k].
+        :param i: Element index.
+        :param k: Index into possible exchanges. Must be in the interval [0, self.num_exchanges(i)).
+        :return: Element to swap with.
+        """
+        stratum_start, cell_start, cell_end, _ = self._slices(i)
+        k += stratum_start
+        if k >= cell_start:
+            k += cell_end - cell_start
+        return int(self._members[k])
+
+    def _slices(self, i: int) -> Tuple[int, int, int, int]:
+        """
+        Get the slices of _members holding the stratum of element i, and the anti-cluster of i within the stratum.
+        :param i: Element index.
+        :return: Start of the stratum, start and end of the anti-cluster, and end of the stratum.
+        """
+        stratum_cell = self.strata[i] * self.num_groups
+        cell = stratum_cell + self.labels[i]
+        offsets = self._offsets
+        return offsets[stratum_cell], offsets[cell], offsets[cell + 1], offsets[stratum_cell + self.num_groups]
+
+    def swap_delta(self, i: int, j: int) -> float:
+        """
+        Calculate the change in objective value if anti-clusters of elements i and j are swapped.
+        Requires the state to be initialized with a distance matrix.
+        :param i: Element.
+        :param j: Other element in a different anti-cluster.
+        :return: The change in objective value.
+        """
+        group_i, group_j = self.labels[i], self.labels[j]
+        distance_to_group = self._distance_to_group
+        return 2.0 * float(
+            distance_to_group[group_j, i]
+            - distance_to_group[group_i, i]
+            + distance_to_group[group_i, j]
+            - distance_to_group[group_j, j]
+            - 2.0 * self._distance(i, j)
+        )
+
+    def swap_deltas(self, i: int) -> npt.NDArray[float]:
+        """
+        Calculate the change in objective value for swapping element i with every element.
+        Requires the state to be initialized with a distance matrix.
+        :param i: Element.
+        :return: The change in objective value for each element. Elements in the same anti-cluster as i, or in another
+        stratum, are -inf.
+        """
+        group_i = self.labels[i]
+        distance_to_group = self._distance_to_group
+        distance_to_own_group = distance_to_group[self.labels, np.arange(len(self.labels))]
+        deltas = distance_to_group[self.labels, i] - distance_to_group[group_i, i]
+        deltas += distance_to_group[group_i]
+        deltas -= distance_to_own_group
+        distance_matrix = self._distance_matrix
+        if scipy.sparse.issparse(distance_matrix):
+            start, end = distance_matrix.indptr[i], distance_matrix.indptr[i + 1]
+            deltas[distance_matrix.indices[start:end]] -= 2.0 * distance_matrix.data[start:end]
+        else:
+            deltas -= 2.0 * distance_matrix[i]
+        deltas *= 2.0
+        deltas[self.labels == group_i] = -np.inf
+        if self.num_strata > 1:
+            deltas[self.strata != self.strata[i]] = -np.inf
+        return deltas
+
+    def _distance(self, i: int, j: int) -> float:
+        """
+        Look up the distance between two elements.
+        :param i: Element.
+        :param j: Other element.
+        :return: The distance.
+        """
+        distance_matrix = self._distance_matrix
+        if not scipy.sparse.issparse(distance_matrix):
+            return float(distance_matrix[i, j])
+        start, end = distance_matrix.indptr[i], distance_matrix.indptr[i + 1]
+        position = start + np.searchsorted(distance_matrix.indices[start:end], j)
+        if position < end and distance_matrix.indices[position] == j:
+            return float(distance_matrix.data[position])
+        return 0.0
+
+    def swap(self, i: int, j: int, delta: Optional[float] = None) -> None:
+        """
+        Swap anti-clusters of elements i and j in place.
+        :param i: Element.
+        :param j: Other element in the same stratum.
+        :param delta: The change in objective value, if already calculated with swap_delta or swap_deltas.
+        :return:
+        """
+        if self._distance_to_group is not None:
+            self.objective += self.swap_delta(i, j) if delta is None else delta
+            group_i, group_j = self.labels[i], self.labels[j]
+            distance_matrix = self._distance_matrix
+            if scipy.sparse.issparse(distance_matrix):
+                # Only the stored entries of both rows change. Columns are unique within a row.
+                indptr, indices, data = distance_matrix.indptr, distance_matrix.indices, distance_matrix.data
+                for element, sign in ((i, -1.0), (j, 1.0)):
+                    columns = indices[indptr[element] : indptr[element + 1]]
+                    row = sign * data[indptr[element] : indptr[element + 1]].astype(np.float64)
+                    self._distance_to_group[group_i, columns] += row
+                    self._distance_to_group[group_j, columns] -= row
+            else:
+                row_i, row_j = distance_matrix[i], distance_matrix[j]
+                # Element i moves from group_i to group_j, and element j moves the other way.
+                self._distance_to_group[group_i] += row_j
+                self._distance_to_group[group_i] -= row_i
+                self._distance_to_group[group_j] += row_i
+                self._distance_to_group[group_j] -= row_j
+
+        position_i, position_j = self._position[i], self._position[j]
+        self._members[position_i], self._members[position_j] = j, i
+        self._position[i], self._position[j] = position_j, position_i
+        self.labels[i], self.labels[j] = self.labels[j], self.labels[i]
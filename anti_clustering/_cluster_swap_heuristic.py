@@ -13,79 +13,385 @@
 # limitations under the License.
 """Abstract class containing utilities for cluster swap-based heuristics."""
 
-from abc import ABC
-import random
+import contextlib
+import itertools
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional, Tuple
 import numpy as np
 import numpy.typing as npt
+import scipy.sparse
+from anti_clustering.callbacks import Callback, IterationInfo
 from anti_clustering._base import AntiClustering
-from anti_clustering._union_find import UnionFind
+from anti_clustering._cluster_state import ClusterState
+from anti_clustering._distance import get_block_size
+from anti_clustering._early_stopping import EarlyStopping, get_deadline, is_past
+from anti_clustering._kernels import check_backend, compile_kernels, use_numba
+from anti_clustering._parallel import SharedDistanceMatrixPool, effective_n_jobs
 
 
 class ClusterSwapHeuristic(AntiClustering, ABC):
-    """Abstract class containing utilities for cluster swap-based heuristics."""
+    """
+    Abstract class containing utilities for cluster swap-based heuristics.
 
-    def __init__(self, verbose: bool = False, random_seed: int = None):
-        super().__init__(verbose=verbose)
-        self.rnd = random.Random(random_seed)
+    Initial solutions are generated by one of the following strategies:
+    * "random": Balanced random assignment.
+    * "stripe": Elements are sorted along a one-dimensional projection and split into consecutive stripes of num_groups
+      elements. Each stripe is spread over all anti-clusters in random order, so similar elements start in different
+      anti-clusters.
+    With strata, both strategies deal the elements of each stratum over the anti-clusters separately, and swaps are
+    restricted to elements in the same stratum, so each stratum stays spread evenly.
 
-    def _get_exchanges(self, cluster_assignment: npt.NDArray[bool], i: int) -> npt.NDArray[int]:
+    Restarts can be stopped early. With time_limit, no restart starts after the time limit, and running restarts stop
+    at the time limit, so the best solution found within the time limit is returned. The first restart always runs,
+    at least until its initial solution. With stagnation_limit, a restart stops after that many consecutive iterations
+    without improving on the best objective value of the restart by more than a fraction stagnation_tolerance.
+
+    These options are shared by all swap-based heuristics, which take them as keyword arguments and pass them on.
+    """
+
+    _INITIALIZATIONS = ("random", "stripe")
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        random_seed: int = None,
+        n_jobs: int = 1,
+        dtype: npt.DTypeLike = np.float64,
+        distance_block_size: Optional[int] = None,
+        initialization: str = "random",
+        callbacks: Optional[List[Callback]] = None,
+        time_limit: Optional[float] = None,
+        stagnation_limit: Optional[int] = None,
+        stagnation_tolerance: float = 0.0,
+    ):
+        # pylint: disable = R0913
+        super().__init__(
+            verbose=verbose, n_jobs=n_jobs, dtype=dtype, distance_block_size=distance_block_size, callbacks=callbacks
+        )
+        if initialization not in self._INITIALIZATIONS:
+            raise ValueError(f"Unknown initialization: {initialization}. Must be one of {self._INITIALIZATIONS}.")
+        if stagnation_limit is not None and stagnation_limit < 1:
+            raise ValueError(f"stagnation_limit must be at least 1, got {stagnation_limit}.")
+        if stagnation_tolerance < 0:
+            raise ValueError(f"stagnation_tolerance must be non-negative, got {stagnation_tolerance}.")
+        self.random_seed = random_seed
+        self.initialization = initialization
+        self.time_limit = time_limit
+        self.stagnation_limit = stagnation_limit
+        self.stagnation_tolerance = stagnation_tolerance
+
+    def _get_early_stopping(self, objective: float, deadline: Optional[float]) -> EarlyStopping:
+        """
+        Get the stopping criteria of a restart.
+        :param objective: The initial objective value of the restart.
+        :param deadline: Time at which to stop, as returned by get_deadline, or None.
+        :return: The stopping criteria.
         """
-        Given a cluster assignment matrix and element index, will return possible indexes to swap anti-clusters with.
-        :param cluster_assignment: Cluster assignment matrix.
-        :param i: Element index.
-        :return: Possible exchanges.
+        return EarlyStopping(
+            stagnation_limit=self.stagnation_limit,
+            tolerance=self.stagnation_tolerance,
+            deadline=deadline,
+            objective=objective,
+        )
+
+    def _get_initial_clusters(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> ClusterState:
+        """
+        Get an initialization of anti-clusters, supporting evaluation of swaps.
+        :param distance_matrix: The distance matrix of elements.
+        :param num_groups: Number of anti-clusters to generate.
+        :param rng: Random generator.
+        :param strata: Optional stratum of each element.
+        :return: The initialized anti-clusters.
         """
-        return np.nonzero(np.invert(cluster_assignment[i]))[0]
+        return ClusterState(
+            labels=self._get_initial_labels(
+                distance_matrix=distance_matrix, num_groups=num_groups, rng=rng, strata=strata
+            ),
+            num_groups=num_groups,
+            distance_matrix=distance_matrix,
+            strata=strata,
+        )
 
-    def _swap(self, cluster_assignment: npt.NDArray[bool], i: int, j: int) -> npt.NDArray[bool]:
+    def _get_initial_labels(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        size: Optional[int] = None,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> npt.NDArray[int]:
+        # pylint: disable = R0913
         """
-        Swap anti-clusters of elements i and j.
-        :param cluster_assignment: Current cluster assignment.
-        :param i: Element.
-        :param j: Other element.
-        :return: Cluster assignment with i and j swapped.
+        Get balanced initial anti-cluster labels using the initialization strategy.
+        :param distance_matrix: The distance matrix of elements.
+        :param num_groups: Number of anti-clusters to generate.
+        :param rng: Random generator.
+        :param size: If given, a batch of this many initializations is generated at once.
+        :param strata: Optional stratum of each element, spread evenly over the anti-clusters.
+        :return: Labels of shape (num elements,), or (size, num elements) if size is given.
         """
-        cluster_assignment = cluster_assignment.copy()
-        tmp1 = cluster_assignment[i,].copy()
-        tmp2 = cluster_assignment[:, i].copy()
-        cluster_assignment[i,] = cluster_assignment[j,]
-        cluster_assignment[:, i] = cluster_assignment[:, j]
-        cluster_assignment[j,] = tmp1
-        cluster_assignment[:, j] = tmp2
-        cluster_assignment[i, j] = False
-        cluster_assignment[j, i] = False
-        return cluster_assignment
+        num_elements = distance_matrix.shape[0]
+        batch_size = 1 if size is None else size
 
-    def _get_random_clusters(self, num_groups: int, num_elements: int) -> npt.NDArray[bool]:
+        if self.initialization == "stripe" and scipy.sparse.issparse(distance_matrix):
+            raise ValueError("Stripe initialization requires a dense distance matrix.")
+        if strata is not None:
+            labels = self._get_stratified_labels(
+                distance_matrix=distance_matrix, num_groups=num_groups, rng=rng, batch_size=batch_size, strata=strata
+            )
+        elif self.initialization == "stripe":
+            # Consecutive stripes of num_groups elements along the projection each get a random permutation of labels.
+            # A last incomplete stripe gets a random subset of labels, so anti-clusters are balanced.
+            num_stripes = -(-num_elements // num_groups)
+            stripes = np.broadcast_to(np.arange(num_groups), (batch_size, num_stripes, num_groups))
+            stripes = rng.permuted(stripes, axis=2).reshape(batch_size, -1)[:, :num_elements]
+            labels = np.empty((batch_size, num_elements), dtype=np.intp)
+            labels[:, np.argsort(self._get_projection(distance_matrix=distance_matrix, rng=rng))] = stripes
+        else:
+            labels = np.broadcast_to(np.arange(num_elements, dtype=np.intp) % num_groups, (batch_size, num_elements))
+            labels = rng.permuted(labels, axis=1)
+
+        return labels[0] if size is None else labels
+
+    def _get_stratified_labels(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        batch_size: int,
+        strata: npt.NDArray[int],
+    ) -> npt.NDArray[int]:
+        # pylint: disable = R0913
         """
-        Get a random initialization of anti-clusters.
+        Get a batch of balanced initial labels, spreading each stratum evenly over the anti-clusters. Elements are
+        ordered by stratum, and within strata randomly or along the projection, and labels are dealt round-robin along
+        that order. Each stratum thereby receives labels in turn, continuing where the previous stratum stopped, so both
+        strata and anti-clusters are balanced. With stripe initialization, labels are shuffled within consecutive
+        stripes of num_groups elements of a stratum.
+        :param distance_matrix: The distance matrix of elements.
         :param num_groups: Number of anti-clusters to generate.
-        :param num_elements: Number of elements in algorithm run.
-        :return: The randomly initialized anti-clusters as an assignment matrix
-        """
-        if self.verbose:
-            print("Initializing clusters")
-
-        # Using UnionFind to generate random anti-clusters. The first num_groups elements are guaranteed
-        # to be roots of each their own component. All other elements are assigned a random root.
-        initial_clusters = [i % num_groups for i in range(num_elements - num_groups)]
-        self.rnd.shuffle(initial_clusters)
-        initial_clusters = list(range(num_groups)) + initial_clusters
-        uf_init = UnionFind(len(initial_clusters))  # pylint: disable = R1721
-        for i, cluster in enumerate(initial_clusters):
-            uf_init.union(i, cluster)
-
-        cluster_assignment = np.array(
-            [[uf_init.connected(i, j) for i in range(num_elements)] for j in range(num_elements)]
+        :param rng: Random generator.
+        :param batch_size: Number of initializations.
+        :param strata: Stratum of each element.
+        :return: Labels of shape (batch_size, num elements).
+        """
+        num_elements = len(strata)
+        keys = rng.random((batch_size, num_elements))
+        labels = np.empty((batch_size, num_elements), dtype=np.intp)
+        if self.initialization == "stripe":
+            order = np.lexsort((self._get_projection(distance_matrix=distance_matrix, rng=rng), strata))
+            sorted_strata = strata[order]
+            # Index of each element within its stratum, along the order.
+            within_stratum = np.arange(num_elements) - np.searchsorted(sorted_strata, sorted_strata)
+            stripes = sorted_strata * num_elements + within_stratum // num_groups
+            # Positions along the order, shuffled within stripes.
+            shuffled = np.lexsort((keys, np.broadcast_to(stripes, keys.shape)))
+            labels[:, order] = shuffled % num_groups
+        else:
+            order = np.lexsort((keys, np.broadcast_to(strata, keys.shape)))
+            np.put_along_axis(labels, order, np.arange(num_elements) % num_groups, axis=1)
+        return labels
+
+    def _get_projection(self, distance_matrix: npt.NDArray[float], rng: np.random.Generator) -> npt.NDArray[float]:
+        """
+        Project elements onto a line through two far apart elements, using only their distances (as in FastMap).
+        :param distance_matrix: The distance matrix of elements.
+        :param rng: Random generator for selecting the first pivot.
+        :return: The coordinate of each element along the line.
+        """
+        pivot_1 = int(np.argmax(distance_matrix[rng.integers(distance_matrix.shape[0])]))
+        pivot_2 = int(np.argmax(distance_matrix[pivot_1]))
+        distance_1 = np.asarray(distance_matrix[pivot_1], dtype=np.float64)
+        distance_2 = np.asarray(distance_matrix[pivot_2], dtype=np.float64)
+        return np.square(distance_1) - np.square(distance_2)
+
+    def _calculate_objectives(
+        self, labels: npt.NDArray[int], distance_matrix: npt.NDArray[float], num_groups: int
+    ) -> npt.NDArray[float]:
+        """
+        Calculate objective values of a batch of solutions at once, i.e. the sum of distances between all pairs of
+        elements in the same anti-cluster. With one-hot encoded labels Y, the objective is the sum of (DY) * Y, where
+        DY is computed by matrix multiplication in blocks of rows, accumulated in double precision.
+        :param labels: Labels of shape (number of solutions, number of elements).
+        :param distance_matrix: Distance matrix.
+        :param num_groups: Number of anti-clusters.
+        :return: Objective value of each solution.
+        """
+        batch_size, num_elements = labels.shape
+        one_hot = np.zeros((num_elements, batch_size * num_groups))
+        one_hot[np.arange(num_elements), labels + (np.arange(batch_size) * num_groups)[:, None]] = 1.0
+
+        objectives = np.zeros(batch_size * num_groups)
+        block_size = get_block_size(num_elements=num_elements, n_jobs=1, block_size=self.distance_block_size)
+        for start in range(0, num_elements, block_size):
+            block = distance_matrix[start : start + block_size]
+            if scipy.sparse.issparse(block):
+                block = block.astype(np.float64)
+            else:
+                block = np.asarray(block, dtype=np.float64)
+            objectives += np.einsum("ij,ij->j", block @ one_hot, one_hot[start : start + block_size])
+
+        return objectives.reshape(batch_size, num_groups).sum(axis=1)
+
+
+class RestartHeuristic(ClusterSwapHeuristic, ABC):
+    """
+    Abstract class for cluster swap-based heuristics running independent restarts, each from its own initial solution,
+    and returning the best solution found. Subclasses implement a single restart.
+
+    With backend "numba", or "auto" if Numba is installed, restarts run as compiled kernels if there are no callbacks.
+    The kernels are compiled before the time limit starts.
+    """
+
+    def __init__(self, restarts: int = 9, backend: str = "python", **kwargs):
+        super().__init__(**kwargs)
+        check_backend(backend)
+        self.restarts = restarts
+        self.backend = backend
+
+    def _solve(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, strata: Optional[npt.NDArray[int]] = None
+    ) -> npt.NDArray[int]:
+        if use_numba(self.backend, distance_matrix) and len(self._get_callbacks()) == 0:
+            compile_kernels(distance_matrix.dtype)
+        return self._run_restarts(
+            distance_matrix=distance_matrix, num_groups=num_groups, restarts=self.restarts, strata=strata
         )
 
-        return cluster_assignment
+    def _run_restarts(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        restarts: int,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> npt.NDArray[int]:
+        """
+        Run independent restarts of the heuristic and select the best solution. If n_jobs allows it, restarts run in a
+        pool of worker processes sharing the distance matrix. Each restart has its own random stream derived from
+        random_seed, so the result does not depend on the number of workers. If there are callbacks, the iterations of
+        each restart are recorded and reported when the restart has finished.
+        :param distance_matrix: The distance matrix of elements.
+        :param num_groups: Number of anti-clusters to generate.
+        :param restarts: Number of restarts.
+        :param strata: Optional stratum of each element.
+        :return: The anti-cluster labels of the best solution found.
+        """
+        callbacks = self._get_callbacks()
+        record = len(callbacks) > 0
+        deadline = get_deadline(self.time_limit)
+
+        # Seeds are spawned one at a time, so restarts skipped at the time limit are never spawned.
+        seed_sequence = np.random.SeedSequence(self.random_seed)
+        seeds = (seed_sequence.spawn(1)[0] for _ in range(restarts))
+        n_jobs = min(effective_n_jobs(self.n_jobs), restarts)
+
+        candidate_solutions = []
+
+        with contextlib.ExitStack() as stack:
+            if n_jobs > 1:
+                pool = stack.enter_context(SharedDistanceMatrixPool(distance_matrix=distance_matrix, n_jobs=n_jobs))
+                solutions = pool.map(
+                    self._run_restart,
+                    itertools.repeat(num_groups),
+                    seeds,
+                    range(restarts),
+                    itertools.repeat(record),
+                    itertools.repeat(deadline),
+                    itertools.repeat(strata),
+                )
+            else:
+                solutions = (
+                    self._run_restart(distance_matrix, num_groups, seed, restart, record, deadline, strata)
+                    for restart, seed in enumerate(seeds)
+                )
+
+            for restart, solution in enumerate(solutions):
+                if solution is None:
+                    # Skipped, as the time limit was reached before the restart started.
+                    continue
+                objective, labels, iterations = solution
+                candidate_solutions.append((objective, labels))
+
+                for callback in callbacks:
+                    for info in iterations:
+                        callback.on_iteration(info)
+                    callback.on_restart_end(restart, objective)
 
-    def _calculate_objective(self, cluster_assignment: npt.NDArray[bool], distance_matrix: npt.NDArray[float]) -> float:
+                if is_past(deadline):
+                    break
+
+        # Select best solution, maximizing objective
+        _, best_labels = max(candidate_solutions, key=lambda x: x[0])
+
+        return best_labels
+
+    def _run_restart(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        seed: np.random.SeedSequence,
+        restart: int,
+        record: bool,
+        deadline: Optional[float],
+        strata: Optional[npt.NDArray[int]],
+    ) -> Optional[Tuple[float, npt.NDArray[int], List[IterationInfo]]]:
+        # pylint: disable = R0913
+        """
+        Run a single restart. Only the objective value, labels and recorded iterations are returned, as these are cheap
+        to send between processes.
+        :param distance_matrix: The distance matrix of elements.
+        :param num_groups: Number of anti-clusters to generate.
+        :param seed: Seed of the random stream of the restart.
+        :param restart: Index of the restart.
+        :param record: Whether to record the progress of each iteration.
+        :param deadline: Time at which to stop, as returned by get_deadline, or None.
+        :param strata: Optional stratum of each element.
+        :return: The objective value and labels of the solution, and the recorded iterations. None if the restart was
+        skipped because the deadline had passed.
+        """
+        if restart > 0 and is_past(deadline):
+            return None
+
+        iterations: List[IterationInfo] = []
+
+        def report(**kwargs) -> None:
+            iterations.append(IterationInfo(restart=restart, **kwargs))
+
+        objective, labels = self._restart(
+            distance_matrix=distance_matrix,
+            num_groups=num_groups,
+            rng=np.random.default_rng(seed),
+            report=report if record else None,
+            deadline=deadline,
+            strata=strata,
+        )
+        return objective, labels, iterations
+
+    @abstractmethod
+    def _restart(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        report: Optional[Callable[..., None]] = None,
+        deadline: Optional[float] = None,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> Tuple[float, npt.NDArray[int]]:
+        # pylint: disable = R0913
         """
-        Calculate objective value
-        :param cluster_assignment: Cluster assignment
-        :param distance_matrix: Distance matrix
-        :return: Objective value
+        Run a single restart of the heuristic, from random initialization to final solution.
+        :param distance_matrix: The distance matrix of elements.
+        :param num_groups: Number of anti-clusters to generate.
+        :param rng: Random generator of the restart.
+        :param report: If given, called after each iteration with the fields of IterationInfo other than restart as
+        keyword arguments. Not given when there are no callbacks, so progress costs nothing to track.
+        :param deadline: Time at which to stop, as returned by get_deadline, or None.
+        :param strata: Optional stratum of each element. Swaps must be within strata.
+        :return: The objective value and labels of the best solution found.
         """
-        return np.multiply(cluster_assignment, distance_matrix).sum()
@@ -0,0 +1,419 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Blockwise construction of distance matrices.
+
+The distance matrix is preallocated once and filled one block of rows at a time. Each block is computed in double
+precision, directly in the distance matrix if it is double precision, and in a scratch buffer per thread otherwise.
+Categorical mismatches are added to that block in place where a reusable block of booleans marks differing codes, so
+each thread needs at most one block of double precision and one block of booleans. Blocks are independent, so they can
+be computed in parallel threads.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Tuple, Union
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse
+from scipy.spatial.distance import cdist
+from sklearn.neighbors import NearestNeighbors
+
+# Scratch memory used for computing blocks when no block size is given, shared between all workers.
+DEFAULT_SCRATCH_BYTES = 64 * 2**20
+# Scratch memory per element of a block: the block in double precision, a comparison, and the neighbour indices from
+# partitioning the block when building a neighbour graph.
+_SCRATCH_BYTES_PER_ELEMENT = np.dtype(np.float64).itemsize + np.dtype(bool).itemsize + np.dtype(np.intp).itemsize
+
+METRICS = ("euclidean", "cosine", "gower")
+# Metrics used for numerical features in blocks, after features are weighted.
+_CDIST_METRICS = {"euclidean": "euclidean", "gower": "cityblock"}
+# The same metrics in scikit-learn, used for finding nearest neighbours with trees.
+_TREE_METRICS = {"euclidean": "euclidean", "cityblock": "manhattan"}
+
+
+def get_block_size(num_elements: int, n_jobs: int, block_size: Optional[int] = None) -> int:
+    """
+    Get the number of rows to compute at a time.
+    :param num_elements: Number of elements, i.e. the number of columns in each block.
+    :param n_jobs: Number of workers computing blocks concurrently.
+    :param block_size: Requested number of rows per block. If None, it is derived from DEFAULT_SCRATCH_BYTES.
+    :return: The block size.
+    """
+    if block_size is not None:
+        if block_size < 1:
+            raise ValueError("Block size must be positive.")
+        return block_size
+
+    row_bytes = max(1, num_elements) * _SCRATCH_BYTES_PER_ELEMENT
+    return max(1, DEFAULT_SCRATCH_BYTES // (row_bytes * n_jobs))
+
+
+def stack_codes(codes: Sequence[npt.NDArray[int]]) -> npt.NDArray[int]:
+    """
+    Stack integer codes of categorical columns into a matrix, using the smallest signed integer type that holds all
+    codes. The matrix is stored column by column, so the codes of each column are contiguous in memory.
+    :param codes: Integer codes of each column, e.g. from pd.factorize. Missing values may be coded as -1.
+    :return: Matrix with a column per categorical column.
+    """
+    # The smallest type holding minus the largest code is signed and holds all codes, including -1.
+    dtype = np.min_scalar_type(-max(int(column.max(initial=0)) for column in codes) - 1)
+    stacked = np.empty((len(codes[0]), len(codes)), dtype=dtype, order="F")
+    for index, column in enumerate(codes):
+        stacked[:, index] = column
+    return stacked
+
+
+def build_distance_matrix(
+    numerical_data: Optional[npt.NDArray[float]],
+    categorical_data: Optional[npt.NDArray[int]],
+    num_elements: int,
+    dtype: npt.DTypeLike,
+    block_size: int,
+    n_jobs: int,
+    metric: str = "euclidean",
+    numerical_weights: Optional[npt.NDArray[float]] = None,
+    categorical_weights: Optional[npt.NDArray[float]] = None,
+) -> npt.NDArray[float]:
+    # pylint: disable = R0913, R0914
+    """
+    Build the distance matrix between elements. Depending on the metric, the distance is:
+    * "euclidean": The Euclidean distance between numerical features plus the Hamming distance between categorical
+      features.
+    * "cosine": The cosine distance between numerical features plus the Hamming distance between categorical features.
+      Elements with all numerical features 0 have cosine distance 1 to all other elements.
+    * "gower": The Gower distance, i.e. the mean over all features of the absolute difference between numerical
+      features and the mismatch between categorical features. Numerical features should be scaled to [0, 1].
+    Weights multiply the squared differences of the Euclidean and cosine distances and the terms of the Gower distance.
+    The Hamming distance is the weighted fraction of mismatching categorical features.
+    :param numerical_data: Matrix of numerical features, or None.
+    :param categorical_data: Matrix of integer encoded categorical features, or None. Preferably from stack_codes.
+    :param num_elements: Number of elements.
+    :param dtype: Data type of the distance matrix.
+    :param block_size: Number of rows to compute at a time.
+    :param n_jobs: Number of threads computing blocks.
+    :param metric: The metric, "euclidean", "cosine" or "gower".
+    :param numerical_weights: Non-negative weight of each numerical feature. Defaults to 1 for all features.
+    :param categorical_weights: Non-negative weight of each categorical feature. Defaults to 1 for all features.
+    :return: The distance matrix.
+    """
+    numerical_data, numerical_scale, categorical_scale = weight_features(
+        numerical_data=numerical_data,
+        categorical_data=categorical_data,
+        metric=metric,
+        numerical_weights=numerical_weights,
+        categorical_weights=categorical_weights,
+    )
+
+    distance_matrix = np.empty((num_elements, num_elements), dtype=dtype)
+    # Scratch buffers of each thread, reused for its blocks: a double precision block if the distance matrix is lower
+    # precision, and a block of comparisons if there are categorical features.
+    buffers = threading.local()
+
+    def fill_block(start: int) -> None:
+        block = distance_matrix[start : start + block_size]
+        shape = (min(block_size, num_elements), num_elements)
+        scratch = comparison = None
+        if block.dtype != np.float64:
+            if not hasattr(buffers, "scratch"):
+                buffers.scratch = np.empty(shape)
+            scratch = buffers.scratch[: len(block)]
+        if categorical_data is not None:
+            if not hasattr(buffers, "comparison"):
+                buffers.comparison = np.empty(shape, dtype=bool)
+            comparison = buffers.comparison[: len(block)]
+        _fill_block(
+            block=block,
+            numerical_data=numerical_data,
+            categorical_data=categorical_data,
+            start=start,
+            metric=metric,
+            categorical_weights=categorical_weights,
+            numerical_scale=numerical_scale,
+            categorical_scale=categorical_scale,
+            scratch=scratch,
+            comparison=comparison,
+        )
+
+    starts = range(0, num_elements, block_size)
+    if n_jobs > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            # Consume results to propagate exceptions
+            list(executor.map(fill_block, starts))
+    else:
+        for start in starts:
+            fill_block(start)
+
+    return distance_matrix
+
+
+def build_neighbour_graph(
+    numerical_data: Optional[npt.NDArray[float]],
+    categorical_data: Optional[npt.NDArray[int]],
+    num_elements: int,
+    num_neighbours: int,
+    dtype: npt.DTypeLike,
+    block_size: int,
+    n_jobs: int,
+    metric: str = "euclidean",
+    numerical_weights: Optional[npt.NDArray[float]] = None,
+    categorical_weights: Optional[npt.NDArray[float]] = None,
+) -> scipy.sparse.csr_matrix:
+    # pylint: disable = R0913, R0914
+    """
+    Build a sparse approximation of the distance matrix from the nearest neighbours of each element, using the metrics
+    of build_distance_matrix. Pairs of elements that are not neighbours are taken to be as far apart as the farthest
+    neighbours. The matrix stores the distance between neighbours minus that largest distance, which is zero for all
+    other pairs. With balanced anti-clusters, subtracting the same distance from all pairs does not change which
+    solution is best, so anti-clustering with this matrix keeps near neighbours apart, in O(N * num_neighbours) memory.
+
+    Neighbours are found with a KD-tree or ball tree if there are only numerical features and the metric is not cosine,
+    and by brute force in blocks of rows otherwise.
+    :param numerical_data: Matrix of numerical features, or None.
+    :param categorical_data: Matrix of integer encoded categorical features, or None. Preferably from stack_codes.
+    :param num_elements: Number of elements.
+    :param num_neighbours: Number of nearest neighbours of each element.
+    :param dtype: Data type of the matrix.
+    :param block_size: Number of rows to compute at a time with brute force.
+    :param n_jobs: Number of threads.
+    :param metric: The metric, "euclidean", "cosine" or "gower".
+    :param numerical_weights: Non-negative weight of each numerical feature. Defaults to 1 for all features.
+    :param categorical_weights: Non-negative weight of each categorical feature. Defaults to 1 for all features.
+    :return: Symmetric sparse matrix, with an entry for each element and each of its neighbours.
+    """
+    if num_neighbours < 1:
+        raise ValueError(f"num_neighbours must be at least 1, got {num_neighbours}.")
+    numerical_data, numerical_scale, categorical_scale = weight_features(
+        numerical_data=numerical_data,
+        categorical_data=categorical_data,
+        metric=metric,
+        numerical_weights=numerical_weights,
+        categorical_weights=categorical_weights,
+    )
+    num_neighbours = min(num_neighbours, num_elements - 1)
+
+    if num_neighbours < 1:
+        distances = np.zeros((num_elements, 0))
+        neighbours = np.zeros((num_elements, 0), dtype=np.intp)
+    elif categorical_data is None and numerical_data is not None and metric in _CDIST_METRICS:
+        nearest_neighbours = NearestNeighbors(
+            n_neighbors=num_neighbours, metric=_TREE_METRICS[_CDIST_METRICS[metric]], n_jobs=n_jobs
+        )
+        distances, neighbours = nearest_neighbours.fit(numerical_data).kneighbors()
+        distances *= numerical_scale
+    else:
+        distances = np.empty((num_elements, num_neighbours))
+        neighbours = np.empty((num_elements, num_neighbours), dtype=np.intp)
+
+        def fill_block(start: int) -> None:
+            end = min(start + block_size, num_elements)
+            block = np.empty((end - start, num_elements))
+            _fill_block(
+                block=block,
+                numerical_data=numerical_data,
+                categorical_data=categorical_data,
+                start=start,
+                metric=metric,
+                categorical_weights=categorical_weights,
+                numerical_scale=numerical_scale,
+                categorical_scale=categorical_scale,
+            )
+            # Elements are not their own neighbours
+            block[np.arange(end - start), np.arange(start, end)] = np.inf
+            neighbours[start:end] = np.argpartition(block, num_neighbours - 1, axis=1)[:, :num_neighbours]
+            distances[start:end] = np.take_along_axis(block, neighbours[start:end], axis=1)
+
+        starts = range(0, num_elements, block_size)
+        if n_jobs > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                # Consume results to propagate exceptions
+                list(executor.map(fill_block, starts))
+        else:
+            for start in starts:
+                fill_block(start)
+
+    # How much closer neighbours are than the farthest neighbours, made symmetric by taking each neighbour pair once.
+    closeness = distances.max(initial=0.0) - distances
+    rows = np.repeat(np.arange(num_elements), neighbours.shape[1])
+    graph = scipy.sparse.csr_matrix(
+        (closeness.ravel(), (rows, neighbours.ravel())), shape=(num_elements, num_elements), dtype=np.float64
+    )
+    graph = graph.maximum(graph.T).tocsr()
+    graph.eliminate_zeros()
+    graph.sort_indices()
+    return (-graph).astype(dtype)
+
+
+def check_distance_matrix(
+    distance_matrix: Union[npt.NDArray[float], scipy.sparse.csr_matrix], num_elements: int
+) -> None:
+    """
+    Check that a distance matrix is square, matches the number of elements, is symmetric and has a zero diagonal. Dense
+    matrices are compared with their transpose one block of rows at a time, so no copy of the matrix is made.
+    :param distance_matrix: Dense or sparse distance matrix.
+    :param num_elements: Number of elements.
+    :return:
+    """
+    if distance_matrix.shape != (num_elements, num_elements):
+        raise ValueError(f"Distance matrix of shape {distance_matrix.shape} does not match {num_elements} elements.")
+
+    if not np.allclose(distance_matrix.diagonal(), 0.0):
+        raise ValueError("Distance matrix must have a zero diagonal.")
+
+    if scipy.sparse.issparse(distance_matrix):
+        symmetric = num_elements == 0 or np.allclose(abs(distance_matrix - distance_matrix.T).max(), 0.0)
+    else:
+        block_size = get_block_size(num_elements=num_elements, n_jobs=1)
+        symmetric = all(
+            np.allclose(distance_matrix[start : start + block_size], distance_matrix[:, start : start + block_size].T)
+            for start in range(0, num_elements, block_size)
+        )
+    if not symmetric:
+        raise ValueError("Distance matrix must be symmetric.")
+
+
+def weight_features(
+    numerical_data: Optional[npt.NDArray[float]],
+    categorical_data: Optional[npt.NDArray[int]],
+    metric: str,
+    numerical_weights: Optional[npt.NDArray[float]],
+    categorical_weights: Optional[npt.NDArray[float]],
+) -> Tuple[Optional[npt.NDArray[float]], float, float]:
+    """
+    Check the metric and weights, and weight the numerical features once up front, such that blocks are computed with
+    unweighted metrics.
+    :param numerical_data: Matrix of numerical features, or None.
+    :param categorical_data: Matrix of integer encoded categorical features, or None.
+    :param metric: The metric, "euclidean", "cosine" or "gower".
+    :param numerical_weights: Non-negative weight of each numerical feature, or None.
+    :param categorical_weights: Non-negative weight of each categorical feature, or None.
+    :return: The weighted numerical features, normalized to unit length for cosine distance, and the factors applied
+    to the unweighted numerical distance and to the weighted number of mismatching categorical features.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}. Must be one of {METRICS}.")
+    for weights in (numerical_weights, categorical_weights):
+        if weights is not None and (np.asarray(weights) < 0).any():
+            raise ValueError("Weights must be non-negative.")
+
+    numerical_weight = 0.0
+    if numerical_data is not None:
+        weights = np.ones(numerical_data.shape[1]) if numerical_weights is None else np.asarray(numerical_weights)
+        numerical_weight = float(weights.sum())
+        numerical_data = numerical_data * (weights if metric == "gower" else np.sqrt(weights))
+        if metric == "cosine":
+            norms = np.linalg.norm(numerical_data, axis=1, keepdims=True)
+            numerical_data = numerical_data / np.where(norms > 0, norms, 1.0)
+
+    categorical_weight = 0.0
+    if categorical_data is not None:
+        categorical_weight = (
+            categorical_data.shape[1] if categorical_weights is None else float(np.sum(categorical_weights))
+        )
+
+    if metric == "gower":
+        numerical_scale = categorical_scale = _reciprocal(numerical_weight + categorical_weight)
+    else:
+        numerical_scale, categorical_scale = 1.0, _reciprocal(categorical_weight)
+    return numerical_data, numerical_scale, categorical_scale
+
+
+def _reciprocal(weight: float) -> float:
+    """
+    Get the reciprocal of a total weight.
+    :param weight: The total weight.
+    :return: 1 / weight, or 0 if the weight is 0.
+    """
+    return 1.0 / weight if weight > 0 else 0.0
+
+
+def _add_mismatches(
+    target: npt.NDArray[float],
+    categorical_data: npt.NDArray[int],
+    start: int,
+    categorical_weights: Optional[npt.NDArray[float]],
+    categorical_scale: float,
+    comparison: Optional[npt.NDArray[bool]] = None,
+) -> None:
+    # pylint: disable = R0913
+    """
+    Add the scaled, weighted number of mismatching categorical features between a block of rows and all rows to a
+    block, in place. Mismatches are compared one column at a time and added where the codes differ.
+    :param target: The double precision block to add to.
+    :param categorical_data: Matrix of integer encoded categorical features.
+    :param start: Index of the first row in the block.
+    :param categorical_weights: Weight of each categorical feature, or None for equal weights.
+    :param categorical_scale: Factor applied to the weighted number of mismatches.
+    :param comparison: Boolean buffer with the shape of the block for the comparisons. Allocated if None.
+    :return:
+    """
+    end = start + len(target)
+    comparison = np.empty(target.shape, dtype=bool) if comparison is None else comparison
+    for column in range(categorical_data.shape[1]):
+        codes = categorical_data[:, column]
+        weight = 1.0 if categorical_weights is None else categorical_weights[column]
+        np.not_equal(codes[start:end, None], codes[None, :], out=comparison)
+        np.add(target, weight * categorical_scale, out=target, where=comparison)
+
+
+def _fill_block(
+    block: npt.NDArray[float],
+    numerical_data: Optional[npt.NDArray[float]],
+    categorical_data: Optional[npt.NDArray[int]],
+    start: int,
+    metric: str,
+    categorical_weights: Optional[npt.NDArray[float]],
+    numerical_scale: float,
+    categorical_scale: float,
+    scratch: Optional[npt.NDArray[float]] = None,
+    comparison: Optional[npt.NDArray[bool]] = None,
+) -> None:
+    # pylint: disable = R0913
+    """
+    Fill a block of rows of the distance matrix in place.
+    :param block: The block of the distance matrix to fill.
+    :param numerical_data: Matrix of weighted numerical features, or None. Normalized to unit length for cosine distance.
+    :param categorical_data: Matrix of integer encoded categorical features, or None.
+    :param start: Index of the first row in the block.
+    :param metric: The metric, "euclidean", "cosine" or "gower".
+    :param categorical_weights: Weight of each categorical feature, or None for equal weights.
+    :param numerical_scale: Factor applied to the numerical distance.
+    :param categorical_scale: Factor applied to the weighted number of mismatching categorical features.
+    :param scratch: Double precision buffer with the shape of the block, used if the block is lower precision. Allocated
+    if None.
+    :param comparison: Boolean buffer with the shape of the block for comparing categorical features. Allocated if None.
+    :return:
+    """
+    # Computed in double precision, directly in the block if possible.
+    target = block
+    if block.dtype != np.float64:
+        target = np.empty(block.shape) if scratch is None else scratch
+
+    if numerical_data is None:
+        target[...] = 0.0
+    elif metric == "cosine":
+        # Features are normalized, so the cosine distance is one minus the dot product.
+        np.matmul(numerical_data[start : start + len(block)], numerical_data.T, out=target)
+        np.subtract(1.0, target, out=target)
+        np.maximum(target, 0.0, out=target)
+        target[np.arange(len(target)), np.arange(start, start + len(block))] = 0.0
+    else:
+        cdist(numerical_data[start : start + len(block)], numerical_data, metric=_CDIST_METRICS[metric], out=target)
+
+    if numerical_scale != 1.0:
+        target *= numerical_scale
+    if categorical_data is not None:
+        _add_mismatches(target, categorical_data, start, categorical_weights, categorical_scale, comparison)
+    if target is not block:
+        block[...] = target
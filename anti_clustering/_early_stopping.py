@@ -0,0 +1,84 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Stopping criteria for heuristics: a deadline and stagnation of the objective value.
+"""
+
+import time
+from typing import Optional
+
+
+def get_deadline(time_limit: Optional[float]) -> Optional[float]:
+    """
+    Get the time at which a time limit starting now is reached. Wall-clock time is used, as it is comparable between
+    worker processes.
+    :param time_limit: The time limit in seconds, or None.
+    :return: The deadline, or None without time limit.
+    """
+    return None if time_limit is None else time.time() + time_limit
+
+
+def is_past(deadline: Optional[float]) -> bool:
+    """
+    Check if a deadline has passed.
+    :param deadline: The deadline as returned by get_deadline, or None.
+    :return: Whether the deadline has passed.
+    """
+    return deadline is not None and time.time() >= deadline
+
+
+class EarlyStopping:
+    """
+    Tracks whether a search should stop, because a deadline has passed or because the objective value has not improved
+    by more than a relative tolerance for a number of consecutive iterations. Improvements are measured against the
+    objective value at the last counted improvement, so many small improvements count once they add up.
+    """
+
+    __slots__ = ("stagnation_limit", "tolerance", "deadline", "reference", "stagnation")
+
+    def __init__(
+        self, stagnation_limit: Optional[int], tolerance: float, deadline: Optional[float], objective: float
+    ) -> None:
+        """
+        Initialize stopping criteria.
+        :param stagnation_limit: Number of consecutive iterations without improvement to stop after, or None.
+        :param tolerance: Relative improvement of the objective value below which an iteration is not an improvement.
+        :param deadline: The deadline as returned by get_deadline, or None.
+        :param objective: The initial objective value. May be -inf.
+        """
+        self.stagnation_limit = stagnation_limit
+        self.tolerance = tolerance
+        self.deadline = deadline
+        self.reference = objective
+        self.stagnation = 0
+
+    def update(self, objective: float, iterations: int = 1) -> bool:
+        """
+        Update with the best objective value after some iterations.
+        :param objective: The best objective value found so far.
+        :param iterations: Number of iterations since the last update.
+        :return: Whether the search should stop.
+        """
+        reference = self.reference
+        if objective > reference and (
+            reference == -float("inf") or objective - reference > self.tolerance * abs(reference)
+        ):
+            self.reference = objective
+            self.stagnation = 0
+        else:
+            self.stagnation += iterations
+
+        return (self.stagnation_limit is not None and self.stagnation >= self.stagnation_limit) or is_past(
+            self.deadline
+        )
@@ -0,0 +1,612 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compiled inner loops of the exchange, simulated annealing and tabu search heuristics, used when Numba is installed.
+
+The kernels run on the arrays of a ClusterState in place, and perform the same floating point operations in the same
+order as the pure Python implementations, so both give identical results. Random numbers are drawn by the heuristics
+beforehand. Kernels run a chunk of iterations at a time, such that time limits are checked between chunks.
+"""
+
+import math
+from typing import Optional, Tuple, Union
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse
+from anti_clustering._cluster_state import ClusterState
+from anti_clustering._early_stopping import EarlyStopping, is_past
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ("auto", "python", "numba")
+
+# Number of iterations run by a kernel between checks of the time limit.
+_CHUNK_SIZE = 1024
+
+
+def check_backend(backend: str) -> None:
+    """
+    Check that a backend is known and available.
+    :param backend: "auto" to use Numba if installed, "python" or "numba".
+    :return:
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}. Must be one of {BACKENDS}.")
+    if backend == "numba" and numba is None:
+        raise ImportError("The numba backend requires Numba to be installed.")
+
+
+def use_numba(backend: str, distance_matrix: Union[npt.NDArray[float], scipy.sparse.csr_matrix]) -> bool:
+    """
+    Check whether the compiled kernels are used for a backend. Kernels require a dense distance matrix.
+    :param backend: A backend accepted by check_backend.
+    :param distance_matrix: The distance matrix of elements.
+    :return: Whether to use the compiled kernels.
+    """
+    return numba is not None and backend != "python" and not scipy.sparse.issparse(distance_matrix)
+
+
+def _jit(function):
+    """
+    Compile a function in nopython mode if Numba is installed.
+    :param function: The function.
+    :return: The compiled function, or the function itself without Numba.
+    """
+    return function if numba is None else numba.njit(cache=True)(function)
+
+
+@_jit
+def _swap_delta(distance_matrix, labels, distance_to_group, i, j):
+    # Same as ClusterState.swap_delta
+    group_i, group_j = labels[i], labels[j]
+    return 2.0 * (
+        distance_to_group[group_j, i]
+        - distance_to_group[group_i, i]
+        + distance_to_group[group_i, j]
+        - distance_to_group[group_j, j]
+        - 2.0 * np.float64(distance_matrix[i, j])
+    )
+
+
+@_jit
+def _swap_deltas(distance_matrix, labels, strata, distance_to_group, i, deltas):
+    # pylint: disable = C0200
+    # Same as ClusterState.swap_deltas, written to deltas
+    group_i = labels[i]
+    for k in range(len(labels)):
+        if labels[k] == group_i or strata[k] != strata[i]:
+            deltas[k] = -np.inf
+        else:
+            delta = distance_to_group[labels[k], i] - distance_to_group[group_i, i]
+            delta += distance_to_group[group_i, k]
+            delta -= distance_to_group[labels[k], k]
+            delta -= 2.0 * np.float64(distance_matrix[i, k])
+            deltas[k] = delta * 2.0
+
+
+@_jit
+def _swap(distance_matrix, labels, members, position, distance_to_group, i, j):
+    # Same as ClusterState.swap, apart from the objective value
+    group_i, group_j = labels[i], labels[j]
+    for k in range(len(labels)):
+        row_i, row_j = np.float64(distance_matrix[i, k]), np.float64(distance_matrix[j, k])
+        distance_to_group[group_i, k] = distance_to_group[group_i, k] + row_j - row_i
+        distance_to_group[group_j, k] = distance_to_group[group_j, k] + row_i - row_j
+    position_i, position_j = position[i], position[j]
+    members[position_i], members[position_j] = j, i
+    position[i], position[j] = position_j, position_i
+    labels[i], labels[j] = group_j, group_i
+
+
+@_jit
+def _exchange(labels, strata, members, offsets, num_groups, i, exchange):
+    # pylint: disable = R0913
+    # Same as ClusterState.exchange, selecting the possible swap by a uniform random number in [0, 1)
+    stratum_cell = strata[i] * num_groups
+    cell = stratum_cell + labels[i]
+    stratum_start, cell_start, cell_end = offsets[stratum_cell], offsets[cell], offsets[cell + 1]
+    num_exchanges = offsets[stratum_cell + num_groups] - stratum_start - (cell_end - cell_start)
+    if num_exchanges == 0:
+        return -1
+    k = int(exchange * num_exchanges) + stratum_start
+    if k >= cell_start:
+        k += cell_end - cell_start
+    return members[k]
+
+
+@_jit
+def _is_tabu(labels, tabu_until, num_accepted, i, j):
+    # Whether swapping elements i and j moves either of them to an anti-cluster it may not move to yet
+    return tabu_until[labels[j], i] > num_accepted or tabu_until[labels[i], j] > num_accepted
+
+
+@_jit
+def _admissible_exchange(labels, strata, members, offsets, num_groups, tabu_until, num_accepted, i, exchange):
+    # pylint: disable = R0913
+    # Same as TabuSearchHeuristicAntiClustering._select_move, selecting one of the possible swaps that are not tabu by a
+    # uniform random number in [0, 1)
+    stratum_cell = strata[i] * num_groups
+    cell = stratum_cell + labels[i]
+    stratum_start, cell_start, cell_end = offsets[stratum_cell], offsets[cell], offsets[cell + 1]
+    stratum_end = offsets[stratum_cell + num_groups]
+    num_possible = 0
+    for k in range(stratum_start, stratum_end):
+        if not cell_start <= k < cell_end and not _is_tabu(labels, tabu_until, num_accepted, i, members[k]):
+            num_possible += 1
+    if num_possible == 0:
+        return -1
+    target = int(exchange * num_possible)
+    for k in range(stratum_start, stratum_end):
+        if not cell_start <= k < cell_end and not _is_tabu(labels, tabu_until, num_accepted, i, members[k]):
+            if target == 0:
+                return members[k]
+            target -= 1
+    return -1
+
+
+@_jit
+def _find_swap(deltas, min_improvement, first_improvement, choice):
+    # pylint: disable = C0200
+    # Same as ExchangeHeuristicAntiClustering._find_swap, given the swap deltas
+    j = int(np.argmax(deltas))
+    if first_improvement and deltas[j] > min_improvement:
+        num_improving = 0
+        for k in range(len(deltas)):
+            if deltas[k] > min_improvement:
+                num_improving += 1
+        selected = int(choice * num_improving)
+        for k in range(len(deltas)):
+            if deltas[k] > min_improvement:
+                if selected == 0:
+                    return k
+                selected -= 1
+    return j
+
+
+@_jit
+def _stagnates(objective, reference, stagnation, stagnation_limit, tolerance):
+    # Same as EarlyStopping.update for one iteration, apart from the deadline. A stagnation limit of 0 is no limit.
+    if objective > reference and (reference == -np.inf or objective - reference > tolerance * abs(reference)):
+        reference = objective
+        stagnation = 0
+    else:
+        stagnation += 1
+    return reference, stagnation, 0 < stagnation_limit <= stagnation
+
+
+@_jit
+def _simulated_annealing_kernel(
+    distance_matrix,
+    labels,
+    strata,
+    members,
+    position,
+    offsets,
+    distance_to_group,
+    elements,
+    exchanges,
+    thresholds,
+    start,
+    objective,
+    best_objective,
+    best_labels,
+    kept,
+    temperature,
+    alpha,
+    reference,
+    stagnation,
+    stagnation_limit,
+    tolerance,
+):
+    # pylint: disable = R0913
+    # Same as SimulatedAnnealingHeuristicAntiClustering._restart, from iteration start for a chunk of iterations.
+    # best_labels holds the best solution if kept, otherwise it is the current solution.
+    stop = False
+    end = min(start + _CHUNK_SIZE, len(elements))
+    for iteration in range(start, end):
+        i = elements[iteration]
+        j = _exchange(labels, strata, members, offsets, len(distance_to_group), i, exchanges[iteration])
+        if j < 0:
+            continue
+        delta = _swap_delta(distance_matrix, labels, distance_to_group, i, j)
+        if delta >= 0 or (temperature > 0 and math.exp(delta / temperature) >= thresholds[iteration]):
+            if delta < 0 and not kept:
+                best_labels[:] = labels
+                kept = True
+            _swap(distance_matrix, labels, members, position, distance_to_group, i, j)
+            objective += delta
+        if objective > best_objective:
+            best_objective, kept = objective, False
+        temperature = temperature * alpha
+        reference, stagnation, stop = _stagnates(best_objective, reference, stagnation, stagnation_limit, tolerance)
+        if stop:
+            end = iteration + 1
+            break
+    return end, stop, objective, best_objective, kept, temperature, reference, stagnation
+
+
+@_jit
+def _tabu_search_kernel(
+    distance_matrix,
+    labels,
+    strata,
+    members,
+    position,
+    offsets,
+    distance_to_group,
+    elements,
+    exchanges,
+    start,
+    objective,
+    best_objective,
+    best_labels,
+    tabu_until,
+    tabu_tenure,
+    num_accepted,
+    best_move,
+    reference,
+    stagnation,
+    stagnation_limit,
+    tolerance,
+):
+    # pylint: disable = R0913, C0200
+    # Same as TabuSearchHeuristicAntiClustering._restart, from iteration start for a chunk of iterations
+    deltas = np.empty(len(labels))
+    stop = False
+    end = min(start + _CHUNK_SIZE, len(elements))
+    for iteration in range(start, end):
+        i = elements[iteration]
+        j = -1
+        best_delta = -np.inf
+        if best_move:
+            # Same as TabuSearchHeuristicAntiClustering._select_move
+            _swap_deltas(distance_matrix, labels, strata, distance_to_group, i, deltas)
+            aspiration = best_objective - objective
+            for k in range(len(labels)):
+                tabu = _is_tabu(labels, tabu_until, num_accepted, i, k)
+                if not (tabu and deltas[k] <= aspiration) and deltas[k] > best_delta:
+                    j, best_delta = k, deltas[k]
+        else:
+            k = _admissible_exchange(
+                labels,
+                strata,
+                members,
+                offsets,
+                len(distance_to_group),
+                tabu_until,
+                num_accepted,
+                i,
+                exchanges[iteration],
+            )
+            if k >= 0:
+                delta = _swap_delta(distance_matrix, labels, distance_to_group, i, k)
+                if delta > 0:
+                    j, best_delta = k, delta
+        if j >= 0:
+            num_accepted += 1
+            tabu_until[labels[i], i] = num_accepted + tabu_tenure
+            tabu_until[labels[j], j] = num_accepted + tabu_tenure
+            _swap(distance_matrix, labels, members, position, distance_to_group, i, j)
+            objective += best_delta
+        if objective > best_objective:
+            best_objective = objective
+            if best_move:
+                best_labels[:] = labels
+        reference, stagnation, stop = _stagnates(best_objective, reference, stagnation, stagnation_limit, tolerance)
+        if stop:
+            end = iteration + 1
+            break
+    return end, stop, objective, best_objective, num_accepted, reference, stagnation
+
+
+@_jit
+def _exchange_kernel(
+    distance_matrix,
+    labels,
+    strata,
+    members,
+    position,
+    distance_to_group,
+    active,
+    choices,
+    start,
+    objective,
+    first_improvement,
+    min_relative_improvement,
+    dont_look,
+    margin,
+    track_dont_look,
+    reference,
+    stagnation,
+    stagnation_limit,
+    tolerance,
+):
+    # pylint: disable = R0913, C0200
+    # Same as a pass of ExchangeHeuristicAntiClustering._restart over active elements, from active[start] for a chunk
+    deltas = np.empty(len(labels))
+    improved = False
+    stop = False
+    end = min(start + _CHUNK_SIZE, len(active))
+    for position_in_active in range(start, end):
+        i = active[position_in_active]
+        min_improvement = min_relative_improvement * abs(objective)
+        _swap_deltas(distance_matrix, labels, strata, distance_to_group, i, deltas)
+        j = _find_swap(deltas, min_improvement, first_improvement, choices[position_in_active])
+        delta = deltas[j]
+
+        if delta > min_improvement:
+            if track_dont_look:
+                # Same as ExchangeHeuristicAntiClustering._update_dont_look_bits
+                for k in range(len(labels)):
+                    change = abs(np.float64(distance_matrix[i, k]) - np.float64(distance_matrix[j, k]))
+                    in_swapped_groups = labels[k] == labels[i] or labels[k] == labels[j]
+                    margin[k] -= (4.0 if in_swapped_groups else 2.0) * change
+                    if margin[k] < 0:
+                        dont_look[k] = False
+                dont_look[i] = False
+                dont_look[j] = False
+            _swap(distance_matrix, labels, members, position, distance_to_group, i, j)
+            objective += delta
+            improved = True
+        else:
+            dont_look[i] = True
+            margin[i] = min_improvement - delta
+        reference, stagnation, stop = _stagnates(objective, reference, stagnation, stagnation_limit, tolerance)
+        if stop:
+            end = position_in_active + 1
+            break
+    return end, stop, objective, improved, reference, stagnation
+
+
+def _stagnation_limit(early_stopping: EarlyStopping) -> int:
+    """
+    Get the stagnation limit of early stopping as passed to the kernels.
+    :param early_stopping: Stopping criteria.
+    :return: The stagnation limit, or 0 without limit.
+    """
+    return 0 if early_stopping.stagnation_limit is None else early_stopping.stagnation_limit
+
+
+def run_simulated_annealing(
+    cluster_state: ClusterState,
+    distance_matrix: npt.NDArray[float],
+    elements: npt.NDArray[int],
+    exchanges: npt.NDArray[float],
+    thresholds: npt.NDArray[float],
+    temperature: float,
+    alpha: float,
+    early_stopping: EarlyStopping,
+) -> Tuple[float, Optional[npt.NDArray[int]]]:
+    # pylint: disable = R0913, W0212
+    """
+    Run the iterations of a restart of simulated annealing, updating the solution in place.
+    :param cluster_state: The initial solution.
+    :param distance_matrix: The distance matrix of elements.
+    :param elements: The random element of each iteration.
+    :param exchanges: Uniformly distributed random number in [0, 1) selecting the possible swap of each iteration.
+    :param thresholds: Uniformly distributed random number in [0, 1) for the acceptance of each iteration.
+    :param temperature: The starting temperature.
+    :param alpha: The cooling factor.
+    :param early_stopping: Stopping criteria, updated in place.
+    :return: The objective value of the best solution visited, and its labels, or None if it is the current solution.
+    """
+    best_labels = np.empty_like(cluster_state.labels)
+    objective = best_objective = cluster_state.objective
+    kept = False
+    start = 0
+    while start < len(elements):
+        start, stop, objective, best_objective, kept, temperature, reference, stagnation = _simulated_annealing_kernel(
+            np.asarray(distance_matrix),
+            cluster_state.labels,
+            cluster_state.strata,
+            cluster_state._members,
+            cluster_state._position,
+            cluster_state._offsets,
+            cluster_state._distance_to_group,
+            elements,
+            exchanges,
+            thresholds,
+            start,
+            objective,
+            best_objective,
+            best_labels,
+            kept,
+            float(temperature),
+            float(alpha),
+            early_stopping.reference,
+            early_stopping.stagnation,
+            _stagnation_limit(early_stopping),
+            early_stopping.tolerance,
+        )
+        early_stopping.reference, early_stopping.stagnation = reference, stagnation
+        if stop or is_past(early_stopping.deadline):
+            break
+    cluster_state.objective = objective
+    return best_objective, (best_labels if kept else None)
+
+
+def run_tabu_search(
+    cluster_state: ClusterState,
+    distance_matrix: npt.NDArray[float],
+    elements: npt.NDArray[int],
+    exchanges: npt.NDArray[float],
+    best_labels: npt.NDArray[int],
+    tabu_until: npt.NDArray[int],
+    tabu_tenure: int,
+    best_move: bool,
+    early_stopping: EarlyStopping,
+) -> float:
+    # pylint: disable = R0913, W0212
+    """
+    Run the iterations of a restart of tabu search, updating the solution in place.
+    :param cluster_state: The initial solution.
+    :param distance_matrix: The distance matrix of elements.
+    :param elements: The random element of each iteration.
+    :param exchanges: Uniformly distributed random number in [0, 1) selecting the possible swap of each iteration.
+    :param best_labels: Labels of the best solution found, updated in place with best move selection.
+    :param tabu_until: Number of accepted swaps from which each element may move to each anti-cluster, updated in
+    place.
+    :param tabu_tenure: Number of accepted swaps a move is tabu.
+    :param best_move: Whether the best move selection is used, otherwise the random move selection.
+    :param early_stopping: Stopping criteria, updated in place.
+    :return: The objective value of the best solution found.
+    """
+    objective = best_objective = cluster_state.objective
+    start = num_accepted = 0
+    while start < len(elements):
+        start, stop, objective, best_objective, num_accepted, reference, stagnation = _tabu_search_kernel(
+            np.asarray(distance_matrix),
+            cluster_state.labels,
+            cluster_state.strata,
+            cluster_state._members,
+            cluster_state._position,
+            cluster_state._offsets,
+            cluster_state._distance_to_group,
+            elements,
+            exchanges,
+            start,
+            objective,
+            best_objective,
+            best_labels,
+            tabu_until,
+            tabu_tenure,
+            num_accepted,
+            best_move,
+            early_stopping.reference,
+            early_stopping.stagnation,
+            _stagnation_limit(early_stopping),
+            early_stopping.tolerance,
+        )
+        early_stopping.reference, early_stopping.stagnation = reference, stagnation
+        if stop or is_past(early_stopping.deadline):
+            break
+    cluster_state.objective = objective
+    return best_objective
+
+
+def run_exchange_pass(
+    cluster_state: ClusterState,
+    distance_matrix: npt.NDArray[float],
+    active: npt.NDArray[int],
+    choices: npt.NDArray[float],
+    first_improvement: bool,
+    min_relative_improvement: float,
+    dont_look: npt.NDArray[bool],
+    margin: npt.NDArray[float],
+    track_dont_look: bool,
+    early_stopping: EarlyStopping,
+) -> Tuple[bool, bool]:
+    # pylint: disable = R0913, W0212
+    """
+    Run a pass of the exchange heuristic over the active elements, updating the solution in place.
+    :param cluster_state: The current solution.
+    :param distance_matrix: The distance matrix of elements.
+    :param active: The elements to look at, in order.
+    :param choices: Uniformly distributed random number in [0, 1) choosing among improving swaps of each element with
+    first improvement.
+    :param first_improvement: Whether to use first improvement, otherwise best improvement.
+    :param min_relative_improvement: Fraction of the objective value a swap must improve by.
+    :param dont_look: Don't-look bits, updated in place.
+    :param margin: Margins of elements with don't-look bits, updated in place.
+    :param track_dont_look: Whether to clear don't-look bits after swaps.
+    :param early_stopping: Stopping criteria, updated in place.
+    :return: Whether a swap was made, and whether to stop.
+    """
+    objective = cluster_state.objective
+    improved = stop = False
+    start = 0
+    while start < len(active) and not stop:
+        start, stop, objective, improved_chunk, reference, stagnation = _exchange_kernel(
+            np.asarray(distance_matrix),
+            cluster_state.labels,
+            cluster_state.strata,
+            cluster_state._members,
+            cluster_state._position,
+            cluster_state._distance_to_group,
+            active,
+            choices,
+            start,
+            objective,
+            first_improvement,
+            min_relative_improvement,
+            dont_look,
+            margin,
+            track_dont_look,
+            early_stopping.reference,
+            early_stopping.stagnation,
+            _stagnation_limit(early_stopping),
+            early_stopping.tolerance,
+        )
+        early_stopping.reference, early_stopping.stagnation = reference, stagnation
+        improved |= improved_chunk
+        stop |= is_past(early_stopping.deadline)
+    cluster_state.objective = objective
+    return improved, stop
+
+
+def _new_state(distance_matrix: npt.NDArray[float]) -> Tuple[ClusterState, EarlyStopping]:
+    """
+    Get a solution of two elements in separate anti-clusters, with stopping criteria that never stop early.
+    :param distance_matrix: The distance matrix of the two elements.
+    :return: The solution and the stopping criteria.
+    """
+    cluster_state = ClusterState(labels=np.arange(2), num_groups=2, distance_matrix=distance_matrix)
+    return cluster_state, EarlyStopping(None, 0.0, None, cluster_state.objective)
+
+
+def compile_kernels(dtype: npt.DTypeLike) -> None:
+    """
+    Compile the kernels for distance matrices of a data type, by running them on two elements. Kernels are otherwise
+    compiled at their first call, which takes seconds unless they are cached on disk from an earlier run. The heuristics
+    compile them before their time limit starts. Read-only distance matrices, as shared with worker processes, are
+    compiled separately by Numba, so both are compiled here.
+    :param dtype: Data type of the distance matrix.
+    :return:
+    """
+    elements = np.zeros(1, dtype=np.int64)
+    randoms = np.zeros(1)
+    for writeable in (True, False):
+        distance_matrix = np.zeros((2, 2), dtype=dtype)
+        distance_matrix.flags.writeable = writeable
+
+        cluster_state, early_stopping = _new_state(distance_matrix)
+        run_simulated_annealing(cluster_state, distance_matrix, elements, randoms, randoms, 1.0, 0.5, early_stopping)
+        cluster_state, early_stopping = _new_state(distance_matrix)
+        run_tabu_search(
+            cluster_state,
+            distance_matrix,
+            elements,
+            randoms,
+            cluster_state.labels.copy(),
+            np.zeros((2, 2), dtype=np.int64),
+            1,
+            True,
+            early_stopping,
+        )
+        cluster_state, early_stopping = _new_state(distance_matrix)
+        run_exchange_pass(
+            cluster_state,
+            distance_matrix,
+            np.flatnonzero(np.ones(2, dtype=bool)),
+            np.zeros(2),
+            False,
+            0.0,
+            np.zeros(2, dtype=bool),
+            np.zeros(2),
+            False,
+            early_stopping,
+        )
@@ -0,0 +1,231 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Utilities for running work in a pool of worker processes that share a read-only distance matrix, dense or sparse, and
+arrays that workers modify in place.
+"""
+
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse
+
+# The distance matrix attached in a worker process, and the shared memory block backing it.
+_WORKER_DISTANCE_MATRIX: Optional[Union[npt.NDArray[float], scipy.sparse.csr_matrix]] = None
+_WORKER_SHARED_MEMORY: Optional[SharedMemory] = None
+# Shared memory blocks of SharedArrays attached in a worker process by name, and the arrays in them.
+_WORKER_SHARED_ARRAYS: Dict[str, Tuple[SharedMemory, List[npt.NDArray]]] = {}
+
+# Alignment in bytes of each array in the shared memory block.
+_ALIGNMENT = 64
+
+
+def effective_n_jobs(n_jobs: Optional[int]) -> int:
+    """
+    Resolve the number of worker processes to use.
+    :param n_jobs: Requested number of workers. None means 1 and negative values count back from the number of CPUs,
+    such that -1 means all CPUs.
+    :return: The number of workers.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs == 0:
+        raise ValueError("n_jobs cannot be 0.")
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def _get_layout(arrays: List[npt.NDArray]) -> Tuple[List[Tuple[int, tuple, str]], int]:
+    """
+    Lay out arrays one after another in a shared memory block.
+    :param arrays: The arrays.
+    :return: The offset, shape and data type of each array, and the total size in bytes.
+    """
+    layout = []
+    size = 0
+    for array in arrays:
+        layout.append((size, array.shape, array.dtype.str))
+        size += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    return layout, size
+
+
+def _get_views(shared_memory: SharedMemory, layout: List[Tuple[int, tuple, str]]) -> List[npt.NDArray]:
+    """
+    Get the arrays in a shared memory block without copying them.
+    :param shared_memory: The shared memory block.
+    :param layout: Offset, shape and data type of each array, as returned by _get_layout.
+    :return: The arrays.
+    """
+    return [
+        np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_memory.buf, offset=offset)
+        for offset, shape, dtype in layout
+    ]
+
+
+def _copy_arrays(arrays: List[npt.NDArray], shared_memory: SharedMemory, layout: List[Tuple[int, tuple, str]]) -> None:
+    """
+    Copy arrays into a shared memory block. No views of the block are kept, so it can be closed afterwards.
+    :param arrays: The arrays.
+    :param shared_memory: The shared memory block.
+    :param layout: Offset, shape and data type of each array, as returned by _get_layout.
+    :return:
+    """
+    for array, shared in zip(arrays, _get_views(shared_memory, layout)):
+        shared[...] = array
+
+
+def _attach_distance_matrix(name: str, layout: List[Tuple[int, tuple, str]], sparse_shape: Optional[tuple]) -> None:
+    """
+    Worker initializer attaching the shared distance matrix.
+    :param name: Name of the shared memory block.
+    :param layout: Offset, shape and data type of each array in the shared memory block, as returned by _get_layout.
+    :param sparse_shape: Shape of a sparse distance matrix, whose data, indices and index pointers are the arrays. None
+    for a dense distance matrix, which is the only array.
+    :return:
+    """
+    global _WORKER_DISTANCE_MATRIX, _WORKER_SHARED_MEMORY  # pylint: disable = W0603
+    _WORKER_SHARED_MEMORY = SharedMemory(name=name)
+    arrays = _get_views(_WORKER_SHARED_MEMORY, layout)
+    for array in arrays:
+        array.flags.writeable = False
+
+    if sparse_shape is None:
+        _WORKER_DISTANCE_MATRIX = arrays[0]
+    else:
+        _WORKER_DISTANCE_MATRIX = scipy.sparse.csr_matrix(tuple(arrays), shape=sparse_shape, copy=False)
+        _WORKER_DISTANCE_MATRIX.has_sorted_indices = True
+
+
+def _call_with_distance_matrix(fn: Callable, *args: Any) -> Any:
+    """
+    Call function in a worker process with the shared distance matrix as first argument.
+    :param fn: The function to call.
+    :param args: Remaining arguments.
+    :return: The result of the function.
+    """
+    return fn(_WORKER_DISTANCE_MATRIX, *args)
+
+
+class SharedDistanceMatrixPool:
+    """
+    A process pool where every worker has read access to the same distance matrix. The matrix is copied into shared
+    memory once, instead of being pickled for each task. Sparse matrices must be CSR matrices with sorted indices. Use
+    as a context manager.
+    """
+
+    def __init__(self, distance_matrix: Union[npt.NDArray[float], scipy.sparse.csr_matrix], n_jobs: int):
+        """
+        Initialize pool.
+        :param distance_matrix: The distance matrix to share.
+        :param n_jobs: Number of worker processes.
+        """
+        self._distance_matrix = distance_matrix
+        self._n_jobs = n_jobs
+        self._shared_memory: Optional[SharedMemory] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> "SharedDistanceMatrixPool":
+        if scipy.sparse.issparse(self._distance_matrix):
+            arrays = [self._distance_matrix.data, self._distance_matrix.indices, self._distance_matrix.indptr]
+            sparse_shape = self._distance_matrix.shape
+        else:
+            arrays = [self._distance_matrix]
+            sparse_shape = None
+
+        layout, size = _get_layout(arrays)
+        self._shared_memory = SharedMemory(create=True, size=max(1, size))
+        _copy_arrays(arrays, self._shared_memory, layout)
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=self._n_jobs,
+            initializer=_attach_distance_matrix,
+            initargs=(self._shared_memory.name, layout, sparse_shape),
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._executor.shutdown()
+        self._shared_memory.close()
+        self._shared_memory.unlink()
+
+    def map(self, fn: Callable, *iterables: Iterable) -> Iterator:
+        """
+        Map function over iterables in the worker processes. The function is called with the shared distance matrix as
+        first argument, followed by one element from each iterable. Results are returned in order. Tasks are submitted
+        lazily, keeping at most two per worker pending, so tasks are not submitted if iteration stops early.
+        :param fn: The function to map. Must be picklable.
+        :param iterables: Remaining arguments.
+        :return: Iterator over results.
+        """
+        pending = collections.deque()
+        for args in zip(*iterables):
+            if len(pending) >= 2 * self._n_jobs:
+                yield pending.popleft().result()
+            pending.append(self._executor.submit(_call_with_distance_matrix, fn, *args))
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+class SharedArrays:
+    """
+    Arrays copied into shared memory once, which worker processes modify in place. Only the name and layout of the
+    shared memory block are pickled, and each worker process attaches to it at most once. Use as a context manager in
+    the process creating the arrays, which keeps no reference to the shared arrays itself.
+    """
+
+    def __init__(self, arrays: List[npt.NDArray]):
+        """
+        Initialize shared arrays.
+        :param arrays: The arrays to copy into shared memory.
+        """
+        self._arrays: Optional[List[npt.NDArray]] = arrays
+        self._layout: Optional[List[Tuple[int, tuple, str]]] = None
+        self._name: Optional[str] = None
+        self._shared_memory: Optional[SharedMemory] = None
+
+    def __enter__(self) -> "SharedArrays":
+        self._layout, size = _get_layout(self._arrays)
+        self._shared_memory = SharedMemory(create=True, size=max(1, size))
+        self._name = self._shared_memory.name
+        _copy_arrays(self._arrays, self._shared_memory, self._layout)
+        self._arrays = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._shared_memory.close()
+        self._shared_memory.unlink()
+
+    def __getstate__(self) -> dict:
+        return {"name": self._name, "layout": self._layout}
+
+    def __setstate__(self, state: dict) -> None:
+        self._arrays = None
+        self._layout = state["layout"]
+        self._name = state["name"]
+        self._shared_memory = None
+
+    def get(self) -> List[npt.NDArray]:
+        """
+        Get the shared arrays in a worker process, attaching to the shared memory block on first use.
+        :return: The arrays, modified in place.
+        """
+        if self._name not in _WORKER_SHARED_ARRAYS:
+            shared_memory = SharedMemory(name=self._name)
+            _WORKER_SHARED_ARRAYS[self._name] = (shared_memory, _get_views(shared_memory, self._layout))
+        return _WORKER_SHARED_ARRAYS[self._name][1]
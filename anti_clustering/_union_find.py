@@ -18,21 +18,18 @@ Based on:
 Sedgewick, R. & Wayne, K. (2011), Algorithms, 4th Edition. , Addison-Wesley .
 """
 
-from typing import TypeVar, Generic
+import numpy as np
+import numpy.typing as npt
 
-T = TypeVar("T")  # pylint: disable=C0103
 
-
-class UnionFind(Generic[T]):
+class UnionFind:
     """
     A union find data structure for collecting results of the anti-clustering algorithm.
-    This implementation uses the weighted quick union with path compression.
+    This implementation uses the weighted quick union with path compression. Parents and sizes are stored in integer
+    arrays, and bulk operations are provided for unifying many pairs and finding all roots at once.
     """
 
-    # A mapping from an element to its parent. If a parent maps to itself, it is the root of the component.
-    _parent = {}
-    _size = {}
-    components_count = 0
+    __slots__ = ("_parent", "_size", "components_count")
 
     def __init__(self, initial_components_count: int):
         """
@@ -40,24 +37,26 @@ class UnionFind(Generic[T]):
         :param initial_components_count: The initial number of components.
         """
         self.components_count = initial_components_count
-        self._parent = {i: i for i in range(initial_components_count)}
-        self._size = {i: 1 for i in range(initial_components_count)}
+        # A mapping from an element to its parent. If a parent maps to itself, it is the root of the component.
+        self._parent = np.arange(initial_components_count, dtype=np.intp)
+        # The size of each component. Only valid for roots.
+        self._size = np.ones(initial_components_count, dtype=np.intp)
 
-    def _find(self, element: T) -> T:
+    def _find(self, element: int) -> int:
         """
         Find the root of component of element.
         :param element: Element to find root of.
         :return: The root of the component.
         """
+        parent = self._parent
         # Compresses path while iterating up the tree.
-        while element != self._parent[element]:
-            parent = self._parent[element]
-            self._parent[element] = self._parent[parent]
-            element = parent
+        while element != parent[element]:
+            parent[element] = parent[parent[element]]
+            element = parent[element]
 
-        return element
+        return int(element)
 
-    def find(self, element: T) -> T:
+    def find(self, element: int) -> int:
         """
         Find the root of component of element.
         :param element: Element to find root of.
@@ -65,7 +64,19 @@ class UnionFind(Generic[T]):
         """
         return self._find(element)
 
-    def union(self, element_1: T, element_2: T) -> None:
+    def find_all(self) -> npt.NDArray[int]:
+        """
+        Find the root of the component of every element, fully compressing all paths.
+        :return: The root of each element.
+        """
+        # Pointer jumping: every iteration halves the distance from each element to its root.
+        while True:
+            grandparent = self._parent[self._parent]
+            if np.array_equal(grandparent, self._parent):
+                return self._parent.copy()
+            self._parent = grandparent
+
+    def union(self, element_1: int, element_2: int) -> None:
         """
         Unify components of two elements.
         :param element_1: Element to unify.
@@ -90,7 +101,31 @@ class UnionFind(Generic[T]):
             self._size[root_1] += self._size[root_2]
         self.components_count -= 1
 
-    def connected(self, element_1: T, element_2: T) -> bool:
+    def union_many(self, pairs: npt.NDArray[int]) -> "UnionFind":
+        """
+        Unify components of many pairs of elements at once.
+        :param pairs: Array of shape (number of pairs, 2) with the elements to unify.
+        :return: The UnionFind itself.
+        """
+        pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+        while len(pairs) > 0:
+            roots = self.find_all()[pairs]
+            roots = roots[roots[:, 0] != roots[:, 1]]
+            if len(roots) == 0:
+                break
+
+            # Hook the larger root onto the smallest root it is paired with. Pairs hooked onto another root than their
+            # partner are unified in the next iteration.
+            smaller, larger = roots.min(axis=1), roots.max(axis=1)
+            np.minimum.at(self._parent, larger, smaller)
+            pairs = roots
+
+        roots = self.find_all()
+        self._size = np.bincount(roots, minlength=len(roots))
+        self.components_count = int(np.count_nonzero(roots == np.arange(len(roots))))
+        return self
+
+    def connected(self, element_1: int, element_2: int) -> bool:
         """
         Check if element 1 and 2 are in the same component.
         :param element_1: Element to check.
@@ -98,3 +133,13 @@ class UnionFind(Generic[T]):
         :return: Whether 1 and 2 are in the same component.
         """
         return self._find(element_1) == self._find(element_2)
+
+    def labels(self) -> npt.NDArray[int]:
+        """
+        Label every element with its component. Components are enumerated from 0 in order of first occurrence.
+        :return: The component label of each element.
+        """
+        _, first_occurrence, inverse = np.unique(self.find_all(), return_index=True, return_inverse=True)
+        rank = np.empty(len(first_occurrence), dtype=np.intp)
+        rank[np.argsort(first_occurrence)] = np.arange(len(first_occurrence))
+        return rank[inverse]
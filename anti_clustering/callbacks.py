@@ -0,0 +1,131 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Callbacks reporting the progress of anti-clustering algorithms.
+"""
+
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+import pandas as pd
+
+
+class IterationInfo(NamedTuple):
+    """
+    Progress of a heuristic after an iteration.
+    * restart: The restart, or for parallel tempering the temperature index of the replica.
+    * iteration: The iteration within the restart.
+    * objective: Objective value of the current solution.
+    * best_objective: Objective value of the best solution found in the restart.
+    * accepted: Number of moves accepted so far in the restart.
+    * rejected: Number of moves rejected so far in the restart.
+    * temperature: Temperature of simulated annealing and parallel tempering.
+    * tabu_size: Number of tabu moves of tabu search.
+    """
+
+    restart: int
+    iteration: int
+    objective: float
+    best_objective: float
+    accepted: int
+    rejected: int
+    temperature: Optional[float] = None
+    tabu_size: Optional[int] = None
+
+
+class Callback:
+    """
+    Base class of callbacks passed to anti-clustering algorithms. All methods do nothing, override the ones of interest.
+
+    Phases are "prepare_data", "distance_matrix", "solve" and "post_process". Divide-and-conquer has no distance matrix
+    phase, but "partition" and "merge" phases instead, and the wrapped algorithm reports the phases of each block.
+    The exact approach also reports the phases within solving: "precluster", "warm_start", "constraints", "build_model"
+    and "solve_model". With lazy constraints, the last three are reported in every round of adding violated constraints.
+
+    Iterations and restarts are reported by the swap-based heuristics. When restarts run in worker processes, the
+    iterations of each restart are recorded in the worker and reported once the restart has finished.
+    """
+
+    def on_phase_end(self, phase: str, seconds: float) -> None:
+        """
+        Called when a phase of the algorithm has finished.
+        :param phase: Name of the phase.
+        :param seconds: Wall time of the phase.
+        :return:
+        """
+
+    def on_iteration(self, info: IterationInfo) -> None:
+        """
+        Called after each iteration of a heuristic.
+        :param info: The progress after the iteration.
+        :return:
+        """
+
+    def on_restart_end(self, restart: int, objective: float) -> None:
+        """
+        Called when a restart of a heuristic has finished.
+        :param restart: The restart.
+        :param objective: Objective value of the solution of the restart.
+        :return:
+        """
+
+
+class MetricsCollector(Callback):
+    """
+    Callback collecting phase timings, restart objectives and, optionally, the progress of every iteration.
+    """
+
+    def __init__(self, collect_iterations: bool = True):
+        self.collect_iterations = collect_iterations
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.restart_objectives: List[float] = []
+        self.iterations: List[IterationInfo] = []
+
+    def on_phase_end(self, phase: str, seconds: float) -> None:
+        self.timings[phase] += seconds
+
+    def on_iteration(self, info: IterationInfo) -> None:
+        if self.collect_iterations:
+            self.iterations.append(info)
+
+    def on_restart_end(self, restart: int, objective: float) -> None:
+        self.restart_objectives.append(objective)
+
+    def iterations_frame(self) -> pd.DataFrame:
+        """
+        Get the collected iterations as a dataframe.
+        :return: Dataframe with a row per iteration and a column per field of IterationInfo.
+        """
+        return pd.DataFrame(self.iterations, columns=IterationInfo._fields)
+
+
+class PrintCallback(Callback):
+    """
+    Callback printing progress, used in verbose mode.
+    """
+
+    def __init__(self, every: int = 100):
+        self.every = every
+
+    def on_phase_end(self, phase: str, seconds: float) -> None:
+        print(f"Finished {phase} in {seconds:.3f}s")
+
+    def on_iteration(self, info: IterationInfo) -> None:
+        if info.iteration % self.every == 0:
+            print(
+                f"Restart {info.restart + 1}, iteration {info.iteration + 1}: "
+                f"objective {info.objective:.4f}, best {info.best_objective:.4f}"
+            )
+
+    def on_restart_end(self, restart: int, objective: float) -> None:
+        print(f"Restart {restart + 1} finished with objective {objective:.4f}")
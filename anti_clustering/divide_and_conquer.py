@@ -0,0 +1,321 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Divide-and-conquer anti-clustering for datasets too large for a single distance matrix.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import scipy.sparse
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.linalg import LinearOperator, eigsh
+from sklearn.cluster import MiniBatchKMeans
+from anti_clustering.callbacks import Callback
+from anti_clustering._base import AntiClustering
+from anti_clustering._parallel import effective_n_jobs
+
+
+class DivideAndConquerAntiClustering(AntiClustering):
+    """
+    Divide-and-conquer anti-clustering for datasets too large for a single distance matrix.
+
+    Elements are ordered such that similar elements are adjacent, either by a one-dimensional projection on the first
+    principal component or by pre-clustering with k-means, and are then dealt round-robin into blocks. Each block is
+    thereby a stratified sample of the whole dataset. Blocks are anti-clustered independently by the wrapped algorithm,
+    in parallel if n_jobs allows it. Finally, the anti-clusters of each block are matched to the global anti-clusters,
+    keeping anti-cluster sizes balanced and feature sums as close to proportional as possible.
+
+    Memory is O(B^2) per block instead of O(N^2), where B is the block size. Categorical columns are one-hot encoded as
+    sparse features, so columns with many categories, such as identifiers, need memory linear in N for ordering and
+    merging.
+    """
+
+    # Up to this number of features, principal components are computed from the dense covariance matrix.
+    _DENSE_COVARIANCE_FEATURES = 256
+    # Number of principal components pre-clustered by k-means.
+    _KMEANS_COMPONENTS = 16
+
+    def __init__(
+        self,
+        algorithm: AntiClustering,
+        block_size: int = 1000,
+        partitioning: str = "projection",
+        verbose: bool = False,
+        random_seed: int = None,
+        n_jobs: int = 1,
+        callbacks: Optional[List[Callback]] = None,
+    ):
+        # pylint: disable = R0913
+        super().__init__(verbose=verbose, n_jobs=n_jobs, callbacks=callbacks)
+        if partitioning not in ("projection", "kmeans"):
+            raise ValueError(f"Unknown partitioning: {partitioning}. Must be 'projection' or 'kmeans'.")
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.partitioning = partitioning
+        self.random_seed = random_seed
+
+    def run(
+        self,
+        df: pd.DataFrame,
+        numerical_columns: Optional[List[str]],
+        categorical_columns: Optional[List[str]],
+        num_groups: int,
+        destination_column: str,
+        metric: str = "euclidean",
+        weights: Optional[Dict[str, float]] = None,
+        num_neighbours: Optional[int] = None,
+        stratify_columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        # pylint: disable = R0913
+        numerical_columns = [] if numerical_columns is None else numerical_columns
+        categorical_columns = [] if categorical_columns is None else categorical_columns
+
+        if len(df) <= self.block_size:
+            return self.algorithm.run(
+                df=df,
+                numerical_columns=numerical_columns,
+                categorical_columns=categorical_columns,
+                num_groups=num_groups,
+                destination_column=destination_column,
+                metric=metric,
+                weights=weights,
+                num_neighbours=num_neighbours,
+                stratify_columns=stratify_columns,
+            )
+        if stratify_columns is not None and len(stratify_columns) > 0:
+            # Merging block anti-clusters only balances strata approximately.
+            raise ValueError("Stratification is not supported for datasets split into more than one block.")
+
+        with self._phase("prepare_data"):
+            prepared_df = self._prepare_data(
+                df=df, numerical_columns=numerical_columns, categorical_columns=categorical_columns
+            )
+        with self._phase("partition"):
+            features = self._get_features(
+                df=prepared_df, numerical_columns=numerical_columns, categorical_columns=categorical_columns
+            )
+
+            # Deal elements round-robin into blocks, such that adjacent (i.e. similar) elements end up in different
+            # blocks.
+            num_blocks = -(-len(df) // self.block_size)
+            order = self._get_order(features=features, num_blocks=num_blocks)
+            blocks = [order[b::num_blocks] for b in range(num_blocks)]
+
+        with self._phase("solve"):
+            block_dfs = [prepared_df.iloc[block] for block in blocks]
+            args = (
+                block_dfs,
+                [numerical_columns] * num_blocks,
+                [categorical_columns] * num_blocks,
+                [num_groups] * num_blocks,
+                [metric] * num_blocks,
+                [weights] * num_blocks,
+                [num_neighbours] * num_blocks,
+            )
+            n_jobs = min(effective_n_jobs(self.n_jobs), num_blocks)
+            if n_jobs > 1:
+                with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                    block_labels = list(executor.map(_solve_block, [self.algorithm] * num_blocks, *args))
+            else:
+                block_labels = list(map(_solve_block, [self.algorithm] * num_blocks, *args))
+
+        with self._phase("merge"):
+            labels = self._merge(features=features, blocks=blocks, block_labels=block_labels, num_groups=num_groups)
+
+        with self._phase("post_process"):
+            return self._post_process(df=df, destination_column=destination_column, cluster_assignment=labels)
+
+    def _solve(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, strata: Optional[npt.NDArray[int]] = None
+    ) -> npt.NDArray:
+        # pylint: disable = W0212
+        return self.algorithm._solve(distance_matrix=distance_matrix, num_groups=num_groups, strata=strata)
+
+    def _get_features(
+        self, df: pd.DataFrame, numerical_columns: List[str], categorical_columns: List[str]
+    ) -> scipy.sparse.csr_matrix:
+        """
+        Get a feature matrix used for ordering elements and balancing the merge: the normalized numerical columns and
+        one-hot encoded categorical columns. The matrix is sparse, so it takes O(N) memory per column regardless of the
+        number of categories.
+        :param df: The prepared dataframe.
+        :param numerical_columns: Columns in dataset to use for anti-clustering containing numbers.
+        :param categorical_columns: Columns in dataset to use for anti-clustering containing strings or dates.
+        :return: The feature matrix.
+        """
+        features = [scipy.sparse.csr_matrix(df[numerical_columns].to_numpy(dtype=np.float64))]
+        for column in categorical_columns:
+            codes, uniques = pd.factorize(df[column])
+            # Missing values are coded as -1 and have no category.
+            rows = np.flatnonzero(codes >= 0)
+            features.append(
+                scipy.sparse.csr_matrix(
+                    (np.ones(len(rows)), (rows, codes[rows])), shape=(len(df), len(uniques)), dtype=np.float64
+                )
+            )
+        return scipy.sparse.hstack(features, format="csr")
+
+    def _get_order(self, features: scipy.sparse.csr_matrix, num_blocks: int) -> npt.NDArray[int]:
+        """
+        Order elements such that similar elements are adjacent.
+        :param features: The feature matrix.
+        :param num_blocks: Number of blocks.
+        :return: The ordering of elements.
+        """
+        num_elements = features.shape[0]
+        components = self._get_principal_components(
+            features, num_components=1 if self.partitioning == "projection" else self._KMEANS_COMPONENTS
+        )
+        if components.shape[1] == 0:
+            # All elements have the same features.
+            components = np.zeros((num_elements, 1))
+        projection = components[:, 0]
+
+        if self.partitioning == "projection":
+            return np.argsort(projection, kind="stable")
+
+        # Pre-clustering into clusters of roughly num_blocks elements, such that every block receives about one
+        # element of each cluster. Clusters are found in the space of the principal components, as cluster centers in
+        # the space of one-hot encoded features would be dense. Within clusters, elements are ordered by the projection.
+        clusters = MiniBatchKMeans(
+            n_clusters=max(1, num_elements // num_blocks), random_state=self.random_seed, n_init=3
+        ).fit_predict(components)
+        return np.lexsort((projection, clusters))
+
+    def _get_principal_components(self, features: scipy.sparse.csr_matrix, num_components: int) -> npt.NDArray[float]:
+        """
+        Project elements on the principal components of the features with the largest variance. The features are
+        centered implicitly, so the matrix stays sparse.
+        :param features: The feature matrix.
+        :param num_components: Maximum number of principal components.
+        :return: The projection of each element on each principal component with positive variance, in decreasing order
+        of variance.
+        """
+        num_elements, num_features = features.shape
+        if num_features == 0:
+            return np.zeros((num_elements, 0))
+        means = np.asarray(features.mean(axis=0)).ravel()
+
+        if num_features <= self._DENSE_COVARIANCE_FEATURES:
+            covariance = (features.T @ features).toarray() / num_elements - np.outer(means, means)
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        else:
+            covariance = LinearOperator(
+                shape=(num_features, num_features),
+                matvec=lambda v: features.T @ (features @ v) / num_elements - means * (means @ v),
+                dtype=np.float64,
+            )
+            eigenvalues, eigenvectors = eigsh(
+                covariance, k=min(num_components, num_features - 1), which="LA", v0=np.ones(num_features)
+            )
+
+        # Eigenvalues are in increasing order.
+        order = np.argsort(-eigenvalues, kind="stable")[:num_components]
+        components = eigenvectors[:, order[eigenvalues[order] > 0]]
+        return features @ components - means @ components
+
+    def _merge(
+        self,
+        features: scipy.sparse.csr_matrix,
+        blocks: List[npt.NDArray[int]],
+        block_labels: List[npt.NDArray[int]],
+        num_groups: int,
+    ) -> npt.NDArray[int]:
+        """
+        Merge the anti-clusters of each block into global anti-clusters. Blocks are merged one at a time by solving an
+        assignment problem between block anti-clusters and global anti-clusters. Primarily, sizes are kept balanced, by
+        assigning the larger block anti-clusters to the smaller global anti-clusters. Secondarily, the feature sums of
+        each global anti-cluster are kept as close as possible to the size times the feature means of the dataset.
+        :param features: The feature matrix.
+        :param blocks: The elements of each block.
+        :param block_labels: The anti-cluster labels of each block, as returned by the wrapped algorithm.
+        :param num_groups: Number of anti-clusters.
+        :return: The global anti-cluster labels.
+        """
+        num_elements, num_features = features.shape
+        labels = np.empty(num_elements, dtype=np.intp)
+        means = np.asarray(features.mean(axis=0)).ravel()
+        sizes = np.zeros(num_groups)
+        sums = np.zeros((num_groups, num_features))
+
+        for block, block_label in zip(blocks, block_labels):
+            block_sizes = np.bincount(block_label, minlength=num_groups)
+            one_hot = scipy.sparse.csr_matrix(
+                (np.ones(len(block)), (block_label, np.arange(len(block)))), shape=(num_groups, len(block))
+            )
+            block_sums = (one_hot @ features[block]).toarray()
+
+            # Squared deviation from proportional feature sums for global anti-cluster g receiving block anti-cluster p,
+            # expanded as |a_g + b_p|^2 for the deviations a_g and b_p of either, without a K x K x features array.
+            deviation = sums - sizes[:, None] * means
+            block_deviation = block_sums - block_sizes[:, None] * means
+            balance_cost = np.maximum(
+                np.square(block_deviation).sum(axis=1)[:, None]
+                + np.square(deviation).sum(axis=1)[None, :]
+                + 2.0 * block_deviation @ deviation.T,
+                0.0,
+            )
+            # Number of larger block anti-clusters assigned to larger global anti-clusters. Minimizing it first keeps
+            # the sizes of global anti-clusters within one of each other.
+            size_cost = np.outer(block_sizes - block_sizes.min(), sizes - sizes.min())
+
+            rows, cols = linear_sum_assignment(size_cost * (balance_cost.sum() + 1) + balance_cost)
+            mapping = np.empty(num_groups, dtype=np.intp)
+            mapping[rows] = cols
+
+            labels[block] = mapping[block_label]
+            sizes[cols] += block_sizes[rows]
+            sums[cols] += block_sums[rows]
+
+        return labels
+
+
+def _solve_block(
+    algorithm: AntiClustering,
+    df: pd.DataFrame,
+    numerical_columns: List[str],
+    categorical_columns: List[str],
+    num_groups: int,
+    metric: str,
+    weights: Optional[Dict[str, float]],
+    num_neighbours: Optional[int],
+) -> npt.NDArray[int]:
+    # pylint: disable = R0913
+    """
+    Anti-cluster a single block. Defined at module level to be usable in worker processes.
+    :param algorithm: The algorithm to solve the block with.
+    :param df: The block.
+    :param numerical_columns: Columns in dataset to use for anti-clustering containing numbers.
+    :param categorical_columns: Columns in dataset to use for anti-clustering containing strings or dates.
+    :param num_groups: Number of anti-clusters to generate.
+    :param metric: The distance between elements.
+    :param weights: Optional weight of each column.
+    :param num_neighbours: If given, the number of nearest neighbours in a sparse approximation of distances.
+    :return: The anti-cluster labels of the block.
+    """
+    destination_column = "__anti_cluster__"
+    result = algorithm.run(
+        df=df[[*numerical_columns, *categorical_columns]],
+        numerical_columns=numerical_columns,
+        categorical_columns=categorical_columns,
+        num_groups=num_groups,
+        destination_column=destination_column,
+        metric=metric,
+        weights=weights,
+        num_neighbours=num_neighbours,
+    )
+    return result[destination_column].to_numpy(dtype=np.intp)
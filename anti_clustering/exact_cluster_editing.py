@@ -19,124 +19,449 @@ Papenberg, M., & Klau, G. W. (2021). Using anticlustering to partition data sets
 Psychological Methods, 26(2), 161–174. https://doi.org/10.1037/met0000301
 """
 
-from typing import List
+import collections
+import itertools
+import time
+from typing import List, Optional, Sequence, Tuple
 import numpy as np
 import numpy.typing as npt
-from ortools.linear_solver import pywraplp
+import pandas as pd
+import scipy.sparse
+from ortools.linear_solver.python import model_builder
+from anti_clustering.callbacks import Callback
 from anti_clustering._base import AntiClustering
+from anti_clustering._parallel import effective_n_jobs
+from anti_clustering._union_find import UnionFind
 
 
 class ExactClusterEditingAntiClustering(AntiClustering):
     """
     MIP formulation for solving the anti-clustering problem.
+
+    The model is built in bulk from a sparse constraint matrix. Any solver supported by the OR-Tools model builder can
+    be used, e.g. "SCIP" or "CP_SAT". With "CP_SAT", n_jobs search workers are used.
+
+    Solving can be stopped early by a time limit or a relative gap ("SCIP" and "CP_SAT" only), in which case the best
+    solution found is returned. The solver can be given a starting solution found by another algorithm, e.g. the
+    exchange heuristic, with warm_start. After running, the objective value of the solution, the best bound on the
+    optimal objective value and the relative gap between them are available as objective_value, objective_bound and
+    gap. Objective values count the distance of each pair of elements in the same anti-cluster once. The time limit
+    covers the whole run, including preclustering and the warm start, and the solver gets the remaining time.
+
+    With preclustering, elements are first partitioned into preclusters of num_groups similar elements, and elements
+    of the same precluster are assigned to different anti-clusters, as described by Papenberg & Klau. This removes the
+    variables of those pairs and most of the constraints involving them, so larger instances can be solved. Solutions
+    are then optimal among the solutions separating preclustered elements, and objective_bound and gap are relative to
+    the best such solution, not to the best anti-clustering overall.
+
+    With lazy_constraints, the model starts with only a few of the cluster assignment constraints. Constraints violated
+    by the solution are added and the model is solved again, until the solution is a valid anti-clustering. This
+    usually needs a small fraction of the constraints, and max_model_size is not enforced.
     """
 
-    def __init__(self, verbose: bool = False, solver_id: str = "SCIP"):
-        super().__init__(verbose=verbose)
+    _RELATIVE_GAP_PARAMETERS = {
+        "SCIP": "limits/gap = {}",
+        "CP_SAT": "relative_gap_limit:{}",
+        "SAT": "relative_gap_limit:{}",
+    }
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        solver_id: str = "SCIP",
+        n_jobs: int = 1,
+        dtype: npt.DTypeLike = np.float64,
+        distance_block_size: Optional[int] = None,
+        max_model_size: Optional[int] = 10**8,
+        time_limit: Optional[float] = None,
+        relative_gap: Optional[float] = None,
+        warm_start: Optional[AntiClustering] = None,
+        preclustering: bool = False,
+        lazy_constraints: bool = False,
+        callbacks: Optional[List[Callback]] = None,
+    ):
+        # pylint: disable = R0913
+        super().__init__(
+            verbose=verbose, n_jobs=n_jobs, dtype=dtype, distance_block_size=distance_block_size, callbacks=callbacks
+        )
+        if relative_gap is not None and solver_id.upper() not in self._RELATIVE_GAP_PARAMETERS:
+            raise ValueError(f"Relative gap is not supported for solver {solver_id}.")
         self.solver_id = solver_id
+        self.max_model_size = max_model_size
+        self.time_limit = time_limit
+        self.relative_gap = relative_gap
+        self.warm_start = warm_start
+        self.preclustering = preclustering
+        self.lazy_constraints = lazy_constraints
+        self.objective_value = None
+        self.objective_bound = None
+        self.gap = None
 
-    def _solve(self, distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[bool]:
-        solver: pywraplp.Solver = pywraplp.Solver.CreateSolver(self.solver_id)
+    @staticmethod
+    def estimate_model_size(
+        num_elements: int, precluster_sizes: Optional[Sequence[int]] = None
+    ) -> Tuple[int, int, int]:
+        """
+        Estimate the size of the model for a number of elements, before building it.
+        :param num_elements: Number of elements.
+        :param precluster_sizes: Sizes of preclusters, if preclustering is used.
+        :return: The number of variables, constraints and nonzero constraint coefficients.
+        """
+        sizes = np.ones(num_elements, dtype=np.int64) if precluster_sizes is None else np.asarray(precluster_sizes)
+        num_pairs = num_elements * (num_elements - 1) // 2
+        num_triples = num_pairs * (num_elements - 2) // 3
+        # Pairs within a precluster have no variable. Triples with one such pair keep a single constraint, and triples
+        # within a precluster keep none.
+        num_fixed_pairs = int((sizes * (sizes - 1) // 2).sum())
+        num_reduced_triples = int((sizes * (sizes - 1) // 2 * (num_elements - sizes)).sum())
+        num_full_triples = num_triples - num_reduced_triples - int((sizes * (sizes - 1) * (sizes - 2) // 6).sum())
+        num_variables = num_pairs - num_fixed_pairs
+        return (
+            num_variables,
+            3 * num_full_triples + num_reduced_triples + num_elements,
+            9 * num_full_triples + 2 * num_reduced_triples + 2 * num_variables,
+        )
 
-        if self.verbose:
-            solver.EnableOutput()
+    def _solve(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, strata: Optional[npt.NDArray[int]] = None
+    ) -> npt.NDArray[int]:
+        # pylint: disable = R0912, R0914, R0915
+        if scipy.sparse.issparse(distance_matrix):
+            raise ValueError("The exact approach requires a dense distance matrix.")
+        start_time = time.monotonic()
+        if strata is not None:
+            raise ValueError("The exact approach does not support stratification.")
+        num_elements = len(distance_matrix)
 
-        min_group_size = np.floor(len(distance_matrix) / num_groups)
-        max_group_size = np.ceil(len(distance_matrix) / num_groups)
+        # Cluster assignments are modelled as boolean assignments, one for each pair of elements i < j.
+        pair_rows, pair_cols = np.triu_indices(num_elements, k=1)
+        free = np.ones(len(pair_rows), dtype=bool)
+        precluster_sizes = None
+        if self.preclustering and num_groups > 1:
+            with self._phase("precluster"):
+                preclusters = self._get_preclusters(distance_matrix=distance_matrix, num_groups=num_groups)
+            precluster_sizes = np.bincount(preclusters)
+            # Elements of the same precluster are assigned to different anti-clusters.
+            free = preclusters[pair_rows] != preclusters[pair_cols]
 
-        # Cluster assignment are modelled as boolean assignments.
-        x = np.asarray(
-            [
-                [(solver.BoolVar(f"x_[{i}][{j}]")) if j > i else False for j in range(len(distance_matrix))]
-                for i in range(len(distance_matrix))
-            ]
-        )
+        _, _, num_nonzeros = self.estimate_model_size(num_elements, precluster_sizes)
+        if not self.lazy_constraints and self.max_model_size is not None and num_nonzeros > self.max_model_size:
+            raise ValueError(
+                f"Model with {num_nonzeros} nonzero coefficients exceeds max_model_size of {self.max_model_size}."
+            )
 
-        if self.verbose:
-            print("Making cluster assignment constraints")
+        if not model_builder.Solver(self.solver_id).solver_is_supported():
+            raise ValueError(f"Solver {self.solver_id} is not supported.")
 
-        # Cluster assignment constraints
-        for k in range(len(distance_matrix)):
-            for j in range(0, k):
-                for i in range(0, j):
-                    self._add_constraint(
-                        solver=solver,
-                        vars_=[x[i][j], x[i][k], x[j][k]],
-                        coeffs=[-1.0, 1.0, 1.0],
-                        ub=1.0,
-                        lb=-solver.infinity(),
-                    )
-
-                    self._add_constraint(
-                        solver=solver,
-                        vars_=[x[i][j], x[i][k], x[j][k]],
-                        coeffs=[1.0, -1.0, 1.0],
-                        ub=1.0,
-                        lb=-solver.infinity(),
-                    )
-
-                    self._add_constraint(
-                        solver=solver,
-                        vars_=[x[i][j], x[i][k], x[j][k]],
-                        coeffs=[1.0, 1.0, -1.0],
-                        ub=1.0,
-                        lb=-solver.infinity(),
-                    )
-
-        if self.verbose:
-            print("Making cluster size constraints")
+        rows, cols = pair_rows[free], pair_cols[free]
+        variables = np.full(len(pair_rows), -1, dtype=np.intp)
+        variables[free] = np.arange(len(rows))
 
         # Cluster size constraints. Differently to original paper, we allow anti-clusters to be of different size if
         # number of groups does not divide number og elements.
-        for i in range(len(distance_matrix)):
-            self._add_constraint(
-                solver=solver,
-                vars_=[x[i][j] for j in range(i + 1, len(distance_matrix))] + [x[k][i] for k in range(0, i)],
-                coeffs=[1.0 for j in range(i + 1, len(distance_matrix))] + [1.0 for k in range(0, i)],
-                ub=max_group_size - 1.0 if i + 1 < len(distance_matrix) else solver.infinity(),
-                lb=min_group_size - 1.0 if i > 0 else -solver.infinity(),
-            )
+        size_constraints = scipy.sparse.csr_matrix(
+            (
+                np.ones(2 * len(rows)),
+                (np.concatenate((rows, cols)), np.tile(np.arange(len(rows)), 2)),
+            ),
+            shape=(num_elements, len(rows)),
+        )
 
-        if self.verbose:
-            print("Making objective")
+        hint = None
+        if self.warm_start is not None:
+            with self._phase("warm_start"):
+                hint = self._get_hint(distance_matrix, num_groups, pair_rows, pair_cols)
 
-        # Maximise internal anti-cluster distance
-        solver.Maximize(np.multiply(x, distance_matrix).sum())
+        # Cluster assignment constraints
+        with self._phase("constraints"):
+            if self.lazy_constraints:
+                # Seed with the constraints violated when each element is paired with its farthest elements, which is
+                # roughly what the model without any cluster assignment constraints would do.
+                triangle_constraints = self._get_triangle_constraints(
+                    num_elements=num_elements,
+                    variables=variables,
+                    values=self._get_farthest_pairs(distance_matrix, num_groups, rows, cols),
+                )
+            else:
+                triangle_constraints = self._get_triangle_constraints(num_elements=num_elements, variables=variables)
 
-        if self.verbose:
-            print("Solving")
+        values, bound = None, np.inf
+        while True:
+            time_limit = None if self.time_limit is None else self.time_limit - (time.monotonic() - start_time)
+            if time_limit is not None and time_limit <= 0:
+                break
 
-        status = solver.Solve()
+            values, objective_value, bound = self._solve_model(
+                distance_matrix=distance_matrix,
+                num_groups=num_groups,
+                rows=rows,
+                cols=cols,
+                constraints=scipy.sparse.vstack((triangle_constraints, size_constraints), format="csr"),
+                num_triangle_constraints=triangle_constraints.shape[0],
+                hint=None if hint is None else hint[free],
+                time_limit=time_limit,
+            )
+            if not self.lazy_constraints or values is None:
+                break
 
-        if status != 0:
+            with self._phase("constraints"):
+                violated_constraints = self._get_triangle_constraints(
+                    num_elements=num_elements, variables=variables, values=values
+                )
+            if violated_constraints.shape[0] == 0:
+                break
+
+            # The solution is not a valid anti-clustering, so it is discarded.
+            values = None
+            triangle_constraints = scipy.sparse.vstack((triangle_constraints, violated_constraints), format="csr")
+
+        if values is not None:
+            # Pairs of elements assigned to the same anti-cluster
+            assigned = values > 0.5
+            self.objective_value = objective_value
+        elif hint is not None:
+            # The solver did not find a solution within the time limit, so the starting solution is the incumbent.
+            rows, cols = pair_rows, pair_cols
+            assigned = hint > 0.5
+            self.objective_value = float(np.asarray(distance_matrix[rows, cols], dtype=np.float64) @ hint)
+        else:
             raise ValueError("Optimization failed!")
 
-        cluster_assignment = np.asarray(
-            [
-                [bool(x[i][j].solution_value()) if j > i else None for j in range(len(distance_matrix))]
-                for i in range(len(distance_matrix))
-            ]
-        )
+        # Bounds of models with only some cluster assignment constraints are also bounds of the full model. With
+        # preclustering, they only bound the solutions separating preclustered elements.
+        self.objective_bound = bound
+        self.gap = abs(self.objective_bound - self.objective_value) / max(abs(self.objective_value), 1e-12)
+
+        return UnionFind(num_elements).union_many(np.column_stack((rows[assigned], cols[assigned]))).labels()
+
+    def _solve_model(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rows: npt.NDArray[int],
+        cols: npt.NDArray[int],
+        constraints: scipy.sparse.csr_matrix,
+        num_triangle_constraints: int,
+        hint: Optional[npt.NDArray[float]],
+        time_limit: Optional[float],
+    ) -> Tuple[Optional[npt.NDArray[float]], Optional[float], float]:
+        # pylint: disable = R0913, R0914
+        """
+        Build and solve the model.
+        :param distance_matrix: The distance matrix.
+        :param num_groups: Number of anti-clusters.
+        :param rows: First element of the pair of each variable.
+        :param cols: Second element of the pair of each variable.
+        :param constraints: Cluster assignment constraints followed by a cluster size constraint for each element.
+        :param num_triangle_constraints: Number of cluster assignment constraints.
+        :param hint: Optional starting value of each variable.
+        :param time_limit: Optional time limit in seconds.
+        :return: Variable values and objective value of the best solution, or None if no solution was found, and the
+        best bound on the objective value.
+        """
+        with self._phase("build_model"):
+            model = self._build_model(
+                distance_matrix=distance_matrix,
+                num_groups=num_groups,
+                rows=rows,
+                cols=cols,
+                constraints=constraints,
+                num_triangle_constraints=num_triangle_constraints,
+                hint=hint,
+            )
+
+        with self._phase("solve_model"):
+            solver = model_builder.Solver(self.solver_id)
+            solver.enable_output(self.verbose)
+            if time_limit is not None:
+                solver.set_time_limit_in_seconds(time_limit)
+            solver.set_solver_specific_parameters("\n".join(self._get_solver_parameters()))
+            status = solver.solve(model)
 
-        return cluster_assignment
+        # Solvers report a missing bound as NA or as their value of infinity, e.g. 1e20 for SCIP.
+        bound = solver.best_objective_bound
+        bound = np.inf if pd.isna(bound) or abs(bound) >= 1e20 else bound
 
-    def _add_constraint(
-        self, solver: pywraplp.Solver, lb: float, ub: float, coeffs: List[float], vars_: List[pywraplp.Variable]
-    ) -> pywraplp.Constraint:
+        if status not in (model_builder.SolveStatus.OPTIMAL, model_builder.SolveStatus.FEASIBLE):
+            return None, None, bound
+        return solver.values(model.get_variables()).to_numpy(), solver.objective_value, bound
+
+    @staticmethod
+    def _build_model(
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rows: npt.NDArray[int],
+        cols: npt.NDArray[int],
+        constraints: scipy.sparse.csr_matrix,
+        num_triangle_constraints: int,
+        hint: Optional[npt.NDArray[float]],
+    ) -> model_builder.Model:
         # pylint: disable = R0913
         """
-        Utility for adding constraints in the Google OR-Tools framework. Adds single constraint on the form:
-        lb <= c_1x_1 + c_2x_2 + ... <= ub
-        :param solver: The OR-Tools solver.
-        :param lb: Lower bound.
-        :param ub: Upper bound.
-        :param coeffs: A list of coefficients. Each index must correspond to the same index in vars_.
-        :param vars_: A list of decision variables. Each index must correspond to the same index in coeffs.
-        :return: The OR-Tools constraint.
+        Build the model.
+        :param distance_matrix: The distance matrix.
+        :param num_groups: Number of anti-clusters.
+        :param rows: First element of the pair of each variable.
+        :param cols: Second element of the pair of each variable.
+        :param constraints: Cluster assignment constraints followed by a cluster size constraint for each element.
+        :param num_triangle_constraints: Number of cluster assignment constraints.
+        :param hint: Optional starting value of each variable.
+        :return: The model.
+        """
+        num_elements = len(distance_matrix)
+        min_group_size = np.floor(num_elements / num_groups)
+        max_group_size = np.ceil(num_elements / num_groups)
+
+        model = model_builder.Model()
+        # Maximise internal anti-cluster distance
+        model.helper.fill_model_from_sparse_data(
+            variable_lower_bound=np.zeros(len(rows)),
+            variable_upper_bound=np.ones(len(rows)),
+            objective_coefficients=np.asarray(distance_matrix[rows, cols], dtype=np.float64),
+            constraint_lower_bounds=np.concatenate(
+                (np.full(num_triangle_constraints, -np.inf), np.full(num_elements, min_group_size - 1.0))
+            ),
+            constraint_upper_bounds=np.concatenate(
+                (np.ones(num_triangle_constraints), np.full(num_elements, max_group_size - 1.0))
+            ),
+            constraint_matrix=constraints,
+        )
+        model.helper.set_maximize(True)
+        # Variables created in bulk by the model builder cannot be referenced by the sparse constraint matrix, so
+        # integrality and hints are applied to all variables in a single pass of the compiled setters.
+        variables = range(len(rows))
+        collections.deque(map(model.helper.set_var_integrality, variables, itertools.repeat(True)), maxlen=0)
+        if hint is not None:
+            collections.deque(map(model.helper.add_hint, variables, hint.tolist()), maxlen=0)
+        return model
+
+    def _get_solver_parameters(self) -> List[str]:
+        """
+        Get solver specific parameters for the relative gap and number of search workers.
+        :return: Parameters in the format of the solver.
+        """
+        parameters = []
+        if self.relative_gap is not None:
+            parameters.append(self._RELATIVE_GAP_PARAMETERS[self.solver_id.upper()].format(self.relative_gap))
+        if self.solver_id.upper() in ("CP_SAT", "SAT"):
+            parameters.append(f"num_workers:{effective_n_jobs(self.n_jobs)}")
+        return parameters
+
+    def _get_hint(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, rows: npt.NDArray[int], cols: npt.NDArray[int]
+    ) -> npt.NDArray[float]:
+        """
+        Get values of pair variables from the solution of the warm start algorithm.
+        :param distance_matrix: The distance matrix.
+        :param num_groups: Number of anti-clusters.
+        :param rows: First element of each pair.
+        :param cols: Second element of each pair.
+        :return: 1 for each pair in the same anti-cluster, 0 otherwise.
+        """
+        # pylint: disable = W0212
+        cluster_assignment = self.warm_start._solve(distance_matrix=distance_matrix, num_groups=num_groups)
+        if cluster_assignment.ndim == 2:
+            return np.asarray(cluster_assignment[rows, cols], dtype=np.float64)
+        return (cluster_assignment[rows] == cluster_assignment[cols]).astype(np.float64)
+
+    @staticmethod
+    def _get_preclusters(distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[int]:
+        """
+        Partition elements into preclusters of num_groups similar elements (the last one possibly smaller). Repeatedly,
+        the element farthest from all remaining elements is grouped with its nearest remaining neighbours.
+        :param distance_matrix: The distance matrix.
+        :param num_groups: Number of anti-clusters, i.e. the size of preclusters.
+        :return: The precluster of each element.
         """
-        constr: pywraplp.Constraint = solver.Constraint(lb, ub)
+        num_elements = len(distance_matrix)
+        preclusters = np.empty(num_elements, dtype=np.intp)
+        remaining = np.ones(num_elements, dtype=bool)
+        distance_to_remaining = np.asarray(distance_matrix.sum(axis=1, dtype=np.float64))
 
-        for coeff, var in zip(coeffs, vars_):
-            constr.SetCoefficient(var, coeff)
+        for precluster in range(-(-num_elements // num_groups)):
+            candidates = np.flatnonzero(remaining)
+            seed = candidates[np.argmax(distance_to_remaining[candidates])]
+            distances = np.asarray(distance_matrix[seed, candidates], dtype=np.float64)
+            distances[candidates == seed] = -np.inf
+            members = candidates[np.argsort(distances, kind="stable")[:num_groups]]
 
-        return constr
+            preclusters[members] = precluster
+            remaining[members] = False
+            distance_to_remaining -= distance_matrix[members].sum(axis=0, dtype=np.float64)
+
+        return preclusters
+
+    @staticmethod
+    def _get_farthest_pairs(
+        distance_matrix: npt.NDArray[float], num_groups: int, rows: npt.NDArray[int], cols: npt.NDArray[int]
+    ) -> npt.NDArray[float]:
+        """
+        Pair each element with the elements farthest from it, as many as fit in an anti-cluster.
+        :param distance_matrix: The distance matrix.
+        :param num_groups: Number of anti-clusters.
+        :param rows: First element of the pair of each variable.
+        :param cols: Second element of the pair of each variable.
+        :return: 1 for each variable of a pair where one element is among the farthest of the other, 0 otherwise.
+        """
+        num_elements = len(distance_matrix)
+        num_partners = min(int(np.ceil(num_elements / num_groups)) - 1, num_elements - 1)
+        farthest = np.zeros((num_elements, num_elements), dtype=bool)
+        if num_partners > 0:
+            partners = np.argpartition(-np.asarray(distance_matrix, dtype=np.float64), num_partners - 1, axis=1)
+            farthest[np.arange(num_elements)[:, None], partners[:, :num_partners]] = True
+        return (farthest[rows, cols] | farthest[cols, rows]).astype(np.float64)
+
+    @staticmethod
+    def _get_triangle_constraints(
+        num_elements: int, variables: npt.NDArray[int], values: Optional[npt.NDArray[float]] = None
+    ) -> scipy.sparse.csr_matrix:
+        """
+        Build the transitivity constraints of all triples of elements i < j < k as a sparse matrix over pair variables.
+        Each triple gives three constraints on the form x_ij + x_ik + x_jk - 2x_ab <= 1 for each pair ab of the triple,
+        i.e. if two pairs are in the same anti-cluster, so is the third.
+        Pairs without a variable are fixed to not be in the same anti-cluster. Constraints where such a pair has a
+        positive coefficient always hold, so they are left out.
+        :param num_elements: Number of elements.
+        :param variables: Variable index of each pair in row-major upper triangular order, or -1 if it has no variable.
+        :param values: If given, only constraints violated by these variable values are built.
+        :return: Sparse constraint matrix with a column per variable.
+        """
+
+        # Index of pair (i, j), i < j, in row-major upper triangular order.
+        def pair_index(i, j):
+            return i * (2 * num_elements - i - 1) // 2 + j - i - 1
+
+        # Pairs without a variable have the value 0, stored last.
+        pair_values = None if values is None else np.append(values, 0.0)
+
+        constraint_rows, constraint_cols, coefficients = [], [], []
+        num_constraints = 0
+        for k in range(2, num_elements):
+            i, j = np.triu_indices(k, k=1)
+            triples = variables[np.column_stack((pair_index(i, j), pair_index(i, k), pair_index(j, k)))]
+            for negative in range(3):
+                positive = [pair for pair in range(3) if pair != negative]
+                keep = (triples[:, positive] >= 0).all(axis=1)
+                if pair_values is not None:
+                    triple_values = pair_values[triples]
+                    keep &= triple_values[:, positive].sum(axis=1) - triple_values[:, negative] > 1.5
+                kept = triples[keep]
+                coefficient = np.ones(3)
+                coefficient[negative] = -1.0
+
+                nonzero = kept.ravel() >= 0
+                constraint_rows.append(np.repeat(np.arange(num_constraints, num_constraints + len(kept)), 3)[nonzero])
+                constraint_cols.append(kept.ravel()[nonzero])
+                coefficients.append(np.tile(coefficient, len(kept))[nonzero])
+                num_constraints += len(kept)
+
+        return scipy.sparse.csr_matrix(
+            (
+                np.concatenate(coefficients) if coefficients else np.empty(0),
+                (
+                    np.concatenate(constraint_rows) if constraint_rows else np.empty(0, dtype=np.intp),
+                    np.concatenate(constraint_cols) if constraint_cols else np.empty(0, dtype=np.intp),
+                ),
+            ),
+            shape=(num_constraints, int((variables >= 0).sum())),
+        )
@@ -19,65 +19,241 @@ Papenberg, M., & Klau, G. W. (2021). Using anticlustering to partition data sets
 Psychological Methods, 26(2), 161–174. https://doi.org/10.1037/met0000301
 """
 
+import itertools
+from typing import Callable, Optional, Tuple
+import numpy as np
 import numpy.typing as npt
-from anti_clustering._cluster_swap_heuristic import ClusterSwapHeuristic
+import scipy.sparse
+from anti_clustering._cluster_state import ClusterState
+from anti_clustering._cluster_swap_heuristic import RestartHeuristic
+from anti_clustering._early_stopping import EarlyStopping
+from anti_clustering._kernels import run_exchange_pass, use_numba
 
 
-class ExchangeHeuristicAntiClustering(ClusterSwapHeuristic):
+class ExchangeHeuristicAntiClustering(RestartHeuristic):
     """
     The exchange heuristic to solving the anti-clustering problem.
+
+    Each pass goes through all elements and swaps each with the element in another anti-cluster giving the largest
+    improvement of the objective value, if any. By default a restart makes a single pass. With max_passes, passes are
+    repeated, and with max_passes=None until a local optimum is reached, where no swap improves the objective value.
+    After the first pass, elements are skipped until they are part of a swap again (don't-look bits). Once all elements
+    are skipped, a full pass confirms the local optimum or resumes the search.
+
+    With improvement="first", an element is swapped with the first improving element in random order, instead of the
+    best. As all swaps of an element are evaluated at once, this costs the same per element, but takes smaller steps
+    and can reach different local optima.
+
+    With backend "numba", or "auto" if Numba is installed, passes run as compiled kernels if there are no callbacks,
+    giving the same results as the pure Python implementation ("python", default) for a given random_seed. The
+    kernels are compiled before the time limit starts, which takes seconds the first time and is cached on disk.
     """
 
-    def __init__(self, verbose: bool = False, random_seed: int = None, restarts: int = 9):
-        super().__init__(verbose=verbose, random_seed=random_seed)
-        self.restarts = restarts
+    _IMPROVEMENTS = ("best", "first")
+    # Swaps must improve the objective value by more than this fraction, so rounding errors cannot make passes cycle.
+    _MIN_RELATIVE_IMPROVEMENT = 1e-12
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        random_seed: int = None,
+        restarts: int = 9,
+        max_passes: Optional[int] = 1,
+        improvement: str = "best",
+        backend: str = "python",
+        **kwargs,
+    ):
+        super().__init__(verbose=verbose, random_seed=random_seed, restarts=restarts, backend=backend, **kwargs)
+        if max_passes is not None and max_passes < 1:
+            raise ValueError(f"max_passes must be at least 1, got {max_passes}.")
+        if improvement not in self._IMPROVEMENTS:
+            raise ValueError(f"Unknown improvement: {improvement}. Must be one of {self._IMPROVEMENTS}.")
+        self.max_passes = max_passes
+        self.improvement = improvement
 
-    def _solve(self, distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[bool]:
+    def _restart(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        report: Optional[Callable[..., None]] = None,
+        deadline: Optional[float] = None,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> Tuple[float, npt.NDArray[int]]:
+        # pylint: disable = R0913
         # Starts with random cluster assignment
-        cluster_assignment = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
+        cluster_state = self._get_initial_clusters(
+            distance_matrix=distance_matrix, num_groups=num_groups, rng=rng, strata=strata
+        )
 
-        if self.verbose:
-            print("Solving")
+        num_elements = distance_matrix.shape[0]
+        # Don't-look bits of elements without an improving swap, with the margin by which their best swap missed
+        dont_look = np.zeros(num_elements, dtype=bool)
+        margin = np.zeros(num_elements)
+        early_stopping = self._get_early_stopping(cluster_state.objective, deadline)
+        iteration = num_accepted = 0
 
-        candidate_solutions = []
+        def report_evaluation(accepted: bool) -> None:
+            nonlocal iteration, num_accepted
+            num_accepted += accepted
+            report(
+                iteration=iteration,
+                objective=cluster_state.objective,
+                best_objective=cluster_state.objective,
+                accepted=num_accepted,
+                rejected=iteration + 1 - num_accepted,
+            )
+            iteration += 1
 
-        for restart in range(self.restarts):
-            # Initial objective value
-            current_objective = self._calculate_objective(cluster_assignment, distance_matrix)
-            for i in range(len(distance_matrix)):
-                if self.verbose and i % 5 == 0:
-                    print(f"Iteration {i + 1} of {len(distance_matrix)}")
+        for _ in itertools.count() if self.max_passes is None else range(self.max_passes):
+            full_pass = not dont_look.any()
+            active = np.flatnonzero(~dont_look)
+            # Uniformly distributed random numbers in [0, 1) choosing among improving swaps, one for each element
+            choices = rng.random(len(active)) if self.improvement == "first" else np.zeros(len(active))
 
-                # Get list of possible swaps
-                exchange_indices = self._get_exchanges(cluster_assignment, i)
+            if report is None and use_numba(self.backend, distance_matrix):
+                improved, stop = run_exchange_pass(
+                    cluster_state=cluster_state,
+                    distance_matrix=distance_matrix,
+                    active=active,
+                    choices=choices,
+                    first_improvement=self.improvement == "first",
+                    min_relative_improvement=self._MIN_RELATIVE_IMPROVEMENT,
+                    dont_look=dont_look,
+                    margin=margin,
+                    track_dont_look=self.max_passes != 1,
+                    early_stopping=early_stopping,
+                )
+            else:
+                improved, stop = self._pass(
+                    cluster_state=cluster_state,
+                    distance_matrix=distance_matrix,
+                    active=active,
+                    choices=choices,
+                    dont_look=dont_look,
+                    margin=margin,
+                    report=report_evaluation if report is not None else None,
+                    early_stopping=early_stopping,
+                )
 
-                if len(exchange_indices) == 0:
-                    continue
+            if stop:
+                break
+            if not improved:
+                if full_pass:
+                    # Local optimum
+                    break
+                dont_look[:] = False
 
-                # Calculate objective value for all possible swaps.
-                # List contains tuples of obj. val. and swapped element index.
-                exchanges = [
-                    (self._calculate_objective(self._swap(cluster_assignment, i, j), distance_matrix), j)
-                    for j in exchange_indices
-                ]
+        return cluster_state.objective, cluster_state.labels
 
-                # Find best swap
-                best_exchange = max(exchanges)
+    def _pass(
+        self,
+        cluster_state: ClusterState,
+        distance_matrix: npt.NDArray[float],
+        active: npt.NDArray[int],
+        choices: npt.NDArray[float],
+        dont_look: npt.NDArray[bool],
+        margin: npt.NDArray[float],
+        report: Optional[Callable[[bool], None]],
+        early_stopping: EarlyStopping,
+    ) -> Tuple[bool, bool]:
+        # pylint: disable = R0913
+        """
+        Make a pass over the active elements, updating the solution in place.
+        :param cluster_state: The current solution.
+        :param distance_matrix: The distance matrix of elements.
+        :param active: The elements to look at, in order.
+        :param choices: Uniformly distributed random number in [0, 1) choosing among improving swaps of each element with
+        first improvement.
+        :param dont_look: Don't-look bits, updated in place.
+        :param margin: Margins of elements with don't-look bits, updated in place.
+        :param report: If given, called after each element with whether it was swapped.
+        :param early_stopping: Stopping criteria.
+        :return: Whether a swap was made, and whether to stop.
+        """
+        improved = False
+        for i, choice in zip(active.tolist(), choices.tolist()):
+            min_improvement = self._MIN_RELATIVE_IMPROVEMENT * abs(cluster_state.objective)
+            j, delta = self._find_swap(cluster_state=cluster_state, i=i, min_improvement=min_improvement, choice=choice)
 
-                # If best swap is better than current objective value then complete swap
-                if best_exchange[0] > current_objective:
-                    cluster_assignment = self._swap(cluster_assignment, i, best_exchange[1])
-                    current_objective = best_exchange[0]
+            # If the swap improves the objective value then complete swap
+            accepted = delta > min_improvement
+            if accepted:
+                if self.max_passes != 1:
+                    self._update_dont_look_bits(
+                        distance_matrix=distance_matrix,
+                        cluster_state=cluster_state,
+                        i=i,
+                        j=j,
+                        dont_look=dont_look,
+                        margin=margin,
+                    )
+                cluster_state.swap(i, j, delta=delta)
+                improved = True
+            else:
+                dont_look[i] = True
+                margin[i] = min_improvement - delta
 
-            candidate_solutions.append((current_objective, cluster_assignment))
+            if report is not None:
+                report(accepted)
 
-            if self.verbose:
-                print(f"Restart {restart + 1} of {self.restarts}")
+            if early_stopping.update(cluster_state.objective):
+                return improved, True
 
-            # Cold restart, select random cluster assignment
-            cluster_assignment = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
+        return improved, False
 
-        # Select best solution, maximizing objective
-        _, best_cluster_assignment = max(candidate_solutions, key=lambda x: x[0])
+    def _find_swap(
+        self, cluster_state: ClusterState, i: int, min_improvement: float, choice: float
+    ) -> Tuple[int, float]:
+        """
+        Find the swap of element i to make, using the improvement strategy.
+        :param cluster_state: The current anti-clusters.
+        :param i: Element.
+        :param min_improvement: Change in objective value above which a swap is an improvement.
+        :param choice: Uniformly distributed random number in [0, 1) choosing among improving swaps with first
+        improvement.
+        :return: The element to swap with and the change in objective value. If no swap improves the objective value,
+        the best swap.
+        """
+        # Calculate change in objective value for all possible swaps at once, and find best swap
+        deltas = cluster_state.swap_deltas(i)
+        j = int(np.argmax(deltas))
+        if self.improvement == "first" and deltas[j] > min_improvement:
+            improving = np.flatnonzero(deltas > min_improvement)
+            j = int(improving[int(choice * len(improving))])
+        return j, float(deltas[j])
 
-        return best_cluster_assignment
+    @staticmethod
+    def _update_dont_look_bits(
+        distance_matrix: npt.NDArray[float],
+        cluster_state: ClusterState,
+        i: int,
+        j: int,
+        dont_look: npt.NDArray[bool],
+        margin: npt.NDArray[float],
+    ) -> None:
+        # pylint: disable = R0913
+        """
+        Clear don't-look bits of elements whose swaps may improve after swapping elements i and j. The swap changes the
+        summed distances from element k to the two anti-clusters involved by |d(k, i) - d(k, j)|, which changes the
+        part of the swap deltas of k depending on its own distances by at most four times as much if k is in one of
+        these anti-clusters, and twice as much otherwise. Once these changes exceed the margin of k, its bit is cleared.
+        The part depending on the other element of a swap is not bounded, so a local optimum is confirmed by a full
+        pass.
+        :param distance_matrix: The distance matrix of elements.
+        :param cluster_state: The anti-clusters before the swap.
+        :param i: Element.
+        :param j: Element to swap with.
+        :param dont_look: Don't-look bits, updated in place.
+        :param margin: Margins of elements with don't-look bits, updated in place.
+        :return:
+        """
+        if scipy.sparse.issparse(distance_matrix):
+            change = np.abs((distance_matrix[i] - distance_matrix[j]).toarray().ravel().astype(np.float64))
+        else:
+            change = np.abs(np.subtract(distance_matrix[i], distance_matrix[j], dtype=np.float64))
+        labels = cluster_state.labels
+        in_swapped_groups = (labels == labels[i]) | (labels == labels[j])
+        margin -= np.where(in_swapped_groups, 4.0, 2.0) * change
+        dont_look[margin < 0] = False
+        dont_look[[i, j]] = False
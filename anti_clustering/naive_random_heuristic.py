@@ -15,29 +15,91 @@
 The naive randomized way of solving the anti-clustering problem.
 """
 
+import itertools
+from typing import Optional
+import numpy as np
 import numpy.typing as npt
+from anti_clustering.callbacks import IterationInfo
 from anti_clustering._cluster_swap_heuristic import ClusterSwapHeuristic
+from anti_clustering._distance import DEFAULT_SCRATCH_BYTES
+from anti_clustering._early_stopping import get_deadline
 
 
 class NaiveRandomHeuristicAntiClustering(ClusterSwapHeuristic):
     """
-    The naive randomized way of solving the anti-clustering problem.
+    The naive randomized way of solving the anti-clustering problem: the best of iterations + 1 random solutions.
+    With time_limit or stagnation_limit, generating solutions also stops at the time limit, or once stagnation_limit
+    consecutive solutions do not improve on the best one. With iterations None, solutions are generated until one of
+    these happens.
     """
 
-    def __init__(self, verbose: bool = False, random_seed: int = None, iterations: int = 1000):
-        super().__init__(verbose=verbose, random_seed=random_seed)
+    def __init__(
+        self,
+        verbose: bool = False,
+        random_seed: int = None,
+        iterations: Optional[int] = 1000,
+        **kwargs,
+    ):
+        super().__init__(verbose=verbose, random_seed=random_seed, **kwargs)
+        if iterations is None and self.time_limit is None and self.stagnation_limit is None:
+            raise ValueError("iterations can only be None with a time_limit or stagnation_limit.")
         self.iterations = iterations
 
-    def _solve(self, distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[bool]:
-        best_candidate = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
-        best_objective = self._calculate_objective(best_candidate, distance_matrix)
+    def _solve(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, strata: Optional[npt.NDArray[int]] = None
+    ) -> npt.NDArray[int]:
+        rng = np.random.default_rng(self.random_seed)
 
-        for _ in range(self.iterations):
-            candidate = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
-            objective = self._calculate_objective(candidate, distance_matrix)
+        best_candidate = None
+        best_objective = -np.inf
+        callbacks = self._get_callbacks()
+        early_stopping = self._get_early_stopping(best_objective, get_deadline(self.time_limit))
+        num_accepted = 0
 
-            if objective > best_objective:
-                best_candidate = candidate
-                best_objective = objective
+        # Candidates are generated and evaluated in batches, bounded by the size of their one-hot encoding.
+        # Without iterations, batches are generated until stopped early.
+        batch_size = max(1, DEFAULT_SCRATCH_BYTES // (8 * num_groups * distance_matrix.shape[0]))
+        num_candidates = None if self.iterations is None else self.iterations + 1
+        starts = itertools.count(0, batch_size) if num_candidates is None else range(0, num_candidates, batch_size)
+        for start in starts:
+            candidates = self._get_initial_labels(
+                distance_matrix=distance_matrix,
+                num_groups=num_groups,
+                rng=rng,
+                size=batch_size if num_candidates is None else min(batch_size, num_candidates - start),
+                strata=strata,
+            )
+            objectives = self._calculate_objectives(
+                labels=candidates, distance_matrix=distance_matrix, num_groups=num_groups
+            )
+
+            # Candidates are visited in order, such that stopping early does not depend on the batch size.
+            stop = False
+            for offset, objective in enumerate(objectives.tolist()):
+                if objective > best_objective:
+                    best_candidate, best_objective = candidates[offset], objective
+                    num_accepted += 1
+
+                if len(callbacks) > 0:
+                    info = IterationInfo(
+                        restart=0,
+                        iteration=start + offset,
+                        objective=objective,
+                        best_objective=best_objective,
+                        accepted=num_accepted,
+                        rejected=start + offset + 1 - num_accepted,
+                    )
+                    for callback in callbacks:
+                        callback.on_iteration(info)
+
+                stop = early_stopping.update(best_objective)
+                if stop:
+                    break
+
+            if stop:
+                break
+
+        for callback in callbacks:
+            callback.on_restart_end(0, best_objective)
 
         return best_candidate
@@ -0,0 +1,380 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Online assignment of rows arriving after the anti-clusters have been formed.
+"""
+
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler
+from anti_clustering._base import AntiClustering
+from anti_clustering._distance import weight_features
+
+
+class OnlineAntiClustering:
+    # pylint: disable = R0902
+    """
+    Online assignment of rows arriving after the anti-clusters have been formed.
+
+    The initial dataset is anti-clustered by the wrapped algorithm. Afterwards only the fitted scaler, the labels and
+    per anti-cluster feature aggregates are kept: element count, sum of features, sum of squared feature norms and
+    category counts. From these the summed squared Euclidean or cosine distance and summed Hamming distance from a new
+    row to all members of an anti-cluster are computed without a distance matrix, in O(K) per row. New rows are
+    assigned greedily to the smallest anti-cluster they are most dissimilar to, which keeps anti-cluster sizes
+    balanced, within their stratum if the initial run was stratified.
+
+    Optionally, the newly assigned rows are periodically revisited by an exchange pass on the same aggregate-based
+    objective, swapping them with any earlier row if that increases the diversity within anti-clusters. Such a pass
+    also changes the anti-cluster of rows returned by earlier calls. The current labels of all rows are given by
+    labels, and reoptimize returns which rows moved.
+    """
+
+    _METRICS = ("euclidean", "cosine")
+
+    def __init__(self, algorithm: AntiClustering, reoptimize_every: Optional[int] = None):
+        """
+        Initialize online anti-clustering.
+        :param algorithm: The algorithm used to anti-cluster the initial dataset.
+        :param reoptimize_every: If set, run a re-optimization pass once this many rows have been assigned since the
+        last pass.
+        """
+        self.algorithm = algorithm
+        self.reoptimize_every = reoptimize_every
+
+        self._numerical_columns: List[str] = []
+        self._categorical_columns: List[str] = []
+        self._stratify_columns: List[str] = []
+        self._metric = "euclidean"
+        self._numerical_weights: Optional[npt.NDArray[float]] = None
+        self._categorical_weights = np.empty(0)
+        self._destination_column: Optional[str] = None
+        self._scaler: Optional[MinMaxScaler] = None
+        self._categories: List[pd.Index] = []
+        self._strata_index = pd.Index([])
+
+        # Features and labels of all rows seen so far. Arrays are over-allocated to make appending cheap.
+        self._size = 0
+        self._features = np.empty((0, 0))
+        self._codes = np.empty((0, 0), dtype=np.intp)
+        self._labels = np.empty(0, dtype=np.intp)
+        self._strata = np.empty(0, dtype=np.intp)
+        self._pending = 0
+
+        # Per anti-cluster aggregates.
+        self._counts = np.empty(0, dtype=np.intp)
+        self._feature_sums = np.empty((0, 0))
+        self._squared_norm_sums = np.empty(0)
+        self._category_counts: List[npt.NDArray[int]] = []
+        self._stratum_counts = np.empty((0, 0), dtype=np.intp)
+
+    @property
+    def labels(self) -> npt.NDArray[int]:
+        """
+        The current anti-cluster labels of all rows seen so far, in the order they were added.
+        """
+        return self._labels[: self._size].copy()
+
+    def run(
+        self,
+        df: pd.DataFrame,
+        numerical_columns: Optional[List[str]],
+        categorical_columns: Optional[List[str]],
+        num_groups: int,
+        destination_column: str,
+        metric: str = "euclidean",
+        weights: Optional[Dict[str, float]] = None,
+        stratify_columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        # pylint: disable = R0913
+        """
+        Run the wrapped anti-clustering algorithm on the initial dataset and keep the state for assigning new rows.
+        :param df: The dataset to run anti-clustering on.
+        :param numerical_columns: Columns in dataset to use for anti-clustering containing numbers.
+        :param categorical_columns: Columns in dataset to use for anti-clustering containing strings or dates.
+        :param num_groups: Number of anti-clusters to generate.
+        :param destination_column: The column to write results to.
+        :param metric: The distance between elements, "euclidean" or "cosine". New rows are scored with the squared
+        Euclidean distance for "euclidean". The Gower distance cannot be computed from aggregates and is not supported.
+        :param weights: Optional weight of each column. Columns not included have weight 1.
+        :param stratify_columns: Optional columns whose combinations of values are spread evenly over the anti-clusters,
+        also when assigning new rows.
+        :return: The original dataframe with a destination_column added.
+        """
+        if metric not in self._METRICS:
+            raise ValueError(f"Unknown metric: {metric}. Must be one of {self._METRICS}.")
+
+        self._numerical_columns = [] if numerical_columns is None else numerical_columns
+        self._categorical_columns = [] if categorical_columns is None else categorical_columns
+        self._stratify_columns = [] if stratify_columns is None else stratify_columns
+        self._destination_column = destination_column
+        self._metric = metric
+
+        result = self.algorithm.run(
+            df=df,
+            numerical_columns=self._numerical_columns,
+            categorical_columns=self._categorical_columns,
+            num_groups=num_groups,
+            destination_column=destination_column,
+            metric=metric,
+            weights=weights,
+            stratify_columns=stratify_columns,
+        )
+
+        # Same normalization and weighting as the wrapped algorithm, kept for transforming new rows.
+        weights = {} if weights is None else weights
+        self._scaler = MinMaxScaler().fit(df[self._numerical_columns]) if len(self._numerical_columns) > 0 else None
+        self._numerical_weights = np.array([weights.get(column, 1.0) for column in self._numerical_columns])
+        categorical_weights = np.array([weights.get(column, 1.0) for column in self._categorical_columns])
+        total_weight = categorical_weights.sum()
+        self._categorical_weights = categorical_weights / total_weight if total_weight > 0 else categorical_weights
+        self._categories = [pd.Index([]) for _ in self._categorical_columns]
+        self._strata_index = pd.Index([])
+
+        self._counts = np.zeros(num_groups, dtype=np.intp)
+        self._category_counts = [np.zeros((num_groups, 0), dtype=np.intp) for _ in self._categorical_columns]
+        self._stratum_counts = np.zeros((num_groups, 0), dtype=np.intp)
+        self._features, self._codes, self._strata = self._encode(df)
+        self._labels = result[destination_column].to_numpy(dtype=np.intp)
+        self._size = len(df)
+        self._pending = 0
+
+        # Aggregates of all initial rows at once.
+        labels = self._labels
+        self._counts = np.bincount(labels, minlength=num_groups)
+        self._feature_sums = np.zeros((num_groups, self._features.shape[1]))
+        np.add.at(self._feature_sums, labels, self._features)
+        self._squared_norm_sums = np.bincount(
+            labels, weights=np.einsum("ij,ij->i", self._features, self._features), minlength=num_groups
+        )
+        for c, category_counts in enumerate(self._category_counts):
+            np.add.at(category_counts, (labels, self._codes[:, c]), 1)
+        np.add.at(self._stratum_counts, (labels, self._strata), 1)
+
+        return result
+
+    def assign(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Assign new rows to the existing anti-clusters. Rows are assigned one at a time, in O(K) each.
+
+        If this triggers a re-optimization pass, rows returned by run or earlier calls may move to another anti-cluster
+        as well. Their current anti-clusters are given by labels.
+        :param df: The new rows. Must contain the columns used in run.
+        :return: The new rows with the destination column added.
+        """
+        if self._destination_column is None:
+            raise ValueError("run must be called before assigning new rows.")
+
+        features, codes, strata = self._encode(df)
+        first = self._size
+
+        for i in range(len(df)):
+            # Only the currently smallest anti-clusters of the row's stratum are eligible, and among those the smallest
+            # overall, such that sizes differ by at most one.
+            stratum_counts = self._stratum_counts[:, strata[i]]
+            eligible = stratum_counts == stratum_counts.min()
+            eligible &= self._counts == self._counts[eligible].min()
+            scores = self._distance_to_groups(features[i : i + 1], codes[i : i + 1])[0]
+            scores[~eligible] = -np.inf
+            self._add(features[i], codes[i], strata[i], int(np.argmax(scores)))
+
+        self._pending += len(df)
+        if self.reoptimize_every is not None and self._pending >= self.reoptimize_every:
+            self.reoptimize()
+
+        return df.assign(**{self._destination_column: self._labels[first : self._size]})
+
+    def reoptimize(self) -> npt.NDArray[int]:
+        """
+        Run an exchange pass over the rows assigned since the last pass. Each of them is swapped with the row in another
+        anti-cluster of the same stratum that increases the objective the most, if any. The swap partner can be any
+        earlier row, so rows returned before may change anti-cluster too. Costs O(N) per revisited row.
+        :return: Positions of the rows that changed anti-cluster, in the order rows were added as in labels.
+        """
+        size = self._size
+        features, codes, labels = self._features[:size], self._codes[:size], self._labels[:size]
+        strata = self._strata[:size]
+        initial_labels = labels.copy()
+
+        # Summed distance from every row to every anti-cluster, kept up to date during the pass. These sums include the
+        # distance of rows to themselves, which is not zero for the cosine distance of all-zero rows.
+        distance_to_group = self._distance_to_groups(features, codes)
+        self_distances = self._self_distances(features)
+
+        for i in range(size - self._pending, size):
+            group_i = labels[i]
+            distance_i = self._distance_to_rows(i)
+            deltas = (
+                distance_to_group[i, labels]
+                - distance_to_group[i, group_i]
+                + self_distances[i]
+                + distance_to_group[:, group_i]
+                - distance_to_group[np.arange(size), labels]
+                + self_distances
+                - 2.0 * distance_i
+            )
+            deltas[(labels == group_i) | (strata != strata[i])] = -np.inf
+            j = int(np.argmax(deltas))
+
+            if deltas[j] > 0:
+                group_j = labels[j]
+                distance_j = self._distance_to_rows(j)
+                distance_to_group[:, group_i] += distance_j - distance_i
+                distance_to_group[:, group_j] += distance_i - distance_j
+                self._remove(i)
+                self._remove(j)
+                self._add_to_group(i, group_j)
+                self._add_to_group(j, group_i)
+
+        self._pending = 0
+        return np.flatnonzero(labels != initial_labels)
+
+    def _encode(self, df: pd.DataFrame) -> Tuple[npt.NDArray[float], npt.NDArray[int], npt.NDArray[int]]:
+        """
+        Scale and weight numerical columns, and encode categorical columns and strata as integer codes. Unseen
+        categories and strata get new codes.
+        :param df: The rows to encode.
+        :return: The scaled features, category codes and strata.
+        """
+        features = np.empty((len(df), 0))
+        if self._scaler is not None:
+            features, _, _ = weight_features(
+                numerical_data=self._scaler.transform(df[self._numerical_columns]),
+                categorical_data=None,
+                metric=self._metric,
+                numerical_weights=self._numerical_weights,
+                categorical_weights=None,
+            )
+
+        codes = np.empty((len(df), len(self._categorical_columns)), dtype=np.intp)
+        for c, column in enumerate(self._categorical_columns):
+            unseen = pd.Index(df[column].unique()).difference(self._categories[c], sort=False)
+            if len(unseen) > 0:
+                self._categories[c] = self._categories[c].append(unseen)
+                self._category_counts[c] = np.pad(self._category_counts[c], ((0, 0), (0, len(unseen))))
+            codes[:, c] = self._categories[c].get_indexer(df[column])
+
+        # Without columns to stratify by, all rows are in a single stratum.
+        keys = pd.MultiIndex.from_frame(df[self._stratify_columns]).to_flat_index() if self._stratify_columns else None
+        keys = pd.Index(np.zeros(len(df), dtype=np.intp)) if keys is None else keys
+        unseen = keys.unique().difference(self._strata_index, sort=False)
+        if len(unseen) > 0:
+            self._strata_index = unseen if len(self._strata_index) == 0 else self._strata_index.append(unseen)
+            self._stratum_counts = np.pad(self._stratum_counts, ((0, 0), (0, len(unseen))))
+        strata = self._strata_index.get_indexer(keys).astype(np.intp)
+
+        return features, codes, strata
+
+    def _distance_to_groups(self, features: npt.NDArray[float], codes: npt.NDArray[int]) -> npt.NDArray[float]:
+        """
+        Calculate the summed distance from rows to all members of each anti-cluster using the aggregates.
+        :param features: Scaled numerical features of the rows.
+        :param codes: Category codes of the rows.
+        :return: Matrix of summed distances with a row per row and a column per anti-cluster.
+        """
+        if self._scaler is None:
+            distances = np.zeros((len(features), len(self._counts)))
+        elif self._metric == "cosine":
+            # Features are normalized, so sum_j (1 - x . y_j) = n - x . sum_j y_j
+            distances = np.tile(self._counts.astype(float), (len(features), 1))
+            distances -= features @ self._feature_sums.T
+        else:
+            # sum_j |x - y_j|^2 = n |x|^2 - 2 x . sum_j y_j + sum_j |y_j|^2
+            distances = np.outer(np.einsum("ij,ij->i", features, features), self._counts)
+            distances -= 2.0 * features @ self._feature_sums.T
+            distances += self._squared_norm_sums
+
+        # Hamming distance is the weighted fraction of categorical columns in which two rows differ.
+        for c, weight in enumerate(self._categorical_weights):
+            distances += weight * (self._counts - self._category_counts[c][:, codes[:, c]].T)
+
+        return distances
+
+    def _distance_to_rows(self, i: int) -> npt.NDArray[float]:
+        """
+        Calculate the distance from a row to all rows seen so far.
+        :param i: Index of the row.
+        :return: Distances.
+        """
+        features, codes = self._features[: self._size], self._codes[: self._size]
+        if self._scaler is None:
+            distances = np.zeros(self._size)
+        elif self._metric == "cosine":
+            distances = 1.0 - features @ features[i]
+        else:
+            distances = np.square(features - features[i]).sum(axis=1)
+        if len(self._categorical_columns) > 0:
+            distances += (codes != codes[i]) @ self._categorical_weights
+        return distances
+
+    def _self_distances(self, features: npt.NDArray[float]) -> npt.NDArray[float]:
+        """
+        Calculate the distance of rows to themselves as counted by the aggregates.
+        :param features: Scaled numerical features of the rows.
+        :return: Distances, 1 for all-zero rows with cosine distance and 0 otherwise.
+        """
+        if self._scaler is not None and self._metric == "cosine":
+            return 1.0 - np.einsum("ij,ij->i", features, features)
+        return np.zeros(len(features))
+
+    def _add(self, features: npt.NDArray[float], codes: npt.NDArray[int], stratum: int, group: int) -> None:
+        """
+        Append a row and add it to an anti-cluster.
+        :param features: Scaled numerical features of the row.
+        :param codes: Category codes of the row.
+        :param stratum: Stratum of the row.
+        :param group: The anti-cluster.
+        :return:
+        """
+        if self._size == len(self._labels):
+            capacity = max(1, 2 * len(self._labels))
+            self._features = np.resize(self._features, (capacity, self._features.shape[1]))
+            self._codes = np.resize(self._codes, (capacity, self._codes.shape[1]))
+            self._labels = np.resize(self._labels, capacity)
+            self._strata = np.resize(self._strata, capacity)
+
+        self._features[self._size] = features
+        self._codes[self._size] = codes
+        self._strata[self._size] = stratum
+        self._size += 1
+        self._stratum_counts[group, stratum] += 1
+        self._add_to_group(self._size - 1, group)
+
+    def _add_to_group(self, i: int, group: int) -> None:
+        """
+        Add a row to the aggregates of an anti-cluster.
+        :param i: Index of the row.
+        :param group: The anti-cluster.
+        :return:
+        """
+        self._labels[i] = group
+        self._counts[group] += 1
+        self._feature_sums[group] += self._features[i]
+        self._squared_norm_sums[group] += self._features[i] @ self._features[i]
+        for c, category_counts in enumerate(self._category_counts):
+            category_counts[group, self._codes[i, c]] += 1
+
+    def _remove(self, i: int) -> None:
+        """
+        Remove a row from the aggregates of its anti-cluster.
+        :param i: Index of the row.
+        :return:
+        """
+        group = self._labels[i]
+        self._counts[group] -= 1
+        self._feature_sums[group] -= self._features[i]
+        self._squared_norm_sums[group] -= self._features[i] @ self._features[i]
+        for c, category_counts in enumerate(self._category_counts):
+            category_counts[group, self._codes[i, c]] -= 1
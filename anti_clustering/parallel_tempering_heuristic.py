@@ -0,0 +1,317 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A parallel tempering (replica exchange) approach to solving the anti-clustering problem.
+"""
+
+import contextlib
+import math
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+import numpy.typing as npt
+from anti_clustering.callbacks import Callback, IterationInfo
+from anti_clustering._cluster_state import ClusterState
+from anti_clustering._cluster_swap_heuristic import ClusterSwapHeuristic
+from anti_clustering._early_stopping import get_deadline, is_past
+from anti_clustering._parallel import SharedArrays, SharedDistanceMatrixPool, effective_n_jobs
+
+
+class ParallelTemperingHeuristicAntiClustering(ClusterSwapHeuristic):
+    """
+    A parallel tempering (replica exchange) approach to solving the anti-clustering problem.
+    A number of replicas make random swaps with the simulated annealing acceptance function, each at a fixed
+    temperature. Every exchange_interval iterations, replicas at neighbouring temperatures exchange solutions with the
+    Metropolis probability, such that good solutions found at high temperatures move down to low temperatures. If
+    n_jobs allows it, replicas run in a pool of worker processes between exchanges. Replicas are then kept in shared
+    memory, so only objective values and improved solutions are sent between processes. The stagnation limit is checked
+    after each exchange round, counting the iterations since the best solution of all replicas improved.
+
+    Unless temperatures are given, they are calibrated from random swaps of a random solution. Near good solutions,
+    swaps only change the objective slightly, so temperatures are based on the smallest percent of swaps worsening the
+    objective: they are spaced geometrically between a hottest temperature accepting such a swap with probability 1/2
+    and a coldest temperature accepting it with probability 1/100.
+    """
+
+    _HOTTEST_ACCEPTANCE = 0.5
+    _COLDEST_ACCEPTANCE = 0.01
+    _CALIBRATION_QUANTILE = 0.01
+    _CALIBRATION_SAMPLES = 1000
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        random_seed: int = None,
+        num_replicas: int = 8,
+        iterations: int = 2000,
+        exchange_interval: int = 100,
+        temperatures: Optional[Sequence[float]] = None,
+        **kwargs,
+    ):
+        super().__init__(verbose=verbose, random_seed=random_seed, **kwargs)
+        if temperatures is not None and len(temperatures) != num_replicas:
+            raise ValueError(f"Expected {num_replicas} temperatures, got {len(temperatures)}.")
+        self.num_replicas = num_replicas
+        self.iterations = iterations
+        self.exchange_interval = exchange_interval
+        self.temperatures = temperatures
+
+    def _solve(
+        self, distance_matrix: npt.NDArray[float], num_groups: int, strata: Optional[npt.NDArray[int]] = None
+    ) -> npt.NDArray[int]:
+        # pylint: disable = R0914
+        # Seeds of the random streams of replicas are spawned for each round, so results do not depend on n_jobs.
+        seed_sequence = np.random.SeedSequence(self.random_seed)
+        rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+
+        replicas = [
+            self._get_initial_clusters(distance_matrix=distance_matrix, num_groups=num_groups, rng=rng, strata=strata)
+            for _ in range(self.num_replicas)
+        ]
+        temperatures = (
+            np.sort(np.asarray(self.temperatures, dtype=np.float64))
+            if self.temperatures is not None
+            else self._calibrate_temperatures(replicas[0], rng)
+        )
+        best = max(replicas, key=lambda replica: replica.objective)
+        best_objective, best_labels = best.objective, best.labels.copy()
+
+        n_jobs = min(effective_n_jobs(self.n_jobs), self.num_replicas)
+        num_rounds = -(-self.iterations // self.exchange_interval)
+        callbacks = self._get_callbacks()
+        deadline = get_deadline(self.time_limit)
+        early_stopping = self._get_early_stopping(best_objective, deadline)
+        # Replica running at each temperature. Exchanges swap the temperatures of replicas, which stay in place.
+        order = list(range(self.num_replicas))
+        objectives = [replica.objective for replica in replicas]
+        # Number of accepted moves at each temperature.
+        num_accepted = np.zeros(self.num_replicas, dtype=np.int64)
+
+        with contextlib.ExitStack() as stack:
+            if n_jobs > 1:
+                pool = stack.enter_context(SharedDistanceMatrixPool(distance_matrix=distance_matrix, n_jobs=n_jobs))
+                # Updated in place by the workers, leaving the replicas in this process out of date.
+                shared_replicas = [stack.enter_context(SharedArrays(replica.to_arrays())) for replica in replicas]
+
+            for exchange_round in range(num_rounds):
+                iterations = [min(self.exchange_interval, self.iterations - exchange_round * self.exchange_interval)]
+                seeds = seed_sequence.spawn(self.num_replicas)
+                if n_jobs > 1:
+                    results = list(
+                        pool.map(
+                            self._run_shared_replica,
+                            [shared_replicas[r] for r in order],
+                            [objectives[r] for r in order],
+                            temperatures,
+                            iterations * self.num_replicas,
+                            seeds,
+                            [deadline] * self.num_replicas,
+                        )
+                    )
+                else:
+                    results = [
+                        self._run_replica(distance_matrix, replicas[r], temperature, iterations[0], seed, deadline)
+                        for r, temperature, seed in zip(order, temperatures, seeds)
+                    ]
+
+                for r, (objective, replica_best_objective, labels, _) in zip(order, results):
+                    objectives[r] = objective
+                    if labels is not None and replica_best_objective > best_objective:
+                        best_objective, best_labels = replica_best_objective, labels
+                num_accepted += [accepted for _, _, _, accepted in results]
+
+                if len(callbacks) > 0:
+                    self._report_round(
+                        callbacks,
+                        [objectives[r] for r in order],
+                        temperatures,
+                        min(self.iterations, (exchange_round + 1) * self.exchange_interval),
+                        best_objective,
+                        num_accepted,
+                    )
+
+                if early_stopping.update(best_objective, iterations=iterations[0]):
+                    break
+
+                self._exchange_replicas(order, objectives, temperatures, exchange_round % 2, rng)
+
+        return best_labels
+
+    def _calibrate_temperatures(self, cluster_state: ClusterState, rng: np.random.Generator) -> npt.NDArray[float]:
+        """
+        Calibrate temperatures from the change in objective of random swaps.
+        :param cluster_state: A random solution.
+        :param rng: Random generator.
+        :return: Temperatures in increasing order.
+        """
+        elements = rng.integers(0, len(cluster_state), size=self._CALIBRATION_SAMPLES).tolist()
+        exchanges = rng.random(size=self._CALIBRATION_SAMPLES).tolist()
+        deltas = np.array(
+            [
+                cluster_state.swap_delta(i, cluster_state.exchange(i, int(u * cluster_state.num_exchanges(i))))
+                for i, u in zip(elements, exchanges)
+                if cluster_state.num_exchanges(i) > 0
+            ]
+        )
+
+        worsening = -deltas[deltas < 0]
+        if len(worsening) == 0:
+            return np.ones(self.num_replicas)
+
+        # A swap worsening the objective by delta is accepted with probability exp(-delta / temperature).
+        delta = float(np.quantile(worsening, self._CALIBRATION_QUANTILE))
+        return np.geomspace(
+            delta / -math.log(self._COLDEST_ACCEPTANCE),
+            delta / -math.log(self._HOTTEST_ACCEPTANCE),
+            self.num_replicas,
+        )
+
+    def _run_shared_replica(
+        self,
+        distance_matrix: npt.NDArray[float],
+        shared_replica: SharedArrays,
+        objective: float,
+        temperature: float,
+        iterations: int,
+        seed: np.random.SeedSequence,
+        deadline: Optional[float],
+    ) -> Tuple[float, float, Optional[npt.NDArray[int]], int]:
+        # pylint: disable = R0913
+        """
+        Run a replica kept in shared memory at a fixed temperature, in a worker process.
+        :param distance_matrix: The distance matrix of elements.
+        :param shared_replica: The arrays of the solution of the replica. Updated in place.
+        :param objective: The objective value of the solution.
+        :param temperature: Temperature of the replica.
+        :param iterations: Number of iterations.
+        :param seed: Seed of the random stream.
+        :param deadline: Time at which to stop, as returned by get_deadline, or None.
+        :return: As returned by _run_replica.
+        """
+        cluster_state = ClusterState.from_arrays(shared_replica.get(), objective, distance_matrix)
+        return self._run_replica(distance_matrix, cluster_state, temperature, iterations, seed, deadline)
+
+    def _run_replica(
+        self,
+        distance_matrix: npt.NDArray[float],
+        cluster_state: ClusterState,
+        temperature: float,
+        iterations: int,
+        seed: np.random.SeedSequence,
+        deadline: Optional[float],
+    ) -> Tuple[float, float, Optional[npt.NDArray[int]], int]:
+        # pylint: disable = R0913
+        """
+        Run a replica at a fixed temperature.
+        :param distance_matrix: The distance matrix of elements.
+        :param cluster_state: The solution of the replica. Updated in place.
+        :param temperature: Temperature of the replica.
+        :param iterations: Number of iterations.
+        :param seed: Seed of the random stream.
+        :param deadline: Time at which to stop, as returned by get_deadline, or None.
+        :return: The objective value of the solution, the objective value and labels of the best solution found, or
+        None if the solution never improved, and the number of accepted moves.
+        """
+        rng = np.random.default_rng(seed)
+
+        # Random numbers for all iterations are drawn at once: the element, the possible swap and the acceptance.
+        elements = rng.integers(0, distance_matrix.shape[0], size=iterations).tolist()
+        exchanges = rng.random(size=iterations).tolist()
+        # A swap is accepted if delta / temperature >= log(threshold).
+        log_thresholds = (np.log(rng.random(size=iterations)) * temperature).tolist()
+
+        best_objective, best_labels = cluster_state.objective, None
+        num_accepted = 0
+        for iteration in range(iterations):
+            if is_past(deadline):
+                break
+            # Select random element
+            i = elements[iteration]
+            # Get number of possible swaps
+            num_exchanges = cluster_state.num_exchanges(i)
+            if num_exchanges == 0:
+                continue
+            # Select random possible swap.
+            j = cluster_state.exchange(i, int(exchanges[iteration] * num_exchanges))
+
+            delta = cluster_state.swap_delta(i, j)
+
+            # Select solution as current if accepted
+            if delta >= 0 or delta >= log_thresholds[iteration]:
+                cluster_state.swap(i, j, delta=delta)
+                num_accepted += 1
+
+                if cluster_state.objective > best_objective:
+                    best_objective, best_labels = cluster_state.objective, cluster_state.labels.copy()
+
+        return cluster_state.objective, best_objective, best_labels, num_accepted
+
+    def _report_round(
+        self,
+        callbacks: List[Callback],
+        objectives: List[float],
+        temperatures: npt.NDArray[float],
+        iterations: int,
+        best_objective: float,
+        num_accepted: npt.NDArray[int],
+    ) -> None:
+        # pylint: disable = R0913
+        """
+        Report the progress of each temperature after an exchange round to callbacks.
+        :param callbacks: The callbacks.
+        :param objectives: Objective values of the replicas, ordered by temperature.
+        :param temperatures: Temperatures in increasing order.
+        :param iterations: Number of iterations completed by each replica.
+        :param best_objective: Objective value of the best solution found.
+        :param num_accepted: Number of accepted moves at each temperature.
+        :return:
+        """
+        for k in range(self.num_replicas):
+            info = IterationInfo(
+                restart=k,
+                iteration=iterations - 1,
+                objective=objectives[k],
+                best_objective=best_objective,
+                accepted=int(num_accepted[k]),
+                rejected=iterations - int(num_accepted[k]),
+                temperature=float(temperatures[k]),
+            )
+            for callback in callbacks:
+                callback.on_iteration(info)
+
+    def _exchange_replicas(
+        self,
+        order: List[int],
+        objectives: List[float],
+        temperatures: npt.NDArray[float],
+        parity: int,
+        rng: np.random.Generator,
+    ) -> None:
+        # pylint: disable = R0913
+        """
+        Propose exchanging the temperatures of replicas at neighbouring temperatures, alternating between even and odd
+        pairs.
+        :param order: The replica at each temperature. Exchanged in place.
+        :param objectives: Objective value of each replica.
+        :param temperatures: Temperatures in increasing order.
+        :param parity: Whether to start with the first (0) or second (1) replica.
+        :param rng: Random generator.
+        :return:
+        """
+        for k in range(parity, self.num_replicas - 1, 2):
+            # Metropolis criterion for sampling exp(objective / temperature) at both temperatures.
+            log_ratio = (objectives[order[k + 1]] - objectives[order[k]]) * (
+                1.0 / temperatures[k] - 1.0 / temperatures[k + 1]
+            )
+            if log_ratio >= 0 or math.log(rng.random()) < log_ratio:
+                order[k], order[k + 1] = order[k + 1], order[k]
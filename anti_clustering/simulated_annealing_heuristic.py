@@ -16,13 +16,23 @@ A simulated annealing with restarts approach to solving the anti-clustering prob
 """
 
 import math
+from typing import Callable, List, Optional, Tuple
+import numpy as np
 import numpy.typing as npt
-from anti_clustering._cluster_swap_heuristic import ClusterSwapHeuristic
+from anti_clustering._cluster_state import ClusterState
+from anti_clustering._cluster_swap_heuristic import RestartHeuristic
+from anti_clustering._early_stopping import EarlyStopping
+from anti_clustering._kernels import run_simulated_annealing, use_numba
 
 
-class SimulatedAnnealingHeuristicAntiClustering(ClusterSwapHeuristic):
+class SimulatedAnnealingHeuristicAntiClustering(RestartHeuristic):
     """
-    A simulated annealing with restarts approach to solving the anti-clustering problem.
+    A simulated annealing with restarts approach to solving the anti-clustering problem. Each restart returns the best
+    solution it visited, which is not necessarily the last one, e.g. when stopped early at a high temperature.
+
+    With backend "numba", or "auto" if Numba is installed, restarts run as compiled kernels if there are no callbacks,
+    giving the same results as the pure Python implementation ("python", default) for a given random_seed. The
+    kernels are compiled before the time limit starts, which takes seconds the first time and is cached on disk.
     """
 
     def __init__(
@@ -33,69 +43,133 @@ class SimulatedAnnealingHeuristicAntiClustering(ClusterSwapHeuristic):
         iterations: int = 2000,
         starting_temperature: float = 100,
         restarts: int = 9,
+        backend: str = "python",
+        **kwargs,
     ):
-        # pylint: disable = R0913
-        super().__init__(verbose=verbose, random_seed=random_seed)
+        super().__init__(verbose=verbose, random_seed=random_seed, restarts=restarts, backend=backend, **kwargs)
         self.alpha = alpha
         self.iterations = iterations
         self.starting_temperature = starting_temperature
-        self.restarts = restarts
 
-    def _solve(self, distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[bool]:
+    def _restart(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        report: Optional[Callable[..., None]] = None,
+        deadline: Optional[float] = None,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> Tuple[float, npt.NDArray[int]]:
+        # pylint: disable = R0913
         # Start with random cluster assignment
-        cluster_assignment = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
-
-        if self.verbose:
-            print("Solving")
-
-        candidate_solutions = []
-
-        for restart in range(self.restarts):
-            temperature = self.starting_temperature
-            # Initial objective value
-            objective = self._calculate_objective(cluster_assignment, distance_matrix)
-            for iteration in range(self.iterations):
-                if self.verbose and iteration % 5 == 0:
-                    print(f"Iteration {iteration + 1} of {self.iterations}")
-
-                # Select random element
-                i = self.rnd.randint(0, len(distance_matrix) - 1)
-                # Get possible swaps
-                possible_exchanges = self._get_exchanges(cluster_assignment, i)
-                if len(possible_exchanges) == 0:
-                    continue
-                # Select random possible swap.
-                j = possible_exchanges[self.rnd.randint(0, len(possible_exchanges) - 1)]
-
-                new_cluster_assignment = self._swap(cluster_assignment, i, j)
-                new_objective = self._calculate_objective(new_cluster_assignment, distance_matrix)
-
-                # Select solution as current if accepted
-                if self._accept(new_objective - objective, temperature):
-                    objective = new_objective
-                    cluster_assignment = new_cluster_assignment
-
-                # Cool down temperature
-                temperature = temperature * self.alpha
-
-            candidate_solutions.append((objective, cluster_assignment))
-
-            if self.verbose:
-                print(f"Restart {restart + 1} of {self.restarts}")
-
-            # Cold restart, select random cluster assignment
-            cluster_assignment = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
-
-        # Select best solution, maximizing objective
-        _, best_cluster_assignment = max(candidate_solutions, key=lambda x: x[0])
-
-        return best_cluster_assignment
-
-    def _accept(self, delta: float, temperature: float) -> bool:
+        cluster_state = self._get_initial_clusters(
+            distance_matrix=distance_matrix, num_groups=num_groups, rng=rng, strata=strata
+        )
+
+        # Random numbers for all iterations are drawn at once: the element, the possible swap and the acceptance.
+        elements = rng.integers(0, distance_matrix.shape[0], size=self.iterations)
+        exchanges = rng.random(size=self.iterations)
+        thresholds = rng.random(size=self.iterations)
+
+        early_stopping = self._get_early_stopping(cluster_state.objective, deadline)
+        if report is None and use_numba(self.backend, distance_matrix):
+            best_objective, best_labels = run_simulated_annealing(
+                cluster_state=cluster_state,
+                distance_matrix=distance_matrix,
+                elements=elements,
+                exchanges=exchanges,
+                thresholds=thresholds,
+                temperature=self.starting_temperature,
+                alpha=self.alpha,
+                early_stopping=early_stopping,
+            )
+        else:
+            best_objective, best_labels = self._anneal(
+                cluster_state=cluster_state,
+                elements=elements.tolist(),
+                exchanges=exchanges.tolist(),
+                thresholds=thresholds.tolist(),
+                report=report,
+                early_stopping=early_stopping,
+            )
+
+        if best_labels is None:
+            return cluster_state.objective, cluster_state.labels
+        return best_objective, best_labels
+
+    def _anneal(
+        self,
+        cluster_state: ClusterState,
+        elements: List[int],
+        exchanges: List[float],
+        thresholds: List[float],
+        report: Optional[Callable[..., None]],
+        early_stopping: EarlyStopping,
+    ) -> Tuple[float, Optional[npt.NDArray[int]]]:
+        # pylint: disable = R0913
+        """
+        Run the iterations of a restart, updating the solution in place.
+        :param cluster_state: The initial solution.
+        :param elements: The random element of each iteration.
+        :param exchanges: Uniformly distributed random number in [0, 1) selecting the possible swap of each iteration.
+        :param thresholds: Uniformly distributed random number in [0, 1) for the acceptance of each iteration.
+        :param report: If given, called after each iteration.
+        :param early_stopping: Stopping criteria.
+        :return: The objective value of the best solution visited, and its labels, or None if it is the current solution.
+        """
+        temperature = self.starting_temperature
+        # The best solution found, or None if it is the current solution.
+        best_objective, best_labels = cluster_state.objective, None
+        num_accepted = 0
+        for iteration in range(self.iterations):
+            # Select random element
+            i = elements[iteration]
+            # Get number of possible swaps
+            num_exchanges = cluster_state.num_exchanges(i)
+            if num_exchanges == 0:
+                continue
+            # Select random possible swap.
+            j = cluster_state.exchange(i, int(exchanges[iteration] * num_exchanges))
+
+            delta = cluster_state.swap_delta(i, j)
+
+            # Select solution as current if accepted
+            accepted = self._accept(delta, temperature, thresholds[iteration])
+            if accepted:
+                if delta < 0 and best_labels is None:
+                    # The best solution found is left, so it is kept.
+                    best_labels = cluster_state.labels.copy()
+                cluster_state.swap(i, j, delta=delta)
+
+            if cluster_state.objective > best_objective:
+                best_objective, best_labels = cluster_state.objective, None
+
+            if report is not None:
+                num_accepted += accepted
+                report(
+                    iteration=iteration,
+                    objective=cluster_state.objective,
+                    best_objective=best_objective,
+                    accepted=num_accepted,
+                    rejected=iteration + 1 - num_accepted,
+                    temperature=temperature,
+                )
+
+            # Cool down temperature
+            temperature = temperature * self.alpha
+
+            if early_stopping.update(best_objective):
+                break
+
+        return best_objective, best_labels
+
+    def _accept(self, delta: float, temperature: float, threshold: float) -> bool:
         """
         Simulated annealing acceptance function. Notice d/t is used instead of -d/t because we are maximizing.
         :param delta: Difference in objective
         :param temperature: Current temperature
+        :param threshold: Uniformly distributed random number in [0, 1)
         :return: Whether the solution is accepted or not.
         """
-        return delta >= 0 or math.exp(delta / temperature) >= self.rnd.uniform(0, 1)
+        # Long runs cool down until the temperature underflows to 0, from where only improving swaps are accepted.
+        return delta >= 0 or (temperature > 0 and math.exp(delta / temperature) >= threshold)
@@ -15,16 +15,36 @@
 A tabu search with restarts approach to solving the anti-clustering problem.
 """
 
+from typing import Callable, List, Optional, Tuple
+import numpy as np
 import numpy.typing as npt
-from anti_clustering._cluster_swap_heuristic import ClusterSwapHeuristic
+from anti_clustering._cluster_state import ClusterState
+from anti_clustering._cluster_swap_heuristic import RestartHeuristic
+from anti_clustering._early_stopping import EarlyStopping
+from anti_clustering._kernels import run_tabu_search, use_numba
 
 
-class TabuSearchHeuristicAntiClustering(ClusterSwapHeuristic):
+class TabuSearchHeuristicAntiClustering(RestartHeuristic):
     """
     A tabu search with restarts approach to solving the anti-clustering problem.
-    In this version, specific transformations are put in the tabu list not solutions.
+    In this version, moves are put in the tabu list not solutions: after a swap, neither element may move back to the
+    anti-cluster it left for the next tabu_tenure accepted swaps. Iterations without a swap do not count. The tabu list
+    is stored as the number of accepted swaps from which each element may move to each anti-cluster again, so checking
+    a move takes constant time.
+
+    In each iteration a random element is selected, and moved according to move_selection:
+    * "random": Swap with a random element in another anti-cluster among the swaps that are not tabu, if the swap
+      improves the objective.
+    * "best": Swap with the element giving the largest change in objective among all swaps that are not tabu, even if
+      the objective gets worse. Tabu swaps are allowed if they improve on the best solution found (aspiration).
+
+    With backend "numba", or "auto" if Numba is installed, restarts run as compiled kernels if there are no callbacks,
+    giving the same results as the pure Python implementation ("python", default) for a given random_seed. The
+    kernels are compiled before the time limit starts, which takes seconds the first time and is cached on disk.
     """
 
+    _MOVE_SELECTIONS = ("random", "best")
+
     def __init__(
         self,
         verbose: bool = False,
@@ -32,68 +52,173 @@ class TabuSearchHeuristicAntiClustering(ClusterSwapHeuristic):
         tabu_tenure: int = 10,
         iterations: int = 2000,
         restarts: int = 9,
+        move_selection: str = "random",
+        backend: str = "python",
+        **kwargs,
     ):
-        # pylint: disable = R0913
-        super().__init__(verbose=verbose, random_seed=random_seed)
+        super().__init__(verbose=verbose, random_seed=random_seed, restarts=restarts, backend=backend, **kwargs)
+        if move_selection not in self._MOVE_SELECTIONS:
+            raise ValueError(f"Unknown move selection: {move_selection}. Must be one of {self._MOVE_SELECTIONS}.")
         self.tabu_tenure = tabu_tenure
         self.iterations = iterations
-        self.restarts = restarts
+        self.move_selection = move_selection
 
-    def _solve(self, distance_matrix: npt.NDArray[float], num_groups: int) -> npt.NDArray[bool]:
+    def _restart(
+        self,
+        distance_matrix: npt.NDArray[float],
+        num_groups: int,
+        rng: np.random.Generator,
+        report: Optional[Callable[..., None]] = None,
+        deadline: Optional[float] = None,
+        strata: Optional[npt.NDArray[int]] = None,
+    ) -> Tuple[float, npt.NDArray[int]]:
+        # pylint: disable = R0913
         # Start with random cluster assignment
-        cluster_assignment = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
-
-        if self.verbose:
-            print("Solving")
-
-        candidate_solutions = []
-
-        for restart in range(self.restarts):
-            tabu_swaps = []
-            # Initial objective value
-            objective = self._calculate_objective(cluster_assignment, distance_matrix)
-            for iteration in range(self.iterations):
-                if self.verbose and iteration % 5 == 0:
-                    print(f"Iteration {iteration + 1} of {self.iterations}")
-
-                # Select random element
-                i = self.rnd.randint(0, len(distance_matrix) - 1)
-
-                # Get possible swaps
-                possible_exchanges = [
-                    j
-                    for j in self._get_exchanges(cluster_assignment, i)
-                    if (i, j) not in tabu_swaps and (j, i) not in tabu_swaps
-                ]
-
-                if len(possible_exchanges) == 0:
-                    continue
-
-                # Generate possible assignments
-                j = possible_exchanges[self.rnd.randint(0, len(possible_exchanges) - 1)]
-
-                # Select random possible swap.
-                new_cluster_assignment = self._swap(cluster_assignment, i, j)
-                new_objective = self._calculate_objective(new_cluster_assignment, distance_matrix)
-
-                # Select solution as current if it improves the objective value
-                if new_objective > objective:
-                    cluster_assignment = new_cluster_assignment
-                    objective = new_objective
-                    tabu_swaps.append((i, j))
-                    # Delete oldest tabu swap if tabu list is full
-                    if len(tabu_swaps) > self.tabu_tenure:
-                        tabu_swaps.pop(0)
-
-            candidate_solutions.append((objective, cluster_assignment))
-
-            if self.verbose:
-                print(f"Restart {restart + 1} of {self.restarts}")
-
-            # Cold restart, select random cluster assignment
-            cluster_assignment = self._get_random_clusters(num_groups=num_groups, num_elements=len(distance_matrix))
-
-        # Select best solution, maximizing objective
-        _, best_cluster_assignment = max(candidate_solutions, key=lambda x: x[0])
-
-        return best_cluster_assignment
+        cluster_state = self._get_initial_clusters(
+            distance_matrix=distance_matrix, num_groups=num_groups, rng=rng, strata=strata
+        )
+
+        # Random numbers for all iterations are drawn at once: the element and the possible swap.
+        elements = rng.integers(0, distance_matrix.shape[0], size=self.iterations)
+        exchanges = rng.random(size=self.iterations)
+
+        # Number of accepted swaps from which element i may move to anti-cluster g, stored at [g, i].
+        tabu_until = np.zeros((num_groups, distance_matrix.shape[0]), dtype=np.int64)
+        best_labels = cluster_state.labels.copy()
+        early_stopping = self._get_early_stopping(cluster_state.objective, deadline)
+
+        if report is None and use_numba(self.backend, distance_matrix):
+            best_objective = run_tabu_search(
+                cluster_state=cluster_state,
+                distance_matrix=distance_matrix,
+                elements=elements,
+                exchanges=exchanges,
+                best_labels=best_labels,
+                tabu_until=tabu_until,
+                tabu_tenure=self.tabu_tenure,
+                best_move=self.move_selection == "best",
+                early_stopping=early_stopping,
+            )
+        else:
+            best_objective = self._search(
+                cluster_state=cluster_state,
+                elements=elements.tolist(),
+                exchanges=exchanges.tolist(),
+                best_labels=best_labels,
+                tabu_until=tabu_until,
+                report=report,
+                early_stopping=early_stopping,
+            )
+
+        if self.move_selection == "best":
+            return best_objective, best_labels
+        return cluster_state.objective, cluster_state.labels
+
+    def _search(
+        self,
+        cluster_state: ClusterState,
+        elements: List[int],
+        exchanges: List[float],
+        best_labels: npt.NDArray[int],
+        tabu_until: npt.NDArray[int],
+        report: Optional[Callable[..., None]],
+        early_stopping: EarlyStopping,
+    ) -> float:
+        # pylint: disable = R0913
+        """
+        Run the iterations of a restart, updating the solution in place.
+        :param cluster_state: The initial solution.
+        :param elements: The random element of each iteration.
+        :param exchanges: Uniformly distributed random number in [0, 1) selecting the possible swap of each iteration.
+        :param best_labels: Labels of the best solution found, updated in place with best move selection.
+        :param tabu_until: Number of accepted swaps from which each element may move to each anti-cluster, updated in
+        place.
+        :param report: If given, called after each iteration.
+        :param early_stopping: Stopping criteria.
+        :return: The objective value of the best solution found.
+        """
+        labels = cluster_state.labels
+        best_objective = cluster_state.objective
+        num_accepted = 0
+
+        for iteration in range(self.iterations):
+            # Select random element
+            i = elements[iteration]
+
+            move = self._select_move(cluster_state, i, exchanges[iteration], tabu_until, num_accepted, best_objective)
+            if move is not None:
+                j, delta = move
+                num_accepted += 1
+                tabu_until[labels[i], i] = tabu_until[labels[j], j] = num_accepted + self.tabu_tenure
+                cluster_state.swap(i, j, delta=delta)
+
+            if cluster_state.objective > best_objective:
+                best_objective = cluster_state.objective
+                # Only the best move selection may make the objective worse, so the best solution is kept separately.
+                if self.move_selection == "best":
+                    best_labels[:] = labels
+
+            if report is not None:
+                report(
+                    iteration=iteration,
+                    objective=cluster_state.objective,
+                    best_objective=best_objective,
+                    accepted=num_accepted,
+                    rejected=iteration + 1 - num_accepted,
+                    tabu_size=int(np.count_nonzero(tabu_until > num_accepted)),
+                )
+
+            if early_stopping.update(best_objective):
+                break
+
+        return best_objective
+
+    def _select_move(
+        self,
+        cluster_state: ClusterState,
+        i: int,
+        exchange: float,
+        tabu_until: npt.NDArray[int],
+        num_accepted: int,
+        best_objective: float,
+    ) -> Optional[Tuple[int, float]]:
+        # pylint: disable = R0913
+        """
+        Select the element to swap element i with according to move_selection.
+        :param cluster_state: The current solution.
+        :param i: The selected element.
+        :param exchange: Uniformly distributed random number in [0, 1) selecting a random swap that is not tabu.
+        :param tabu_until: Number of accepted swaps from which each element may move to each anti-cluster.
+        :param num_accepted: Number of swaps accepted so far.
+        :param best_objective: Objective value of the best solution found.
+        :return: The element to swap with and the change in objective value, or None if no move is made.
+        """
+        labels = cluster_state.labels
+
+        if self.move_selection == "best":
+            deltas = cluster_state.swap_deltas(i)
+            # Swaps moving i, or the other element, to an anti-cluster it is not allowed to move to yet.
+            tabu = (tabu_until[labels, i] > num_accepted) | (tabu_until[labels[i]] > num_accepted)
+            # Aspiration: tabu swaps are allowed if they give a new best solution.
+            tabu &= deltas <= best_objective - cluster_state.objective
+            deltas[tabu] = -np.inf
+            j = int(np.argmax(deltas))
+            if deltas[j] == -np.inf:
+                return None
+            return j, deltas[j]
+
+        # Select random possible swap among those that are not tabu.
+        possible = cluster_state.exchanges(i)
+        possible = possible[
+            (tabu_until[labels[possible], i] <= num_accepted) & (tabu_until[labels[i], possible] <= num_accepted)
+        ]
+        if len(possible) == 0:
+            return None
+        j = int(possible[int(exchange * len(possible))])
+
+        delta = cluster_state.swap_delta(i, j)
+
+        # Select solution as current if it improves the objective value
+        if delta <= 0:
+            return None
+        return j, delta
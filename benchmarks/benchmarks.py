@@ -0,0 +1,180 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks of the scaling of each phase of anti-clustering, run with airspeed velocity (asv).
+
+Each suite is parametrized over the number of elements and times a single phase, such that results show where time and
+memory go as datasets grow. asv calls setup before each benchmark and skips parameter combinations for which setup
+raises NotImplementedError. Peak memory (peakmem_*) is the peak resident memory of the benchmark process, including the
+inputs prepared in setup.
+"""
+
+import numpy as np
+from anti_clustering import ExchangeHeuristicAntiClustering, OnlineAntiClustering
+from benchmarks.common import (
+    ALGORITHMS,
+    COLUMN_MIXES,
+    MAX_ELEMENTS,
+    RANDOM_SEED,
+    calculate_objective,
+    generate_dataset,
+    get_columns,
+)
+
+
+class DistanceSuite:
+    """
+    Data preparation, distance matrix construction and post-processing. These phases are shared by all algorithms.
+    """
+
+    params = ([100, 1_000, 10_000], list(COLUMN_MIXES))
+    param_names = ["num_elements", "column_mix"]
+    timeout = 600
+
+    def setup(self, num_elements, column_mix):
+        self.algorithm = ExchangeHeuristicAntiClustering(random_seed=RANDOM_SEED)
+        self.df = generate_dataset(num_elements, column_mix)
+        self.numerical_columns, self.categorical_columns = get_columns(self.df)
+        self.prepared_df = self.algorithm._prepare_data(
+            df=self.df, numerical_columns=self.numerical_columns, categorical_columns=self.categorical_columns
+        )
+        self.labels = np.arange(num_elements) % 2
+
+    def time_prepare_data(self, num_elements, column_mix):
+        self.algorithm._prepare_data(
+            df=self.df, numerical_columns=self.numerical_columns, categorical_columns=self.categorical_columns
+        )
+
+    def time_distance_matrix(self, num_elements, column_mix):
+        self.algorithm._get_distance_matrix(
+            df=self.prepared_df, numerical_columns=self.numerical_columns, categorical_columns=self.categorical_columns
+        )
+
+    def peakmem_distance_matrix(self, num_elements, column_mix):
+        self.algorithm._get_distance_matrix(
+            df=self.prepared_df, numerical_columns=self.numerical_columns, categorical_columns=self.categorical_columns
+        )
+
+    def time_post_process(self, num_elements, column_mix):
+        self.algorithm._post_process(df=self.df, destination_column="Cluster", cluster_assignment=self.labels)
+
+
+class SolveSuite:
+    """
+    Solving from a precomputed distance matrix with each algorithm, and the objective value reached. The column mix
+    only changes the distances, so solving is benchmarked on mixed columns only.
+    """
+
+    params = ([name for name in ALGORITHMS if name != "divide_and_conquer"], [100, 1_000, 10_000], [2, 10])
+    param_names = ["algorithm", "num_elements", "num_groups"]
+    timeout = 1800
+    number = 1
+    repeat = (1, 3, 60.0)
+
+    def setup(self, algorithm, num_elements, num_groups):
+        if num_elements > MAX_ELEMENTS[algorithm]:
+            raise NotImplementedError(f"{algorithm} is not benchmarked with {num_elements} elements")
+        self.algorithm = ALGORITHMS[algorithm]()
+        df = generate_dataset(num_elements, "mixed")
+        numerical_columns, categorical_columns = get_columns(df)
+        self.distance_matrix = self.algorithm.compute_distance_matrix(
+            df=df, numerical_columns=numerical_columns, categorical_columns=categorical_columns
+        )
+
+    def time_solve(self, algorithm, num_elements, num_groups):
+        self.algorithm._solve(distance_matrix=self.distance_matrix, num_groups=num_groups)
+
+    def peakmem_solve(self, algorithm, num_elements, num_groups):
+        self.algorithm._solve(distance_matrix=self.distance_matrix, num_groups=num_groups)
+
+    def track_objective(self, algorithm, num_elements, num_groups):
+        labels = self.algorithm._solve(distance_matrix=self.distance_matrix, num_groups=num_groups)
+        if labels.ndim == 2:
+            # Assignment matrix
+            labels = labels.argmax(axis=1)
+        return calculate_objective(self.distance_matrix, labels)
+
+    track_objective.unit = "distance"
+
+
+class LargeScaleSuite:
+    """
+    End-to-end runs of divide-and-conquer on datasets too large for a full distance matrix. As the objective needs all
+    pairwise distances, quality is tracked as the mean difference in feature means between anti-clusters instead.
+    """
+
+    params = ([10_000, 100_000], [2, 10])
+    param_names = ["num_elements", "num_groups"]
+    timeout = 3600
+    number = 1
+    repeat = (1, 3, 60.0)
+
+    def setup(self, num_elements, num_groups):
+        self.algorithm = ALGORITHMS["divide_and_conquer"]()
+        self.df = generate_dataset(num_elements, "mixed")
+        self.numerical_columns, self.categorical_columns = get_columns(self.df)
+
+    def _run(self, num_groups):
+        return self.algorithm.run(
+            df=self.df,
+            numerical_columns=self.numerical_columns,
+            categorical_columns=self.categorical_columns,
+            num_groups=num_groups,
+            destination_column="Cluster",
+        )
+
+    def time_run(self, num_elements, num_groups):
+        self._run(num_groups)
+
+    def peakmem_run(self, num_elements, num_groups):
+        self._run(num_groups)
+
+    def track_mean_difference(self, num_elements, num_groups):
+        df = self._run(num_groups)
+        numerical = df[self.numerical_columns]
+        means = ((numerical - numerical.mean()) / numerical.std()).groupby(df["Cluster"]).mean()
+        return float((means.max() - means.min()).mean())
+
+    track_mean_difference.unit = "standard deviations"
+
+
+class OnlineSuite:
+    """
+    Assigning new rows to existing anti-clusters, with and without periodic re-optimization.
+    """
+
+    params = ([1_000, 10_000], [None, 100])
+    param_names = ["num_new_elements", "reoptimize_every"]
+    timeout = 600
+    # Assigning changes the state, so each sample runs once on a state rebuilt by setup.
+    number = 1
+    repeat = (1, 3, 60.0)
+
+    def setup(self, num_new_elements, reoptimize_every):
+        df = generate_dataset(2_000 + num_new_elements, "mixed")
+        numerical_columns, categorical_columns = get_columns(df)
+        self.online = OnlineAntiClustering(
+            ExchangeHeuristicAntiClustering(random_seed=RANDOM_SEED, restarts=1), reoptimize_every=reoptimize_every
+        )
+        self.online.run(
+            df=df.iloc[:2_000],
+            numerical_columns=numerical_columns,
+            categorical_columns=categorical_columns,
+            num_groups=10,
+            destination_column="Cluster",
+        )
+        self.new_df = df.iloc[2_000:]
+
+    def time_assign(self, num_new_elements, reoptimize_every):
+        self.online.assign(self.new_df)
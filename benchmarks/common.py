@@ -0,0 +1,124 @@
+# Copyright 2022 ECCO Sneaks & Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Synthetic datasets and algorithm configurations shared by the benchmarks.
+"""
+
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from anti_clustering import (
+    AntiClustering,
+    DivideAndConquerAntiClustering,
+    ExactClusterEditingAntiClustering,
+    ExchangeHeuristicAntiClustering,
+    NaiveRandomHeuristicAntiClustering,
+    ParallelTemperingHeuristicAntiClustering,
+    SimulatedAnnealingHeuristicAntiClustering,
+    TabuSearchHeuristicAntiClustering,
+)
+
+RANDOM_SEED = 0
+
+# Number of numerical and categorical columns of each column mix.
+COLUMN_MIXES: Dict[str, Tuple[int, int]] = {
+    "numerical": (4, 0),
+    "categorical": (0, 4),
+    "mixed": (2, 2),
+}
+
+# Algorithms with default parameters apart from a fixed seed, such that objective values are comparable between runs.
+ALGORITHMS: Dict[str, Callable[[], AntiClustering]] = {
+    "exchange": lambda: ExchangeHeuristicAntiClustering(random_seed=RANDOM_SEED),
+    "exchange_local_search": lambda: ExchangeHeuristicAntiClustering(random_seed=RANDOM_SEED, max_passes=None),
+    "simulated_annealing": lambda: SimulatedAnnealingHeuristicAntiClustering(random_seed=RANDOM_SEED),
+    "tabu_search": lambda: TabuSearchHeuristicAntiClustering(random_seed=RANDOM_SEED),
+    "parallel_tempering": lambda: ParallelTemperingHeuristicAntiClustering(random_seed=RANDOM_SEED),
+    "naive_random": lambda: NaiveRandomHeuristicAntiClustering(random_seed=RANDOM_SEED),
+    # Proving optimality can take very long, so the exact solver is stopped after a time limit
+    "exact": lambda: ExactClusterEditingAntiClustering(
+        solver_id="CP_SAT",
+        lazy_constraints=True,
+        time_limit=60,
+        warm_start=ExchangeHeuristicAntiClustering(random_seed=RANDOM_SEED, restarts=1),
+    ),
+    "divide_and_conquer": lambda: DivideAndConquerAntiClustering(
+        ExchangeHeuristicAntiClustering(random_seed=RANDOM_SEED), block_size=2000, random_seed=RANDOM_SEED
+    ),
+}
+
+# Largest number of elements each algorithm is benchmarked with. All algorithms but divide-and-conquer store a full
+# distance matrix, and the exact solver is only feasible for small instances.
+MAX_ELEMENTS: Dict[str, int] = {
+    "exchange": 10_000,
+    "exchange_local_search": 10_000,
+    "simulated_annealing": 10_000,
+    "tabu_search": 10_000,
+    "parallel_tempering": 10_000,
+    "naive_random": 10_000,
+    "exact": 100,
+    "divide_and_conquer": 100_000,
+}
+
+
+def generate_dataset(num_elements: int, column_mix: str, random_seed: int = RANDOM_SEED) -> pd.DataFrame:
+    """
+    Generate a synthetic dataset. Numerical columns are drawn from distributions of different shape and scale, and
+    categorical columns have between 2 and 50 categories with skewed frequencies.
+    :param num_elements: Number of rows.
+    :param column_mix: One of COLUMN_MIXES.
+    :param random_seed: Seed of the random generator.
+    :return: The dataset.
+    """
+    rng = np.random.default_rng(random_seed)
+    num_numerical, num_categorical = COLUMN_MIXES[column_mix]
+    distributions = [
+        lambda: rng.normal(size=num_elements),
+        lambda: rng.exponential(scale=10.0, size=num_elements),
+        lambda: rng.uniform(-5.0, 5.0, size=num_elements),
+        lambda: rng.lognormal(size=num_elements),
+    ]
+    columns = {f"num_{c}": distributions[c % len(distributions)]() for c in range(num_numerical)}
+    for c in range(num_categorical):
+        num_categories = [2, 5, 20, 50][c % 4]
+        frequencies = 1.0 / np.arange(1, num_categories + 1)
+        codes = rng.choice(num_categories, size=num_elements, p=frequencies / frequencies.sum())
+        columns[f"cat_{c}"] = np.char.add("c", codes.astype(str))
+    return pd.DataFrame(columns)
+
+
+def get_columns(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
+    """
+    Get the numerical and categorical columns of a generated dataset.
+    :param df: A dataset from generate_dataset.
+    :return: The numerical and categorical columns.
+    """
+    numerical_columns = [column for column in df.columns if column.startswith("num_")]
+    categorical_columns = [column for column in df.columns if column.startswith("cat_")]
+    return numerical_columns, categorical_columns
+
+
+def calculate_objective(distance_matrix: npt.NDArray[float], labels: npt.NDArray[int]) -> float:
+    """
+    Calculate the objective value, the sum of distances within anti-clusters, without building a K x N x N tensor.
+    :param distance_matrix: The distance matrix.
+    :param labels: The anti-cluster labels.
+    :return: The sum of distances between all pairs of elements in the same anti-cluster.
+    """
+    objective = 0.0
+    for group in np.unique(labels):
+        members = np.flatnonzero(labels == group)
+        objective += float(distance_matrix[np.ix_(members, members)].sum(dtype=np.float64)) / 2
+    return objective
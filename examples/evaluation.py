@@ -26,6 +26,7 @@ from anti_clustering import (
     SimulatedAnnealingHeuristicAntiClustering,
     NaiveRandomHeuristicAntiClustering,
     TabuSearchHeuristicAntiClustering,
+    ParallelTemperingHeuristicAntiClustering,
     ExactClusterEditingAntiClustering,
     AntiClustering,
 )
@@ -40,10 +41,19 @@ methods: List[AntiClustering] = [
     TabuSearchHeuristicAntiClustering(iterations=5000, restarts=10, tabu_tenure=50),
     ExchangeHeuristicAntiClustering(restarts=20),
     SimulatedAnnealingHeuristicAntiClustering(alpha=0.95, iterations=5000, starting_temperature=1000, restarts=20),
+    ParallelTemperingHeuristicAntiClustering(iterations=20000, n_jobs=-1),
     NaiveRandomHeuristicAntiClustering(),
-    # ExactClusterEditingAntiClustering(), # This method is extremely slow for large datasets
+    # Proving optimality is extremely slow for large datasets, so the best solution found within a time limit is used
+    ExactClusterEditingAntiClustering(
+        solver_id="CP_SAT", time_limit=60, warm_start=ExchangeHeuristicAntiClustering(restarts=5)
+    ),
 ]
 
+# Distances are the same for all methods and numbers of clusters, so they are only computed once
+distance_matrix = methods[0].compute_distance_matrix(
+    df=iris_df, numerical_columns=list(iris_df.columns), categorical_columns=None
+)
+
 for k in range(2, 4):
     print(f"------------- Number of clusters: {k} -------------")
     summary = []
@@ -51,10 +61,9 @@ for k in range(2, 4):
         print(f"Running method: {method.__class__.__name__}")
 
         start_time = time.time()
-        df = method.run(
+        df = method.run_with_distance_matrix(
             df=iris_df,
-            numerical_columns=list(iris_df.columns),
-            categorical_columns=None,
+            distance_matrix=distance_matrix,
             num_groups=k,
             destination_column="Cluster",
         )
@@ -3,9 +3,19 @@ from anti_clustering import (
     ExactClusterEditingAntiClustering,
     ExchangeHeuristicAntiClustering,
     NaiveRandomHeuristicAntiClustering,
+    TabuSearchHeuristicAntiClustering,
+    ParallelTemperingHeuristicAntiClustering,
+    DivideAndConquerAntiClustering,
+    MetricsCollector,
 )
+from anti_clustering import _kernels
+from anti_clustering._cluster_state import ClusterState
+import time
+import numpy as np
 import pytest
 import pandas as pd
+import scipy.sparse
+from scipy.spatial.distance import squareform
 
 
 @pytest.mark.parametrize(
@@ -14,7 +24,7 @@ import pandas as pd
         (pd.DataFrame(data={"x": [0, 0, 2, 3, 3, 2], "y": [1, 2, 2, 1, 0, 0]}), [0, 0, 0, 0, 0, 0], 1),
         (pd.DataFrame(data={"x": [0, 0, 2, 3, 3, 2], "y": [1, 2, 2, 1, 0, 0]}), [0, 1, 0, 1, 0, 1], 2),
         (pd.DataFrame(data={"x": [0, 0, 2, 3, 3, 2], "y": [1, 2, 2, 1, 0, 0]}), [0, 1, 2, 0, 1, 2], 3),
-        (pd.DataFrame(data={"x": [0, 2, 3, 0, 3, 2], "y": [1, 2, 0, 2, 1, 0]}), [0, 2, 1, 1, 0, 2], 3),
+        (pd.DataFrame(data={"x": [0, 2, 3, 0, 3, 2], "y": [1, 2, 0, 2, 1, 0]}), [0, 1, 2, 2, 0, 1], 3),
         (pd.DataFrame(data={"x": [0, 2, 3, 0, 3, 2], "y": [1, 2, 0, 2, 1, 0]}), [0, 0, 0, 1, 1, 1], 2),
         (pd.DataFrame(data={"x": [0, 2, 3, 0, 3, 2], "y": [1, 2, 0, 2, 1, 0]}), [0, 0, 0, 0, 0, 0], 1),
     ],
@@ -25,6 +35,9 @@ import pandas as pd
         ExchangeHeuristicAntiClustering(random_seed=1),
         SimulatedAnnealingHeuristicAntiClustering(random_seed=1),
         ExactClusterEditingAntiClustering(),
+        ExactClusterEditingAntiClustering(solver_id="CP_SAT", n_jobs=2),
+        ExactClusterEditingAntiClustering(lazy_constraints=True),
+        ParallelTemperingHeuristicAntiClustering(random_seed=1, num_replicas=4, iterations=200),
         NaiveRandomHeuristicAntiClustering(random_seed=1),
     ],
 )
@@ -97,3 +110,728 @@ def test_verbose_mode(algorithm):
     algorithm.run(
         df=df, numerical_columns=["x", "y"], num_groups=2, destination_column="col", categorical_columns=["c"]
     )
+
+
+@pytest.mark.parametrize(
+    "algorithm_class",
+    [
+        ExchangeHeuristicAntiClustering,
+        SimulatedAnnealingHeuristicAntiClustering,
+        TabuSearchHeuristicAntiClustering,
+    ],
+)
+def test_parallel_restarts_are_reproducible(algorithm_class):
+    """
+    Test that running restarts in worker processes gives the same result as running them sequentially.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((40, 3)), columns=["x", "y", "z"])
+    results = [
+        algorithm_class(random_seed=2, restarts=4, n_jobs=n_jobs).run(
+            df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+        )
+        for n_jobs in [1, 2]
+    ]
+    assert (results[0]["c"] == results[1]["c"]).all()
+
+
+@pytest.mark.parametrize(
+    "algorithm_class",
+    [
+        ExchangeHeuristicAntiClustering,
+        SimulatedAnnealingHeuristicAntiClustering,
+        TabuSearchHeuristicAntiClustering,
+    ],
+)
+def test_reduced_precision(algorithm_class):
+    """
+    Test that storing the distance matrix in single precision gives the same result as double precision.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((40, 3)), columns=["x", "y", "z"])
+    algorithm = algorithm_class(random_seed=2, restarts=2, dtype=np.float32)
+    prepared_df = algorithm._prepare_data(df=df, numerical_columns=["x", "y", "z"], categorical_columns=[])
+    assert algorithm._get_distance_matrix(prepared_df, ["x", "y", "z"], []).dtype == np.float32
+
+    results = [
+        algorithm_class(random_seed=2, restarts=2, dtype=dtype).run(
+            df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+        )
+        for dtype in [np.float32, np.float64]
+    ]
+    assert (results[0]["c"] == results[1]["c"]).all()
+
+
+def test_invalid_dtype():
+    """
+    Test that non floating point distance matrices are rejected.
+    """
+    with pytest.raises(ValueError):
+        ExchangeHeuristicAntiClustering(dtype=np.int32)
+
+
+def test_post_process_labels_and_matrix():
+    """
+    Test that labels and assignment matrices are post-processed to the same labels, enumerated by first occurrence.
+    """
+    df = pd.DataFrame(data={"x": range(6)})
+    labels = np.array([2, 0, 2, 1, 0, 1])
+    matrix = np.equal.outer(labels, labels)
+    algorithm = ExchangeHeuristicAntiClustering()
+
+    from_labels = algorithm._post_process(df=df, destination_column="Cluster", cluster_assignment=labels)
+    from_matrix = algorithm._post_process(df=df, destination_column="Cluster", cluster_assignment=matrix)
+
+    assert (from_labels["Cluster"].to_numpy() == [0, 1, 0, 2, 1, 2]).all()
+    assert (from_matrix["Cluster"].to_numpy() == [0, 1, 0, 2, 1, 2]).all()
+
+
+@pytest.mark.parametrize("initialization", ["random", "stripe"])
+def test_initial_labels_are_balanced(initialization):
+    """
+    Test that initializations, single and in batches, assign balanced anti-cluster sizes.
+    """
+    points = np.random.default_rng(0).random((11, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    algorithm = ExchangeHeuristicAntiClustering(initialization=initialization)
+    rng = np.random.default_rng(1)
+
+    labels = algorithm._get_initial_labels(distance_matrix=distance_matrix, num_groups=3, rng=rng)
+    assert labels.shape == (11,)
+    assert sorted(np.bincount(labels)) == [3, 4, 4]
+
+    batch = algorithm._get_initial_labels(distance_matrix=distance_matrix, num_groups=3, rng=rng, size=5)
+    assert batch.shape == (5, 11)
+    for labels in batch:
+        assert sorted(np.bincount(labels)) == [3, 4, 4]
+
+
+def test_stripe_initialization_separates_neighbours():
+    """
+    Test that consecutive elements along a line start in different anti-clusters.
+    """
+    distance_matrix = np.abs(np.subtract.outer(np.arange(12.0), np.arange(12.0)))
+    algorithm = ExchangeHeuristicAntiClustering(initialization="stripe")
+    labels = algorithm._get_initial_labels(distance_matrix=distance_matrix, num_groups=3, rng=np.random.default_rng(0))
+    for stripe in labels.reshape(4, 3):
+        assert sorted(stripe) == [0, 1, 2]
+
+
+def test_batched_objectives():
+    """
+    Test that objectives of a batch of solutions match calculating each objective on its own.
+    """
+    points = np.random.default_rng(0).random((10, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    algorithm = NaiveRandomHeuristicAntiClustering(distance_block_size=3)
+    batch = algorithm._get_initial_labels(
+        distance_matrix=distance_matrix, num_groups=2, rng=np.random.default_rng(0), size=4
+    )
+    objectives = algorithm._calculate_objectives(labels=batch, distance_matrix=distance_matrix, num_groups=2)
+    for labels, objective in zip(batch, objectives):
+        assert np.isclose(objective, (np.equal.outer(labels, labels) * distance_matrix).sum())
+
+
+def test_invalid_initialization():
+    """
+    Test that unknown initialization strategies are rejected.
+    """
+    with pytest.raises(ValueError):
+        ExchangeHeuristicAntiClustering(initialization="unknown")
+
+
+def test_exact_model_size():
+    """
+    Test that the estimated model size matches the built model, and that oversized models are rejected before building.
+    """
+    num_variables, num_constraints, num_nonzeros = ExactClusterEditingAntiClustering.estimate_model_size(7)
+    triangle_constraints = ExactClusterEditingAntiClustering._get_triangle_constraints(7, variables=np.arange(21))
+    assert num_variables == triangle_constraints.shape[1] == 21
+    assert num_constraints == triangle_constraints.shape[0] + 7
+    assert num_nonzeros == triangle_constraints.nnz + 2 * num_variables
+
+    df = pd.DataFrame(data={"x": range(7)})
+    with pytest.raises(ValueError):
+        ExactClusterEditingAntiClustering(max_model_size=num_nonzeros - 1).run(
+            df=df, numerical_columns=["x"], categorical_columns=None, num_groups=2, destination_column="c"
+        )
+
+
+@pytest.mark.parametrize("solver_id", ["SCIP", "CP_SAT"])
+def test_exact_time_limit_with_warm_start(solver_id):
+    """
+    Test that the exact solver returns a balanced incumbent with its bound and gap when stopped by a time limit.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((24, 2)), columns=["x", "y"])
+    algorithm = ExactClusterEditingAntiClustering(
+        solver_id=solver_id,
+        time_limit=1.0,
+        relative_gap=0.01,
+        warm_start=ExchangeHeuristicAntiClustering(random_seed=1, restarts=2),
+    )
+    result_df = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    assert sorted(result_df["c"].value_counts()) == [8, 8, 8]
+    assert algorithm.objective_bound >= algorithm.objective_value - 1e-6
+    assert algorithm.gap >= 0.0
+
+
+def test_exact_time_limit_includes_warm_start():
+    """
+    Test that the time limit of the exact solver includes the warm start, whose solution is returned if it uses it up.
+    """
+
+    class SlowExchangeHeuristic(ExchangeHeuristicAntiClustering):
+        def _solve(self, distance_matrix, num_groups, strata=None):
+            time.sleep(1.0)
+            return super()._solve(distance_matrix, num_groups, strata)
+
+    df = pd.DataFrame(data=np.random.default_rng(0).random((24, 2)), columns=["x", "y"])
+    algorithm = ExactClusterEditingAntiClustering(time_limit=0.5, warm_start=SlowExchangeHeuristic(random_seed=1))
+    start = time.monotonic()
+    result_df = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    assert time.monotonic() - start < 1.5
+    assert sorted(result_df["c"].value_counts()) == [8, 8, 8]
+    assert algorithm.objective_bound == np.inf
+
+
+def test_exact_unsupported_relative_gap():
+    """
+    Test that a relative gap is rejected for solvers it cannot be passed to.
+    """
+    with pytest.raises(ValueError):
+        ExactClusterEditingAntiClustering(solver_id="GLOP", relative_gap=0.01)
+
+
+def test_exact_returns_warm_start_without_solution():
+    """
+    Test that the starting solution is returned if the solver finds no solution within the time limit.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((24, 2)), columns=["x", "y"])
+    warm_start = ExchangeHeuristicAntiClustering(random_seed=1, restarts=2)
+    algorithm = ExactClusterEditingAntiClustering(time_limit=1e-6, warm_start=warm_start)
+    result_df = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    expected_df = warm_start.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    assert (result_df["c"] == expected_df["c"]).all()
+    assert algorithm.objective_value > 0.0
+
+
+def test_exact_preclustering():
+    """
+    Test that preclustering separates similar elements and shrinks the model as estimated.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((10, 2)), columns=["x", "y"])
+    algorithm = ExactClusterEditingAntiClustering(preclustering=True)
+    prepared_df = algorithm._prepare_data(df=df, numerical_columns=["x", "y"], categorical_columns=[])
+    distance_matrix = algorithm._get_distance_matrix(prepared_df, ["x", "y"], [])
+    preclusters = algorithm._get_preclusters(distance_matrix, num_groups=3)
+    assert sorted(np.bincount(preclusters)) == [1, 3, 3, 3]
+
+    rows, cols = np.triu_indices(10, k=1)
+    free = preclusters[rows] != preclusters[cols]
+    variables = np.full(len(rows), -1)
+    variables[free] = np.arange(free.sum())
+    triangle_constraints = ExactClusterEditingAntiClustering._get_triangle_constraints(10, variables=variables)
+    num_variables, num_constraints, num_nonzeros = ExactClusterEditingAntiClustering.estimate_model_size(
+        10, precluster_sizes=np.bincount(preclusters)
+    )
+    assert num_variables == triangle_constraints.shape[1] == free.sum()
+    assert num_constraints == triangle_constraints.shape[0] + 10
+    assert num_nonzeros == triangle_constraints.nnz + 2 * num_variables
+    assert num_nonzeros < ExactClusterEditingAntiClustering.estimate_model_size(10)[2]
+
+    result_df = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    labels = result_df["c"].to_numpy()
+    assert sorted(np.bincount(labels)) == [3, 3, 4]
+    for precluster in range(4):
+        assert len(set(labels[preclusters == precluster])) == (preclusters == precluster).sum()
+
+
+def test_exact_lazy_constraints():
+    """
+    Test that adding violated cluster assignment constraints lazily finds an optimal solution with fewer constraints.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((12, 2)), columns=["x", "y"])
+    objective_values = []
+    for lazy_constraints in [False, True]:
+        algorithm = ExactClusterEditingAntiClustering(lazy_constraints=lazy_constraints)
+        result_df = algorithm.run(
+            df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+        )
+        assert sorted(result_df["c"].value_counts()) == [4, 4, 4]
+        objective_values.append(algorithm.objective_value)
+    assert np.isclose(objective_values[0], objective_values[1])
+
+    rows, cols = np.triu_indices(4, k=1)
+    values = np.array([1.0, 1.0, 0.0, 0.0, 0.0, 0.0])  # Pairs (0, 1) and (0, 2) together, but not (1, 2)
+    violated = ExactClusterEditingAntiClustering._get_triangle_constraints(4, variables=np.arange(6), values=values)
+    assert violated.shape[0] == 1
+    assert (violated.toarray()[0] @ values) > 1
+
+
+@pytest.mark.parametrize("move_selection", ["random", "best"])
+def test_tabu_search_improves_initial_solution(move_selection):
+    """
+    Test that both tabu search move selections return balanced anti-clusters at least as good as their starting point.
+    """
+    points = np.random.default_rng(0).random((30, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    algorithm = TabuSearchHeuristicAntiClustering(iterations=200, tabu_tenure=5, move_selection=move_selection)
+
+    initial_state = algorithm._get_initial_clusters(distance_matrix, num_groups=3, rng=np.random.default_rng(0))
+    objective, labels = algorithm._restart(distance_matrix, num_groups=3, rng=np.random.default_rng(0))
+    assert sorted(np.bincount(labels)) == [10, 10, 10]
+    assert objective > initial_state.objective
+    assert np.isclose(objective, (np.equal.outer(labels, labels) * distance_matrix).sum())
+
+
+def test_tabu_search_samples_admissible_swaps():
+    """
+    Test that random move selection draws among the swaps that are not tabu, with tenure counted in accepted swaps.
+    """
+    points = np.array([[0.0], [0.1], [1.0], [1.1]])
+    distance_matrix = np.abs(points - points.T)
+    algorithm = TabuSearchHeuristicAntiClustering()
+    cluster_state = ClusterState(labels=[0, 0, 1, 1], num_groups=2, distance_matrix=distance_matrix)
+
+    # Element 2 may not move to anti-cluster 0 before 5 swaps have been accepted.
+    tabu_until = np.zeros((2, 4), dtype=np.int64)
+    tabu_until[0, 2] = 5
+    for exchange in [0.0, 0.5, 0.99]:
+        assert algorithm._select_move(cluster_state, 0, exchange, tabu_until, 4, 0.0)[0] == 3
+    assert {algorithm._select_move(cluster_state, 0, exchange, tabu_until, 5, 0.0)[0] for exchange in [0.0, 0.99]} == {
+        2,
+        3,
+    }
+
+
+def test_invalid_move_selection():
+    """
+    Test that unknown tabu search move selections are rejected.
+    """
+    with pytest.raises(ValueError):
+        TabuSearchHeuristicAntiClustering(move_selection="unknown")
+
+
+def test_parallel_tempering():
+    """
+    Test that parallel tempering is reproducible with worker processes, and calibrates increasing temperatures.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((40, 3)), columns=["x", "y", "z"])
+    results = [
+        ParallelTemperingHeuristicAntiClustering(random_seed=2, num_replicas=4, iterations=300, n_jobs=n_jobs).run(
+            df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+        )
+        for n_jobs in [1, 2]
+    ]
+    assert (results[0]["c"] == results[1]["c"]).all()
+    assert sorted(results[0]["c"].value_counts()) == [13, 13, 14]
+
+    points = np.random.default_rng(0).random((40, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    algorithm = ParallelTemperingHeuristicAntiClustering(num_replicas=4)
+    rng = np.random.default_rng(0)
+    temperatures = algorithm._calibrate_temperatures(algorithm._get_initial_clusters(distance_matrix, 3, rng), rng)
+    assert len(temperatures) == 4
+    assert (np.diff(temperatures) > 0).all()
+
+    with pytest.raises(ValueError):
+        ParallelTemperingHeuristicAntiClustering(num_replicas=4, temperatures=[1.0, 2.0])
+
+
+def test_run_with_distance_matrix():
+    """
+    Test that running with a precomputed square or condensed distance matrix gives the same result as run.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((30, 3)), columns=["x", "y", "z"])
+    df["c"] = np.random.default_rng(1).choice(["a", "b"], size=30)
+    algorithm = ExchangeHeuristicAntiClustering(random_seed=2, restarts=2)
+    expected = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=["c"], num_groups=3, destination_column="g"
+    )
+
+    distance_matrix = algorithm.compute_distance_matrix(df=df, numerical_columns=["x", "y"], categorical_columns=["c"])
+    for matrix in [distance_matrix, squareform(distance_matrix, checks=False)]:
+        result = algorithm.run_with_distance_matrix(df=df, distance_matrix=matrix, num_groups=3, destination_column="g")
+        assert (result["g"] == expected["g"]).all()
+
+    with pytest.raises(ValueError):
+        algorithm.run_with_distance_matrix(
+            df=df.iloc[:10], distance_matrix=distance_matrix, num_groups=3, destination_column="g"
+        )
+    asymmetric = distance_matrix.copy()
+    asymmetric[0, 1] += 1.0
+    nonzero_diagonal = distance_matrix + np.eye(30)
+    for matrix in [distance_matrix[:, :10], asymmetric, nonzero_diagonal, scipy.sparse.csr_matrix(asymmetric)]:
+        with pytest.raises(ValueError):
+            algorithm.run_with_distance_matrix(df=df, distance_matrix=matrix, num_groups=3, destination_column="g")
+
+
+def test_run_with_sparse_distance_matrix_does_not_modify_it():
+    """
+    Test that running with a sparse distance matrix with unsorted indices leaves the matrix of the caller unchanged.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((20, 2)), columns=["x", "y"])
+    algorithm = ExchangeHeuristicAntiClustering(random_seed=2, restarts=2)
+    distance_matrix = algorithm.compute_distance_matrix(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_neighbours=3
+    )
+    # Reverse the order of the entries within each row.
+    unsorted = distance_matrix.copy()
+    for row in range(unsorted.shape[0]):
+        row_slice = slice(unsorted.indptr[row], unsorted.indptr[row + 1])
+        unsorted.indices[row_slice] = unsorted.indices[row_slice][::-1]
+        unsorted.data[row_slice] = unsorted.data[row_slice][::-1]
+    unsorted.has_sorted_indices = False
+    indices = unsorted.indices.copy()
+
+    result = algorithm.run_with_distance_matrix(df=df, distance_matrix=unsorted, num_groups=2, destination_column="g")
+    assert sorted(result["g"].value_counts()) == [10, 10]
+    assert (unsorted.indices == indices).all()
+
+
+@pytest.mark.parametrize("metric", ["euclidean", "cosine", "gower"])
+def test_metrics_and_weights(metric):
+    """
+    Test that metrics and weights are passed on to the distance matrix, and that a zero weight ignores a column.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((30, 3)), columns=["x", "y", "z"])
+    algorithm = ExchangeHeuristicAntiClustering(random_seed=2, restarts=2)
+    weighted = algorithm.compute_distance_matrix(
+        df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, metric=metric, weights={"z": 0.0}
+    )
+    unweighted = algorithm.compute_distance_matrix(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, metric=metric
+    )
+    assert np.allclose(weighted, unweighted)
+
+    result = algorithm.run(
+        df=df,
+        numerical_columns=["x", "y"],
+        categorical_columns=None,
+        num_groups=3,
+        destination_column="g",
+        metric=metric,
+    )
+    assert sorted(result["g"].value_counts()) == [10, 10, 10]
+
+    with pytest.raises(ValueError):
+        algorithm.compute_distance_matrix(df=df, numerical_columns=["x"], categorical_columns=None, weights={"y": 1.0})
+
+
+@pytest.mark.parametrize(
+    "algorithm",
+    [
+        ExchangeHeuristicAntiClustering(random_seed=2, restarts=10**6, time_limit=0.5),
+        SimulatedAnnealingHeuristicAntiClustering(random_seed=2, iterations=10**7, restarts=2, time_limit=0.5),
+        TabuSearchHeuristicAntiClustering(random_seed=2, iterations=10**7, restarts=2, time_limit=0.5),
+        NaiveRandomHeuristicAntiClustering(random_seed=2, iterations=None, time_limit=0.5),
+        ParallelTemperingHeuristicAntiClustering(random_seed=2, iterations=10**7, num_replicas=2, time_limit=0.5),
+    ],
+)
+def test_heuristic_time_limit(algorithm):
+    """
+    Test that heuristics stop at the time limit with a valid solution.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((60, 3)), columns=["x", "y", "z"])
+    start = time.monotonic()
+    result = algorithm.run(
+        df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    assert time.monotonic() - start < 10
+    assert sorted(result["c"].value_counts()) == [20, 20, 20]
+
+
+@pytest.mark.parametrize(
+    "algorithm",
+    [
+        SimulatedAnnealingHeuristicAntiClustering(random_seed=2, iterations=10**6, restarts=2, stagnation_limit=200),
+        TabuSearchHeuristicAntiClustering(random_seed=2, iterations=10**6, restarts=2, stagnation_limit=200),
+        NaiveRandomHeuristicAntiClustering(random_seed=2, iterations=None, stagnation_limit=200),
+        ExchangeHeuristicAntiClustering(random_seed=2, restarts=2, stagnation_limit=10, stagnation_tolerance=0.01),
+    ],
+)
+def test_heuristic_stagnation_limit(algorithm):
+    """
+    Test that restarts stop once the best objective has not improved for stagnation_limit iterations.
+    """
+    collector = MetricsCollector()
+    algorithm.callbacks = [collector]
+    df = pd.DataFrame(data=np.random.default_rng(0).random((60, 3)), columns=["x", "y", "z"])
+    algorithm.run(
+        df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+
+    for _, iterations in collector.iterations_frame().groupby("restart"):
+        best = iterations["best_objective"].to_numpy()
+        assert len(best) < 60 if isinstance(algorithm, ExchangeHeuristicAntiClustering) else len(best) < 10**6
+        # The last stagnation_limit iterations did not improve the best objective by more than the tolerance.
+        tail = best[-algorithm.stagnation_limit - 1 :]
+        assert tail[-1] - tail[0] <= algorithm.stagnation_tolerance * abs(tail[0])
+
+
+def test_simulated_annealing_returns_best_visited_solution():
+    """
+    Test that simulated annealing stopped at a high temperature returns the best solution it visited.
+    """
+    collector = MetricsCollector()
+    algorithm = SimulatedAnnealingHeuristicAntiClustering(
+        random_seed=2, iterations=500, restarts=2, alpha=1.0, starting_temperature=10.0, callbacks=[collector]
+    )
+    df = pd.DataFrame(data=np.random.default_rng(0).random((60, 3)), columns=["x", "y", "z"])
+    algorithm.run(
+        df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+
+    iterations = collector.iterations_frame()
+    assert (
+        iterations.groupby("restart")["objective"].last() < iterations.groupby("restart")["best_objective"].max()
+    ).any()
+    assert np.allclose(collector.restart_objectives, iterations.groupby("restart")["best_objective"].max())
+
+
+@pytest.mark.parametrize("backend", ["python", "numba"])
+def test_simulated_annealing_cools_down_to_zero(backend):
+    """
+    Test that simulated annealing keeps running, greedily, once the temperature has underflowed to zero.
+    """
+    if backend == "numba":
+        pytest.importorskip("numba")
+    algorithm = SimulatedAnnealingHeuristicAntiClustering(
+        random_seed=2, alpha=0.5, iterations=3000, restarts=1, backend=backend
+    )
+    assert algorithm.starting_temperature * algorithm.alpha**algorithm.iterations == 0.0
+    df = pd.DataFrame(data=np.random.default_rng(0).random((30, 2)), columns=["x", "y"])
+    result_df = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+    assert sorted(result_df["c"].value_counts()) == [10, 10, 10]
+
+
+def test_invalid_stagnation_limit():
+    """
+    Test that invalid stagnation parameters, and unbounded iterations without a stopping criterion, are rejected.
+    """
+    with pytest.raises(ValueError):
+        ExchangeHeuristicAntiClustering(stagnation_limit=0)
+    with pytest.raises(ValueError):
+        TabuSearchHeuristicAntiClustering(stagnation_tolerance=-0.1)
+    with pytest.raises(ValueError):
+        NaiveRandomHeuristicAntiClustering(iterations=None)
+
+
+@pytest.mark.parametrize("improvement", ["best", "first"])
+@pytest.mark.parametrize("num_groups", [2, 5])
+def test_exchange_local_optimum(improvement, num_groups):
+    """
+    Test that exchange passes until a local optimum, where no swap improves the objective value, and improves on a
+    single pass from the same initialization.
+    """
+    points = np.random.default_rng(0).random((200, 3))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+
+    def objective(labels):
+        return (np.equal.outer(labels, labels) * distance_matrix).sum() / 2
+
+    single_pass = ExchangeHeuristicAntiClustering(random_seed=1, restarts=1, improvement=improvement)
+    local_search = ExchangeHeuristicAntiClustering(random_seed=1, restarts=1, max_passes=None, improvement=improvement)
+    labels = local_search._solve(distance_matrix=distance_matrix, num_groups=num_groups)
+
+    assert sorted(np.bincount(labels)) == sorted(np.bincount(np.arange(200) % num_groups))
+    assert objective(labels) > objective(single_pass._solve(distance_matrix=distance_matrix, num_groups=num_groups))
+    state = ClusterState(labels=labels, num_groups=num_groups, distance_matrix=distance_matrix)
+    assert max(state.swap_deltas(i).max() for i in range(200)) <= 1e-9
+
+
+def test_invalid_exchange_parameters():
+    """
+    Test that invalid numbers of passes and improvement strategies are rejected.
+    """
+    with pytest.raises(ValueError):
+        ExchangeHeuristicAntiClustering(max_passes=0)
+    with pytest.raises(ValueError):
+        ExchangeHeuristicAntiClustering(improvement="worst")
+
+
+@pytest.mark.parametrize(
+    "algorithm",
+    [
+        ExchangeHeuristicAntiClustering(random_seed=3, restarts=2, max_passes=None),
+        ExchangeHeuristicAntiClustering(random_seed=3, restarts=2, max_passes=None, improvement="first"),
+        SimulatedAnnealingHeuristicAntiClustering(random_seed=3, restarts=2, stagnation_limit=500),
+        TabuSearchHeuristicAntiClustering(random_seed=3, restarts=2),
+        TabuSearchHeuristicAntiClustering(random_seed=3, restarts=2, move_selection="best"),
+    ],
+)
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("stratified", [False, True])
+def test_backends_give_identical_results(algorithm, dtype, stratified):
+    """
+    Test that compiled kernels give the same solutions as the pure Python implementation.
+    """
+    pytest.importorskip("numba")
+    points = np.random.default_rng(0).random((300, 3))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1).astype(dtype)
+    strata = np.random.default_rng(1).integers(0, 5, size=300) if stratified else None
+
+    results = []
+    for backend in ["python", "numba"]:
+        algorithm.backend = backend
+        results.append(algorithm._solve(distance_matrix=distance_matrix, num_groups=4, strata=strata))
+    assert (results[0] == results[1]).all()
+
+
+@pytest.mark.parametrize(
+    "algorithm",
+    [
+        ExchangeHeuristicAntiClustering(random_seed=3, max_passes=None, backend="numba"),
+        SimulatedAnnealingHeuristicAntiClustering(random_seed=3, iterations=1000, backend="numba"),
+        TabuSearchHeuristicAntiClustering(random_seed=3, iterations=1000, move_selection="best", backend="numba"),
+    ],
+)
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_kernels_compiled_before_time_limit(algorithm, dtype):
+    """
+    Test that compiling the kernels up front covers the calls of a run, so no compilation counts towards the time limit.
+    """
+    pytest.importorskip("numba")
+    kernels = [_kernels._simulated_annealing_kernel, _kernels._tabu_search_kernel, _kernels._exchange_kernel]
+    _kernels.compile_kernels(dtype)
+    signatures = [list(kernel.signatures) for kernel in kernels]
+
+    distance_matrix = np.random.default_rng(0).random((50, 50)).astype(dtype)
+    algorithm._solve(distance_matrix=distance_matrix + distance_matrix.T, num_groups=5)
+    assert [list(kernel.signatures) for kernel in kernels] == signatures
+
+
+def test_default_backend():
+    """
+    Test that Numba is opt-in, as compiling the kernels takes seconds.
+    """
+    assert SimulatedAnnealingHeuristicAntiClustering().backend == "python"
+    assert TabuSearchHeuristicAntiClustering().backend == "python"
+    assert ExchangeHeuristicAntiClustering().backend == "python"
+
+
+def test_invalid_backend():
+    """
+    Test that unknown backends are rejected.
+    """
+    with pytest.raises(ValueError):
+        SimulatedAnnealingHeuristicAntiClustering(backend="cuda")
+
+
+@pytest.mark.parametrize(
+    "algorithm",
+    [
+        ExchangeHeuristicAntiClustering(random_seed=4, restarts=2, max_passes=None),
+        ExchangeHeuristicAntiClustering(random_seed=4, restarts=2, max_passes=None, n_jobs=2),
+        SimulatedAnnealingHeuristicAntiClustering(random_seed=4, restarts=2),
+        TabuSearchHeuristicAntiClustering(random_seed=4, restarts=2, n_jobs=2),
+        NaiveRandomHeuristicAntiClustering(random_seed=4),
+        ParallelTemperingHeuristicAntiClustering(random_seed=4, num_replicas=2, iterations=2000, n_jobs=2),
+    ],
+)
+def test_nearest_neighbours(algorithm):
+    """
+    Test that heuristics run on the sparse nearest neighbour approximation, giving balanced anti-clusters, and that a
+    local optimum separates each element from its nearest neighbour.
+    """
+    # Pairs of nearly identical points, far apart from other pairs.
+    rng = np.random.default_rng(0)
+    points = np.repeat(rng.random((40, 2)) * 100, 2, axis=0) + rng.random((80, 2)) * 1e-3
+    df = pd.DataFrame(data=points, columns=["x", "y"])
+
+    distance_matrix = algorithm.compute_distance_matrix(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_neighbours=1
+    )
+    assert distance_matrix.nnz <= 80
+
+    result = algorithm.run_with_distance_matrix(
+        df=df, distance_matrix=distance_matrix, num_groups=2, destination_column="c"
+    )
+    assert sorted(result["c"].value_counts()) == [40, 40]
+    if isinstance(algorithm, ExchangeHeuristicAntiClustering):
+        labels = result["c"].to_numpy()
+        assert (labels[0::2] != labels[1::2]).all()
+
+
+def test_nearest_neighbours_unsupported():
+    """
+    Test that the exact approach and stripe initialization reject sparse distance matrices.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((12, 2)), columns=["x", "y"])
+    for algorithm in [ExactClusterEditingAntiClustering(), ExchangeHeuristicAntiClustering(initialization="stripe")]:
+        with pytest.raises(ValueError):
+            algorithm.run(
+                df=df,
+                numerical_columns=["x", "y"],
+                categorical_columns=None,
+                num_groups=2,
+                destination_column="c",
+                num_neighbours=3,
+            )
+
+
+@pytest.mark.parametrize(
+    "algorithm",
+    [
+        ExchangeHeuristicAntiClustering(random_seed=5, restarts=2, max_passes=None),
+        ExchangeHeuristicAntiClustering(random_seed=5, restarts=2, initialization="stripe", n_jobs=2),
+        SimulatedAnnealingHeuristicAntiClustering(random_seed=5, restarts=2),
+        TabuSearchHeuristicAntiClustering(random_seed=5, restarts=2, move_selection="best"),
+        NaiveRandomHeuristicAntiClustering(random_seed=5, initialization="stripe"),
+        ParallelTemperingHeuristicAntiClustering(random_seed=5, num_replicas=2, iterations=2000),
+    ],
+)
+@pytest.mark.parametrize("num_groups", [2, 5])
+def test_stratification(algorithm, num_groups):
+    """
+    Test that each combination of values of the stratify columns is spread evenly over the anti-clusters.
+    """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(data=rng.random((101, 2)), columns=["x", "y"])
+    df["country"] = rng.choice(["dk", "se", "no"], size=101, p=[0.6, 0.3, 0.1])
+    df["platform"] = rng.choice(["ios", "android", None], size=101)
+
+    result = algorithm.run(
+        df=df,
+        numerical_columns=["x", "y"],
+        categorical_columns=None,
+        num_groups=num_groups,
+        destination_column="c",
+        stratify_columns=["country", "platform"],
+    )
+    counts = pd.crosstab([result["country"], result["platform"].fillna("")], result["c"])
+    assert counts.shape[1] == num_groups
+    assert (counts.max(axis=1) - counts.min(axis=1) <= 1).all()
+    sizes = result["c"].value_counts()
+    assert sizes.max() - sizes.min() <= 1
+
+
+def test_stratification_unsupported():
+    """
+    Test that the exact approach and divide-and-conquer over several blocks reject stratification.
+    """
+    df = pd.DataFrame(data=np.random.default_rng(0).random((12, 2)), columns=["x", "y"])
+    df["s"] = np.arange(12) % 2
+    for algorithm in [
+        ExactClusterEditingAntiClustering(),
+        DivideAndConquerAntiClustering(ExchangeHeuristicAntiClustering(), block_size=4),
+    ]:
+        with pytest.raises(ValueError):
+            algorithm.run(
+                df=df,
+                numerical_columns=["x", "y"],
+                categorical_columns=None,
+                num_groups=2,
+                destination_column="c",
+                stratify_columns=["s"],
+            )
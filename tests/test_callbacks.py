@@ -0,0 +1,123 @@
+from anti_clustering import (
+    DivideAndConquerAntiClustering,
+    ExactClusterEditingAntiClustering,
+    ExchangeHeuristicAntiClustering,
+    MetricsCollector,
+    NaiveRandomHeuristicAntiClustering,
+    ParallelTemperingHeuristicAntiClustering,
+    SimulatedAnnealingHeuristicAntiClustering,
+    TabuSearchHeuristicAntiClustering,
+)
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def _run(algorithm, num_elements=40):
+    df = pd.DataFrame(data=np.random.default_rng(0).random((num_elements, 3)), columns=["x", "y", "z"])
+    return algorithm.run(
+        df=df, numerical_columns=["x", "y", "z"], categorical_columns=None, num_groups=3, destination_column="c"
+    )
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_metrics_collector(n_jobs):
+    """
+    Test that phases, restarts and iterations are collected, also from worker processes, without changing the result.
+    """
+    collector = MetricsCollector()
+    result = _run(ExchangeHeuristicAntiClustering(random_seed=2, restarts=3, n_jobs=n_jobs, callbacks=[collector]))
+    expected = _run(ExchangeHeuristicAntiClustering(random_seed=2, restarts=3))
+    assert (result["c"] == expected["c"]).all()
+
+    assert set(collector.timings) == {"prepare_data", "distance_matrix", "solve", "post_process"}
+    assert all(seconds >= 0 for seconds in collector.timings.values())
+    assert len(collector.restart_objectives) == 3
+
+    iterations = collector.iterations_frame()
+    assert len(iterations) == 3 * 40
+    assert (iterations.groupby("restart")["iteration"].max() == 39).all()
+    assert (iterations["accepted"] + iterations["rejected"] == iterations["iteration"] + 1).all()
+    last = iterations.groupby("restart").last()
+    assert np.allclose(last["objective"], collector.restart_objectives)
+
+
+@pytest.mark.parametrize(
+    "algorithm, field",
+    [
+        (SimulatedAnnealingHeuristicAntiClustering(random_seed=2, restarts=2, iterations=50), "temperature"),
+        (TabuSearchHeuristicAntiClustering(random_seed=2, restarts=2, iterations=50), "tabu_size"),
+        (ParallelTemperingHeuristicAntiClustering(random_seed=2, num_replicas=2, iterations=50), "temperature"),
+        (NaiveRandomHeuristicAntiClustering(random_seed=2, iterations=49), None),
+    ],
+)
+def test_heuristic_iterations(algorithm, field):
+    """
+    Test that every heuristic reports iterations with a monotone best objective and its own fields.
+    """
+    collector = MetricsCollector()
+    algorithm.callbacks = [collector]
+    _run(algorithm)
+
+    iterations = collector.iterations_frame()
+    assert len(iterations) > 0
+    for _, restart in iterations.groupby("restart"):
+        assert (np.diff(restart["best_objective"]) >= 0).all()
+        assert (restart["best_objective"] >= restart["objective"] - 1e-9).all()
+    if field is not None:
+        assert iterations[field].notna().all()
+
+
+def test_divide_and_conquer_phases():
+    """
+    Test that divide-and-conquer reports its own phases.
+    """
+    collector = MetricsCollector()
+    _run(
+        DivideAndConquerAntiClustering(
+            ExchangeHeuristicAntiClustering(random_seed=2, restarts=1), block_size=20, callbacks=[collector]
+        )
+    )
+    assert set(collector.timings) == {"prepare_data", "partition", "solve", "merge", "post_process"}
+
+
+def test_exact_phases(capsys):
+    """
+    Test that the exact approach reports the steps of solving as phases, and prints them in verbose mode.
+    """
+    collector = MetricsCollector()
+    algorithm = ExactClusterEditingAntiClustering(
+        preclustering=True,
+        warm_start=ExchangeHeuristicAntiClustering(random_seed=2, restarts=1),
+        lazy_constraints=True,
+        callbacks=[collector],
+    )
+    _run(algorithm, num_elements=9)
+    assert set(collector.timings) == {
+        "prepare_data",
+        "distance_matrix",
+        "precluster",
+        "warm_start",
+        "constraints",
+        "build_model",
+        "solve_model",
+        "solve",
+        "post_process",
+    }
+
+    algorithm.callbacks = None
+    algorithm.verbose = True
+    _run(algorithm, num_elements=9)
+    output = capsys.readouterr().out
+    assert "Finished build_model" in output
+    assert "Making objective" not in output
+
+
+def test_verbose_prints_progress(capsys):
+    """
+    Test that verbose mode prints phases and restarts.
+    """
+    _run(ExchangeHeuristicAntiClustering(random_seed=2, restarts=2, verbose=True))
+    output = capsys.readouterr().out
+    assert "Finished solve" in output
+    assert "Restart 2 finished" in output
@@ -0,0 +1,163 @@
+import pickle
+import numpy as np
+import scipy.sparse
+from anti_clustering._cluster_state import ClusterState
+
+
+def test_construction():
+    """
+    Tests that the membership index matches the labels.
+    """
+    state = ClusterState(labels=[1, 0, 1, 2, 0, 2], num_groups=3)
+    assert len(state) == 6
+    assert sorted(state.members(0)) == [1, 4]
+    assert sorted(state.members(1)) == [0, 2]
+    assert sorted(state.members(2)) == [3, 5]
+    assert not state.members(2).flags.writeable
+    assert state.group_size(1) == 2
+    assert sorted(state.exchanges(0)) == [1, 3, 4, 5]
+    assert state.num_exchanges(0) == 4
+
+
+def test_swap():
+    """
+    Tests that swapping updates labels, memberships and exchanges consistently.
+    """
+    state = ClusterState(labels=[1, 0, 1, 2, 0, 2], num_groups=3)
+    state.swap(0, 3)
+    assert list(state.labels) == [2, 0, 1, 1, 0, 2]
+    assert sorted(state.members(1)) == [2, 3]
+    assert sorted(state.members(2)) == [0, 5]
+    for i in range(len(state)):
+        exchanges = state.exchanges(i)
+        assert sorted(exchanges) == [j for j in range(len(state)) if state.labels[j] != state.labels[i]]
+        assert [state.exchange(i, k) for k in range(state.num_exchanges(i))] == list(exchanges)
+
+
+def test_copy_is_independent():
+    """
+    Tests that swapping in a copy does not affect the original state.
+    """
+    state = ClusterState(labels=[0, 1, 0, 1], num_groups=2)
+    other = state.copy()
+    other.swap(0, 1)
+    assert list(state.labels) == [0, 1, 0, 1]
+    assert list(other.labels) == [1, 0, 0, 1]
+
+
+def test_swap_deltas_match_objective():
+    """
+    Tests that incrementally maintained deltas and objective match recalculating the objective from scratch.
+    """
+    rng = np.random.default_rng(0)
+    points = rng.random((12, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+
+    def objective(labels):
+        return (np.equal.outer(labels, labels) * distance_matrix).sum()
+
+    state = ClusterState(labels=np.arange(12) % 3, num_groups=3, distance_matrix=distance_matrix)
+    assert np.isclose(state.objective, objective(state.labels))
+
+    for i, j in [(0, 1), (4, 2), (7, 11), (3, 5)]:
+        deltas = state.swap_deltas(i)
+        assert (deltas[state.labels == state.labels[i]] == -np.inf).all()
+        for k in state.exchanges(i):
+            swapped = state.labels.copy()
+            swapped[[i, k]] = swapped[[k, i]]
+            assert np.isclose(deltas[k], objective(swapped) - objective(state.labels))
+            assert np.isclose(state.swap_delta(i, k), deltas[k])
+
+        state.swap(i, j)
+        assert np.isclose(state.objective, objective(state.labels))
+
+
+def test_pickle_without_distance_matrix():
+    """
+    Tests that pickled states leave out the distance matrix, and work again once it is attached.
+    """
+    rng = np.random.default_rng(0)
+    points = rng.random((100, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    state = ClusterState(labels=np.arange(100) % 2, num_groups=2, distance_matrix=distance_matrix)
+
+    other = pickle.loads(pickle.dumps(state))
+    assert len(pickle.dumps(state)) < distance_matrix.nbytes
+    other.attach(distance_matrix)
+    other.swap(0, 1)
+    state.swap(0, 1)
+    assert list(other.labels) == list(state.labels)
+    assert np.isclose(other.objective, state.objective)
+
+
+def test_from_arrays():
+    """
+    Tests that a state rebuilt from its arrays swaps in place in those arrays, and matches the original state.
+    """
+    rng = np.random.default_rng(0)
+    points = rng.random((60, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    state = ClusterState(
+        labels=np.arange(60) % 3, num_groups=3, distance_matrix=distance_matrix, strata=np.arange(60) // 30
+    )
+
+    arrays = [array.copy() for array in state.to_arrays()]
+    other = ClusterState.from_arrays(arrays, state.objective, distance_matrix)
+    assert other.num_groups == 3 and other.num_strata == 2
+    other.swap(0, 1)
+    state.swap(0, 1)
+    assert other.labels is arrays[0]
+    assert list(arrays[0]) == list(state.labels)
+    assert np.isclose(other.objective, state.objective)
+    assert np.allclose(other.swap_deltas(2), state.swap_deltas(2))
+
+
+def test_sparse_distance_matrix():
+    """
+    Tests that a sparse distance matrix gives the same deltas and objective as the equivalent dense matrix.
+    """
+    rng = np.random.default_rng(0)
+    distance_matrix = scipy.sparse.random(30, 30, density=0.2, random_state=0, format="csr")
+    distance_matrix = (distance_matrix + distance_matrix.T).tocsr()
+    distance_matrix.sort_indices()
+    dense = distance_matrix.toarray()
+
+    labels = np.arange(30) % 3
+    sparse_state = ClusterState(labels=labels, num_groups=3, distance_matrix=distance_matrix)
+    dense_state = ClusterState(labels=labels, num_groups=3, distance_matrix=dense)
+    for _ in range(20):
+        i, j = rng.choice(30, size=2, replace=False)
+        if sparse_state.labels[i] == sparse_state.labels[j]:
+            continue
+        assert np.allclose(sparse_state.swap_deltas(i), dense_state.swap_deltas(i))
+        assert np.isclose(sparse_state.swap_delta(i, j), dense_state.swap_delta(i, j))
+        sparse_state.swap(i, j)
+        dense_state.swap(i, j)
+        assert np.isclose(sparse_state.objective, dense_state.objective)
+
+
+def test_strata():
+    """
+    Tests that elements only swap anti-clusters within their stratum, and that deltas and objective stay consistent.
+    """
+    rng = np.random.default_rng(0)
+    points = rng.random((24, 2))
+    distance_matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+    strata = np.arange(24) // 10
+    state = ClusterState(labels=np.arange(24) % 3, num_groups=3, distance_matrix=distance_matrix, strata=strata)
+    assert sorted(state.members(1)) == list(range(1, 24, 3))
+    assert not state.members(1).flags.writeable
+    assert state.group_size(0) == 8
+
+    for i, j in [(0, 4), (12, 17), (21, 23), (5, 9)]:
+        exchanges = state.exchanges(i)
+        expected = [k for k in range(24) if strata[k] == strata[i] and state.labels[k] != state.labels[i]]
+        assert sorted(exchanges) == expected
+        assert [state.exchange(i, k) for k in range(state.num_exchanges(i))] == list(exchanges)
+
+        deltas = state.swap_deltas(i)
+        assert (np.isfinite(deltas) == np.isin(np.arange(24), expected)).all()
+        assert np.isclose(state.swap_delta(i, j), deltas[j])
+        state.swap(i, j)
+        dense = ClusterState(labels=state.labels, num_groups=3, distance_matrix=distance_matrix)
+        assert np.isclose(state.objective, dense.objective)
@@ -0,0 +1,168 @@
+from anti_clustering._distance import build_distance_matrix, build_neighbour_graph, get_block_size, stack_codes
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+
+@pytest.mark.parametrize("block_size, n_jobs", [(100, 1), (1, 1), (7, 1), (7, 3)])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_blockwise_matches_full_matrix(block_size, n_jobs, dtype):
+    """
+    Test that building the distance matrix block by block gives the same result as building it at once.
+    """
+    rng = np.random.default_rng(0)
+    numerical_data = rng.random((30, 3))
+    categorical_data = rng.integers(0, 3, size=(30, 2))
+    expected = cdist(numerical_data, numerical_data) + cdist(categorical_data, categorical_data, metric="hamming")
+
+    distance_matrix = build_distance_matrix(
+        numerical_data=numerical_data,
+        categorical_data=categorical_data,
+        num_elements=30,
+        dtype=dtype,
+        block_size=block_size,
+        n_jobs=n_jobs,
+    )
+
+    assert distance_matrix.dtype == dtype
+    assert np.allclose(distance_matrix, expected, atol=1e-6)
+
+
+def test_block_size():
+    """
+    Test that the default block size stays within the scratch memory budget and requested sizes are respected.
+    """
+    assert get_block_size(num_elements=10, n_jobs=1, block_size=3) == 3
+    assert get_block_size(num_elements=10**6, n_jobs=4) * 10**6 * 8 * 4 <= 64 * 2**20
+    assert get_block_size(num_elements=10**9, n_jobs=4) == 1
+    with pytest.raises(ValueError):
+        get_block_size(num_elements=10, n_jobs=1, block_size=0)
+
+
+def test_categorical_codes():
+    """
+    Test that categorical codes are stacked in a compact type, and give the Hamming distance of the original codes.
+    """
+    rng = np.random.default_rng(0)
+    codes = [rng.integers(-1, 3, size=40), rng.integers(-1, 1000, size=40), rng.integers(0, 2, size=40)]
+    categorical_data = stack_codes(codes)
+    assert categorical_data.dtype == np.int16
+    assert categorical_data.flags.f_contiguous
+
+    distance_matrix = build_distance_matrix(
+        numerical_data=None,
+        categorical_data=categorical_data,
+        num_elements=40,
+        dtype=np.float64,
+        block_size=7,
+        n_jobs=1,
+    )
+    expected = cdist(np.column_stack(codes), np.column_stack(codes), metric="hamming")
+    assert np.allclose(distance_matrix, expected)
+    assert (distance_matrix == distance_matrix.T).all()
+
+
+def test_metrics():
+    """
+    Test the cosine, weighted Euclidean and Gower distances against direct computations.
+    """
+    rng = np.random.default_rng(0)
+    numerical_data = rng.random((30, 3))
+    categorical_data = rng.integers(0, 3, size=(30, 2))
+    numerical_weights = np.array([1.0, 2.0, 0.5])
+    categorical_weights = np.array([3.0, 1.0])
+
+    def build(metric):
+        return build_distance_matrix(
+            numerical_data=numerical_data,
+            categorical_data=categorical_data,
+            num_elements=30,
+            dtype=np.float64,
+            block_size=7,
+            n_jobs=1,
+            metric=metric,
+            numerical_weights=numerical_weights,
+            categorical_weights=categorical_weights,
+        )
+
+    mismatches = categorical_data[:, None, :] != categorical_data[None, :, :]
+    hamming = (mismatches * categorical_weights).sum(axis=2) / categorical_weights.sum()
+
+    euclidean = cdist(numerical_data, numerical_data, metric="euclidean", w=numerical_weights)
+    assert np.allclose(build("euclidean"), euclidean + hamming)
+
+    weighted_data = numerical_data * np.sqrt(numerical_weights)
+    cosine = cdist(weighted_data, weighted_data, metric="cosine")
+    assert np.allclose(build("cosine"), cosine + hamming)
+
+    absolute_differences = np.abs(numerical_data[:, None, :] - numerical_data[None, :, :])
+    gower = (
+        (absolute_differences * numerical_weights).sum(axis=2) + (mismatches * categorical_weights).sum(axis=2)
+    ) / (numerical_weights.sum() + categorical_weights.sum())
+    assert np.allclose(build("gower"), gower)
+
+
+def test_invalid_metric_and_weights():
+    """
+    Test that unknown metrics and negative weights are rejected.
+    """
+    numerical_data = np.zeros((3, 2))
+    with pytest.raises(ValueError):
+        build_distance_matrix(
+            numerical_data=numerical_data,
+            categorical_data=None,
+            num_elements=3,
+            dtype=np.float64,
+            block_size=3,
+            n_jobs=1,
+            metric="manhattan",
+        )
+    with pytest.raises(ValueError):
+        build_distance_matrix(
+            numerical_data=numerical_data,
+            categorical_data=None,
+            num_elements=3,
+            dtype=np.float64,
+            block_size=3,
+            n_jobs=1,
+            numerical_weights=np.array([1.0, -1.0]),
+        )
+
+
+@pytest.mark.parametrize(
+    "metric, categorical",
+    [("euclidean", False), ("gower", False), ("cosine", False), ("euclidean", True), ("gower", True)],
+)
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_neighbour_graph(metric, categorical, n_jobs):
+    """
+    Test that the neighbour graph holds the distances to the nearest neighbours of each element, minus the largest of
+    these distances, for both the tree and brute force searches.
+    """
+    rng = np.random.default_rng(0)
+    numerical_data = rng.random((50, 3))
+    categorical_data = rng.integers(0, 3, size=(50, 2)) if categorical else None
+    kwargs = dict(
+        numerical_data=numerical_data,
+        categorical_data=categorical_data,
+        num_elements=50,
+        dtype=np.float64,
+        block_size=7,
+        n_jobs=n_jobs,
+        metric=metric,
+    )
+    distance_matrix = build_distance_matrix(**kwargs)
+    graph = build_neighbour_graph(num_neighbours=4, **kwargs)
+
+    assert (graph != graph.T).nnz == 0
+    np.fill_diagonal(distance_matrix, np.inf)
+    neighbours = np.argsort(distance_matrix, axis=1, kind="stable")[:, :4]
+    largest = np.take_along_axis(distance_matrix, neighbours, axis=1).max()
+    rows, cols = graph.nonzero()
+    assert np.allclose(graph.data, distance_matrix[rows, cols] - largest)
+    # Every neighbour closer than the largest distance is in the graph.
+    closer = np.take_along_axis(distance_matrix, neighbours, axis=1) < largest - 1e-9
+    assert all(graph[i, j] != 0 for i, j in zip(np.repeat(np.arange(50), 4)[closer.ravel()], neighbours[closer]))
+
+    with pytest.raises(ValueError):
+        build_neighbour_graph(num_neighbours=0, **kwargs)
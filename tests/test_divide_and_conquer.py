@@ -0,0 +1,84 @@
+from anti_clustering import (
+    DivideAndConquerAntiClustering,
+    ExchangeHeuristicAntiClustering,
+    NaiveRandomHeuristicAntiClustering,
+)
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize("partitioning", ["projection", "kmeans"])
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_blocks_are_merged_into_balanced_groups(partitioning, n_jobs):
+    """
+    Test that merging block-level anti-clusters gives balanced global anti-clusters.
+    """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(data=rng.random((203, 2)), columns=["x", "y"]).assign(c=rng.choice(["a", "b"], size=203))
+    algorithm = DivideAndConquerAntiClustering(
+        ExchangeHeuristicAntiClustering(random_seed=1, restarts=2),
+        block_size=50,
+        partitioning=partitioning,
+        random_seed=0,
+        n_jobs=n_jobs,
+    )
+
+    result = algorithm.run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=["c"], num_groups=3, destination_column="Cluster"
+    )
+
+    counts = result["Cluster"].value_counts()
+    assert sorted(counts.index) == [0, 1, 2]
+    assert counts.max() - counts.min() <= 1
+    category_counts = result.groupby("Cluster")["c"].value_counts().unstack()
+    assert (category_counts.max() - category_counts.min() <= 2).all()
+    means = result.groupby("Cluster")[["x", "y"]].mean()
+    assert (means.max() - means.min() < 0.05).all()
+
+
+@pytest.mark.parametrize("partitioning", ["projection", "kmeans"])
+def test_high_cardinality_categorical(partitioning):
+    """
+    Test that a categorical column with a category per row is encoded sparsely, and still gives balanced anti-clusters.
+    """
+    rng = np.random.default_rng(0)
+    num_elements = 12_000
+    df = pd.DataFrame(data={"x": rng.random(num_elements), "id": np.arange(num_elements).astype(str)})
+    algorithm = DivideAndConquerAntiClustering(
+        NaiveRandomHeuristicAntiClustering(random_seed=1, iterations=1),
+        block_size=2000,
+        partitioning=partitioning,
+        random_seed=0,
+    )
+
+    features = algorithm._get_features(df=df, numerical_columns=["x"], categorical_columns=["id"])
+    assert features.shape == (num_elements, num_elements + 1)
+    assert features.nnz <= 2 * num_elements
+
+    result = algorithm.run(
+        df=df, numerical_columns=["x"], categorical_columns=["id"], num_groups=4, destination_column="Cluster"
+    )
+    counts = result["Cluster"].value_counts()
+    assert counts.max() - counts.min() <= 1
+    means = result.groupby("Cluster")["x"].mean()
+    assert means.max() - means.min() < 0.05
+
+
+def test_small_dataset_is_solved_directly():
+    """
+    Test that datasets fitting in a single block are passed to the wrapped algorithm.
+    """
+    df = pd.DataFrame(data={"x": [0, 0, 2, 3, 3, 2], "y": [1, 2, 2, 1, 0, 0]})
+    result = DivideAndConquerAntiClustering(ExchangeHeuristicAntiClustering(random_seed=1), block_size=10).run(
+        df=df, numerical_columns=["x", "y"], categorical_columns=None, num_groups=2, destination_column="Cluster"
+    )
+    assert (result["Cluster"].to_numpy() == [0, 1, 0, 1, 0, 1]).all()
+
+
+def test_invalid_partitioning():
+    """
+    Test that unknown partitioning strategies are rejected.
+    """
+    with pytest.raises(ValueError):
+        DivideAndConquerAntiClustering(ExchangeHeuristicAntiClustering(), partitioning="unknown")
@@ -0,0 +1,150 @@
+from anti_clustering import ExchangeHeuristicAntiClustering, OnlineAntiClustering
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def _make_df(rng, size):
+    df = pd.DataFrame(data=rng.random((size, 2)), columns=["x", "y"])
+    return df.assign(c=rng.choice(["a", "b", "c", "d"], size=size))
+
+
+def _objective(df, column):
+    """
+    Sum of squared Euclidean and Hamming distances within anti-clusters.
+    """
+    objective = 0
+    for _, group in df.groupby(column):
+        features = group[["x", "y"]].to_numpy()
+        objective += np.square(features[:, None] - features[None, :]).sum()
+        objective += np.not_equal.outer(group["c"].to_numpy(), group["c"].to_numpy()).sum()
+    return objective
+
+
+def test_assign_keeps_groups_balanced():
+    """
+    Test that new rows are assigned such that anti-cluster sizes differ by at most one.
+    """
+    rng = np.random.default_rng(0)
+    online = OnlineAntiClustering(ExchangeHeuristicAntiClustering(random_seed=1))
+    online.run(
+        df=_make_df(rng, 31),
+        numerical_columns=["x", "y"],
+        categorical_columns=["c"],
+        num_groups=3,
+        destination_column="Cluster",
+    )
+
+    for size in [1, 5, 17]:
+        result = online.assign(_make_df(rng, size))
+        assert len(result) == size
+        assert set(result["Cluster"]).issubset({0, 1, 2})
+        counts = np.bincount(online.labels)
+        assert counts.max() - counts.min() <= 1
+
+
+def test_assign_before_run():
+    """
+    Test that assigning rows requires an initial run.
+    """
+    with pytest.raises(ValueError):
+        OnlineAntiClustering(ExchangeHeuristicAntiClustering()).assign(_make_df(np.random.default_rng(0), 3))
+
+
+def test_reoptimize_improves_objective():
+    """
+    Test that the re-optimization pass does not decrease the objective and keeps aggregates consistent.
+    """
+    rng = np.random.default_rng(1)
+    initial_df, new_df = _make_df(rng, 40), _make_df(rng, 40)
+    online = OnlineAntiClustering(ExchangeHeuristicAntiClustering(random_seed=1))
+    online.run(
+        df=initial_df,
+        numerical_columns=["x", "y"],
+        categorical_columns=["c"],
+        num_groups=2,
+        destination_column="Cluster",
+    )
+    online.assign(new_df)
+
+    scaled_df = pd.concat([initial_df, new_df], ignore_index=True)
+    scaled_df[["x", "y"]] = (scaled_df[["x", "y"]] - initial_df[["x", "y"]].min()) / (
+        initial_df[["x", "y"]].max() - initial_df[["x", "y"]].min()
+    )
+    before = _objective(scaled_df.assign(Cluster=online.labels), "Cluster")
+    online.reoptimize()
+    after = _objective(scaled_df.assign(Cluster=online.labels), "Cluster")
+
+    assert after >= before - 1e-9
+    assert (np.bincount(online.labels) == [40, 40]).all()
+
+
+def test_reoptimize_returns_moved_rows():
+    """
+    Test that the re-optimization pass returns exactly the rows whose labels changed, including earlier rows.
+    """
+    rng = np.random.default_rng(2)
+    online = OnlineAntiClustering(ExchangeHeuristicAntiClustering(random_seed=1))
+    online.run(
+        df=_make_df(rng, 30),
+        numerical_columns=["x", "y"],
+        categorical_columns=["c"],
+        num_groups=3,
+        destination_column="Cluster",
+    )
+    online.assign(_make_df(rng, 30))
+
+    before = online.labels
+    moved = online.reoptimize()
+    assert list(moved) == list(np.flatnonzero(online.labels != before))
+
+
+def test_run_forwards_options():
+    """
+    Test that metric, weights and strata are used by both the wrapped algorithm and the aggregate-based distances.
+    """
+    rng = np.random.default_rng(3)
+    df = _make_df(rng, 36).assign(s=np.arange(36) % 2)
+    options = dict(
+        numerical_columns=["x", "y"],
+        categorical_columns=["c"],
+        num_groups=3,
+        destination_column="Cluster",
+        metric="cosine",
+        weights={"x": 2.0, "c": 0.5},
+    )
+    online = OnlineAntiClustering(ExchangeHeuristicAntiClustering(random_seed=1))
+    result = online.run(df=df, stratify_columns=["s"], **options)
+    expected = ExchangeHeuristicAntiClustering(random_seed=1).run(df=df, stratify_columns=["s"], **options)
+    assert list(result["Cluster"]) == list(expected["Cluster"])
+
+    algorithm = ExchangeHeuristicAntiClustering()
+    distance_matrix = algorithm.compute_distance_matrix(
+        df=df, numerical_columns=["x", "y"], categorical_columns=["c"], metric="cosine", weights=options["weights"]
+    )
+    features, codes, _ = online._encode(df)
+    one_hot = np.eye(3)[result["Cluster"]]
+    assert np.allclose(online._distance_to_groups(features, codes), distance_matrix @ one_hot)
+
+    new_df = _make_df(rng, 12).assign(s=np.arange(12) % 2)
+    online.assign(new_df)
+    online.reoptimize()
+    strata = np.concatenate([df["s"].to_numpy(), new_df["s"].to_numpy()])
+    for stratum in [0, 1]:
+        counts = np.bincount(online.labels[strata == stratum], minlength=3)
+        assert counts.max() - counts.min() <= 1
+
+
+def test_unsupported_metric():
+    """
+    Test that metrics that cannot be computed from aggregates are rejected.
+    """
+    with pytest.raises(ValueError):
+        OnlineAntiClustering(ExchangeHeuristicAntiClustering()).run(
+            df=_make_df(np.random.default_rng(0), 10),
+            numerical_columns=["x", "y"],
+            categorical_columns=["c"],
+            num_groups=2,
+            destination_column="Cluster",
+            metric="gower",
+        )
@@ -1,3 +1,4 @@
+import numpy as np
 from anti_clustering._union_find import UnionFind
 
 
@@ -61,3 +62,37 @@ def test_imbalanced_union():
     )
 
     assert uf.connected(0, 9)
+
+
+def test_union_many():
+    """
+    Tests that unioning pairs in bulk gives the same components as unioning them one at a time.
+    """
+    rng = np.random.default_rng(0)
+    pairs = rng.integers(0, 100, size=(60, 2))
+
+    uf_single = UnionFind(100)
+    for element_1, element_2 in pairs:
+        uf_single.union(element_1, element_2)
+    uf_bulk = UnionFind(100).union_many(pairs)
+
+    assert uf_bulk.components_count == uf_single.components_count
+    assert (uf_bulk.labels() == uf_single.labels()).all()
+    for element_1, element_2 in rng.integers(0, 100, size=(200, 2)):
+        assert uf_bulk.connected(element_1, element_2) == uf_single.connected(element_1, element_2)
+
+
+def test_find_all_and_labels():
+    """
+    Tests that all roots are found and labels are enumerated by first occurrence.
+    """
+    uf = UnionFind(6).union_many([(4, 5), (1, 3), (3, 5)])
+    roots = uf.find_all()
+    assert roots[0] == 0 and roots[2] == 2
+    assert roots[1] == roots[3] == roots[4] == roots[5]
+    assert list(uf.labels()) == [0, 1, 2, 1, 1, 1]
+    assert uf.components_count == 3
+
+    uf.union(0, 2)
+    assert list(uf.labels()) == [0, 1, 0, 1, 1, 1]
+    assert uf.components_count == 2